@@ -0,0 +1,320 @@
+"""Records the latency, sizes and counts of the AppBoy and Google Analytics calls.
+
+Both API modules record into the registry returned by get_default_registry:
+per-stage latency histograms, bytes sent and received, batch sizes, retries and
+in-flight requests. A metric is created the first time it is recorded, and each
+record takes one lock and, for histograms, one bisect, so the instrumentation
+can stay on in production.
+
+The registry is exported in the Prometheus text format or as a JSON snapshot,
+and serve_metrics serves both over HTTP.
+
+Sample Application Usage:
+
+  import ApiMetrics
+  ApiMetrics.serve_metrics(9100)
+  # GET http://127.0.0.1:9100/metrics or http://127.0.0.1:9100/metrics.json
+
+"""
+
+import BaseHTTPServer
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Upper bounds of the histogram buckets of counts, like objects per batch.
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 30, 40, 50, 100, 1000)
+
+# Content type of the Prometheus text format.
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def label_key(labels):
+  """Gets the hashable key of a set of labels."""
+  return tuple(sorted(labels.iteritems()))
+
+
+def format_labels(key, extra=()):
+  """Formats labels for the Prometheus text format.
+
+  Args:
+    key: tuple The (name, value) of each label.
+    extra: tuple More (name, value) labels, such as the le of a bucket.
+
+  Returns:
+    The labels in braces, or '' if there are none.
+  """
+  labels = key + tuple(extra)
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(
+      '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+      for name, value in labels)
+
+
+def format_bound(bound):
+  return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Histogram(object):
+  """Counts observations into fixed buckets, with their sum.
+
+  Args:
+    buckets: tuple The upper bound of each bucket, in increasing order.
+  """
+
+  __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+  def __init__(self, buckets):
+    self.bounds = tuple(buckets) + (float('inf'),)
+    self.counts = [0] * len(self.bounds)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative(self):
+    """Gets the (upper bound, observations at or under it) of each bucket."""
+    total = 0
+    buckets = []
+    for bound, count in zip(self.bounds, self.counts):
+      total += count
+      buckets.append((bound, total))
+    return buckets
+
+
+class MetricsRegistry(object):
+  """Holds counters, gauges and histograms, each split by labels.
+
+  Every method is thread-safe.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # (type, values by label key) of each metric, by name.
+    self.metrics = {}
+
+  def values(self, name, metric_type):
+    metric = self.metrics.get(name)
+    if metric is None:
+      metric = self.metrics[name] = (metric_type, {})
+    return metric[1]
+
+  def counter(self, name, value=1, **labels):
+    """Adds to a counter.
+
+    Args:
+      name: str The metric name.
+      value: number The amount to add.
+      **labels: The labels of the series.
+    """
+    key = label_key(labels)
+    with self.lock:
+      values = self.values(name, 'counter')
+      values[key] = values.get(key, 0) + value
+
+  def gauge(self, name, value, **labels):
+    """Sets a gauge.
+
+    Args:
+      name: str The metric name.
+      value: number The new value.
+      **labels: The labels of the series.
+    """
+    key = label_key(labels)
+    with self.lock:
+      self.values(name, 'gauge')[key] = value
+
+  def add_gauge(self, name, delta, **labels):
+    """Adds to a gauge, which may go down.
+
+    Args:
+      name: str The metric name.
+      delta: number The amount to add.
+      **labels: The labels of the series.
+    """
+    key = label_key(labels)
+    with self.lock:
+      values = self.values(name, 'gauge')
+      values[key] = values.get(key, 0) + delta
+
+  def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Records an observation in a histogram.
+
+    Args:
+      name: str The metric name.
+      value: number The observed value.
+      buckets: tuple The bucket bounds, used when the series is created.
+      **labels: The labels of the series.
+    """
+    key = label_key(labels)
+    with self.lock:
+      values = self.values(name, 'histogram')
+      histogram = values.get(key)
+      if histogram is None:
+        histogram = values[key] = Histogram(buckets)
+      histogram.observe(value)
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    """Records the seconds spent in a with block in a latency histogram."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name, time.time() - start, **labels)
+
+  @contextlib.contextmanager
+  def in_flight(self, name, **labels):
+    """Counts the threads inside a with block in a gauge."""
+    self.add_gauge(name, 1, **labels)
+    try:
+      yield
+    finally:
+      self.add_gauge(name, -1, **labels)
+
+  def reset(self):
+    """Drops every metric."""
+    with self.lock:
+      self.metrics = {}
+
+  def merge(self, snapshot):
+    """Adds the metrics of a snapshot, such as one taken in another process.
+
+    Counters and gauges are added to the series with the same labels, and so
+    are the buckets, sum and count of histograms.
+
+    Args:
+      snapshot: dict A snapshot returned by the snapshot method.
+    """
+    with self.lock:
+      for name, metric in snapshot.iteritems():
+        values = self.values(name, metric['type'])
+        for entry in metric['series']:
+          key = label_key(entry['labels'])
+          if metric['type'] != 'histogram':
+            values[key] = values.get(key, 0) + entry['value']
+            continue
+          bounds = [float(bound) for bound, _ in entry['buckets']]
+          histogram = values.get(key)
+          if histogram is None:
+            histogram = values[key] = Histogram(bounds[:-1])
+          previous = 0
+          for index, (_, total) in enumerate(entry['buckets']):
+            histogram.counts[index] += total - previous
+            previous = total
+          histogram.sum += entry['sum']
+          histogram.count += entry['count']
+
+  def snapshot(self):
+    """Gets the current value of every metric.
+
+    Returns:
+      A dictionary with the 'type' and the 'series' of each metric, by name.
+      Each series holds its 'labels' and either its 'value' or, for
+      histograms, its 'count', 'sum' and cumulative 'buckets'.
+    """
+    snapshot = {}
+    with self.lock:
+      for name, (metric_type, values) in self.metrics.iteritems():
+        series = []
+        for key, value in values.iteritems():
+          entry = {'labels': dict(key)}
+          if metric_type == 'histogram':
+            entry['count'] = value.count
+            entry['sum'] = value.sum
+            entry['buckets'] = [[format_bound(bound), count]
+                                for bound, count in value.cumulative()]
+          else:
+            entry['value'] = value
+          series.append(entry)
+        snapshot[name] = {'type': metric_type, 'series': series}
+    return snapshot
+
+  def to_json(self):
+    """Gets the snapshot as a JSON string."""
+    return json.dumps(self.snapshot(), sort_keys=True)
+
+  def to_prometheus(self):
+    """Gets every metric in the Prometheus text exposition format."""
+    lines = []
+    with self.lock:
+      for name in sorted(self.metrics):
+        metric_type, values = self.metrics[name]
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for key in sorted(values):
+          value = values[key]
+          if metric_type != 'histogram':
+            lines.append('%s%s %r' % (name, format_labels(key), value))
+            continue
+          for bound, count in value.cumulative():
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(key, [('le', format_bound(bound))]), count))
+          lines.append('%s_sum%s %r' % (name, format_labels(key), value.sum))
+          lines.append('%s_count%s %d' % (name, format_labels(key),
+                                          value.count))
+    return '\n'.join(lines) + '\n'
+
+
+_default_registry = MetricsRegistry()
+
+
+def get_default_registry():
+  """Gets the registry the API modules record into.
+
+  Returns:
+    The module wide MetricsRegistry.
+  """
+  return _default_registry
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves /metrics in the Prometheus text format and /metrics.json."""
+
+  def do_GET(self):
+    if self.path == '/metrics':
+      self.send_body(self.server.registry.to_prometheus(),
+                     PROMETHEUS_CONTENT_TYPE)
+    elif self.path == '/metrics.json':
+      self.send_body(self.server.registry.to_json(), 'application/json')
+    else:
+      self.send_error(404)
+
+  def send_body(self, body, content_type):
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def serve_metrics(port, host='127.0.0.1', registry=None):
+  """Serves a registry over HTTP from a background thread.
+
+  Args:
+    port: int The port to listen on; 0 picks a free one.
+    host: str The address to listen on.
+    registry: MetricsRegistry The registry to serve. Defaults to the registry
+      the API modules record into.
+
+  Returns:
+    The running server. Call its shutdown method to stop it.
+  """
+  server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+  server.registry = registry or get_default_registry()
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
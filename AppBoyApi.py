@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """This application demonstrates a use case with tasks on Working with AppBoy API using Python.
 
 # predefinition1: Users already exist in the Appboy account and we are only interested in
@@ -44,165 +45,2342 @@ Sample Application Usage:
 
 """
 
+import array
+import collections
+import contextlib
+import email.utils
+import hashlib
+import itertools
+import json
+import multiprocessing
+import operator
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import zlib
+import Queue
+
 import requests
+import requests.adapters
 import datetime
 import time
 
-def get_users_response_object(request_url, app_group_id):
+import ApiMetrics
+
+# Latency, size and retry metrics of the requests, exported by ApiMetrics.
+metrics = ApiMetrics.get_default_registry()
+
+# The /users/track fields holding object lists, whose sizes are recorded.
+OBJECT_FIELDS = ('attributes', 'events', 'purchases')
+
+# simplejson's C encoder can be used for the request bodies when installed.
+try:
+  import simplejson
+except ImportError:
+  simplejson = None
+
+# The max of user objects per API call.
+BATCH_SIZE = 50
+
+# Default number of /users/track requests sent concurrently.
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# How many batches, per worker, may be queued or waiting for collection.
+PENDING_PER_WORKER = 4
+
+# Default number of keep-alive connections pooled per host. Matches the
+# default concurrency so every worker can hold a connection.
+DEFAULT_POOL_SIZE = DEFAULT_MAX_IN_FLIGHT
+
+# Default seconds to wait for the API to answer.
+DEFAULT_TIMEOUT = 60
+
+# Default /users/track quota of the account, in requests per hour.
+DEFAULT_REQUESTS_PER_HOUR = 50000
+
+# Default number of requests that may be sent in a burst above the steady rate.
+DEFAULT_BURST = DEFAULT_MAX_IN_FLIGHT
+
+# Default number of times a throttled or failed batch is sent again.
+DEFAULT_MAX_RETRIES = 8
+
+# Bounds, in seconds, of the exponential backoff between retries.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+# Compression level for gzip request bodies.
+GZIP_LEVEL = 6
+
+# Separators of the compact JSON request bodies.
+JSON_SEPARATORS = (',', ':')
+
+# Headers sent with every request.
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Rows fetched from the source tables per cursor page.
+SOURCE_PAGE_SIZE = 1000
+
+# SQLite stand-in for the appboy tables described above. SQLite has no integer
+# key on appboy.user, so its rowid is what appboy.user_events.user_id refers to.
+SOURCE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS appboy.user
+(
+  user_external_id text UNIQUE,
+  email text,
+  optin_status integer,
+  app_group_id text,
+  first_name text,
+  last_name text,
+  user_zipcode text,
+  user_city text,
+  last_modified_at timestamp
+);
+CREATE TABLE IF NOT EXISTS appboy.user_events
+(
+  user_events_id bigint PRIMARY KEY,
+  user_id integer,
+  name varchar,
+  time timestamp
+);
+CREATE INDEX IF NOT EXISTS appboy.user_events_user_id
+  ON user_events (user_id, user_events_id);
+"""
+
+# appboy.user columns and the user Attribute object fields they are sent as.
+USER_ATTRIBUTE_COLUMNS = [
+    ('user_external_id', 'external_id'),
+    ('email', 'email'),
+    ('optin_status', 'optin_status'),
+    ('first_name', 'first_name'),
+    ('last_name', 'last_name'),
+    ('user_zipcode', 'user_zipcode'),
+    ('user_city', 'home_city'),
+    ('last_modified_at', 'last_modified_at'),
+]
+
+# Attribute object fields held by a UserRecord.
+USER_RECORD_FIELDS = tuple(field for _, field in USER_ATTRIBUTE_COLUMNS)
+USER_RECORD_FIELD_SET = frozenset(USER_RECORD_FIELDS)
+
+# Typecode of 64-bit integer arrays, for the event epoch timestamps.
+try:
+  array.array('q')
+  INT64_TYPECODE = 'q'
+except ValueError:
+  INT64_TYPECODE = 'l'
+
+# Format of the event times sent to the API.
+ISO_8601_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Epoch stored in EventColumns for an event without a time, which is then sent
+# with a None time unless the time is overridden.
+NO_TIME = -2 ** 63
+
+# Table holding the incremental sync high-water mark of each app group.
+WATERMARK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_watermark
+(
+  app_group_id text PRIMARY KEY,
+  last_modified_at timestamp,
+  user_external_id text
+)
+"""
+
+# Table holding the digests of the last Attribute object pushed for each user.
+DIGEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pushed_digest
+(
+  external_id text PRIMARY KEY,
+  digests text
+)
+"""
+
+# Users looked up per digest query, under SQLite's limit of 999 parameters.
+DIGEST_LOOKUP_SIZE = 500
+
+# Default number of processes the app group shards are synced in.
+DEFAULT_PROCESSES = multiprocessing.cpu_count()
+
+# Default seconds within which repeats of a user's event are coalesced.
+DEFAULT_COALESCE_WINDOW = 60
+
+# Max event ids, and max (user, event name) pairs, an EventDeduper remembers.
+DEDUP_MAX_IDS = 65536
+DEDUP_MAX_KEYS = 65536
+
+
+class AppBoyError(Exception):
+  """Raised when the AppBoy API answers a request with a status other than 200."""
+
+  def __init__(self, response):
+    Exception.__init__(
+        self, 'Status: %s Problem with the request.' % response.status_code)
+    self.response = response
+    self.status_code = response.status_code
+
+
+def encode_default(obj):
+  """Turns the values the JSON encoder does not know into JSON values.
+
+  Lazily serialised records are turned into their Attribute or Event objects,
+  and datetimes into ISO-8601 UTC times, as the encoder reaches them.
+
+  Args:
+    obj: The value to encode.
+
+  Returns:
+    A value the JSON encoder can write.
+
+  Raises:
+    TypeError: If the value cannot be encoded.
+  """
+  if hasattr(obj, 'to_object'):
+    return obj.to_object()
+  if hasattr(obj, 'to_objects'):
+    return obj.to_objects()
+  if isinstance(obj, datetime.datetime):
+    # Naive datetimes are taken to be UTC, as datetime.utcnow() returns.
+    offset = obj.utcoffset()
+    if offset is not None:
+      obj = obj.replace(tzinfo=None) - offset
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second)
+  if isinstance(obj, datetime.date):
+    return obj.isoformat()
+  raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+class PayloadEncoder(object):
+  """Encodes /users/track payloads as compact JSON request bodies.
+
+  The underlying JSON encoder is built once and shared by every batch and
+  worker thread, instead of once per json.dumps call, and writes the body in a
+  single pass through encode_default without copying the payload first. The
+  last datetime formatted is kept, since a sync sets the same one on every user.
+
+  The standard json module already encodes with its C speedups, so simplejson
+  is only used when asked for; AppBoyBenchmark compares the two.
+
+  Args:
+    use_simplejson: bool Whether to use simplejson when it is installed.
+  """
+
+  def __init__(self, use_simplejson=False):
+    module = simplejson if use_simplejson and simplejson is not None else json
+    self.backend = module.__name__
+    self.encoder = module.JSONEncoder(separators=JSON_SEPARATORS,
+                                      default=self.default)
+    # Replaced as a whole, so worker threads always read a matching pair.
+    self.last_datetime = (None, None)
+
+  def default(self, obj):
+    """Encodes a value through encode_default, reusing the last datetime."""
+    if isinstance(obj, datetime.datetime):
+      last, text = self.last_datetime
+      if last is not obj:
+        text = encode_default(obj)
+        self.last_datetime = (obj, text)
+      return text
+    return encode_default(obj)
+
+  def encode(self, payload):
+    """Encodes a payload.
+
+    Args:
+      payload: dict The /users/track payload.
+
+    Returns:
+      The JSON body, as an ASCII str.
+    """
+    return self.encoder.encode(payload)
+
+
+def gzip_body(body):
+  """Compresses a request body into the gzip format.
+
+  Args:
+    body: str The request body.
+
+  Returns:
+    The gzip compressed body.
+  """
+  compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(body) + compressor.flush()
+
+
+class AppBoyClient(object):
+  """Sends AppBoy API requests over a pooled, keep-alive HTTP session.
+
+  The session is safe to share between the push worker threads: each request
+  borrows a connection from the pool and returns it once the response is read,
+  so consecutive batches reuse connections instead of opening new ones.
+
+  Args:
+    pool_size: int The max number of connections kept alive per host.
+    gzip_requests: bool Whether to gzip the request bodies.
+    timeout: float Seconds to wait for the API to answer.
+    encoder: PayloadEncoder The encoder of the request bodies.
+  """
+
+  def __init__(self, pool_size=DEFAULT_POOL_SIZE, gzip_requests=False,
+               timeout=DEFAULT_TIMEOUT, encoder=None):
+    self.pool_size = pool_size
+    self.gzip_requests = gzip_requests
+    self.timeout = timeout
+    self.encoder = encoder or PayloadEncoder()
+
+    # Build the headers once instead of once per request.
+    self.session = requests.Session()
+    self.session.headers.update(JSON_HEADERS)
+
+    # Block on an exhausted pool rather than opening throwaway connections.
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+  def get(self, request_url, data):
+    """Sends a GET request.
+
+    Args:
+      request_url: string The request API endpoint.
+      data: dict The request data.
+
+    Returns:
+      The response object.
+    """
+    with metrics.in_flight('appboy_requests_in_flight'):
+      with metrics.timer('appboy_request_seconds', method='GET'):
+        response = self.session.get(request_url, data=data,
+                                    timeout=self.timeout)
+    self.record(response, 'GET')
+    return response
+
+  def post(self, request_url, data):
+    """Sends a POST request with a JSON body, gzipped if enabled.
+
+    Args:
+      request_url: string The request API endpoint.
+      data: dict The request data.
+
+    Returns:
+      The response object.
+    """
+    with metrics.timer('appboy_encode_seconds'):
+      body = self.encoder.encode(data)
+      headers = None
+      if self.gzip_requests:
+        body = gzip_body(body)
+        headers = {'Content-Encoding': 'gzip'}
+    metrics.counter('appboy_bytes_sent_total', len(body), method='POST')
+    with metrics.in_flight('appboy_requests_in_flight'):
+      with metrics.timer('appboy_request_seconds', method='POST'):
+        response = self.session.post(request_url, data=body, headers=headers,
+                                     timeout=self.timeout)
+    self.record(response, 'POST')
+    return response
+
+  def record(self, response, method):
+    """Records the size and status of a response."""
+    metrics.counter('appboy_bytes_received_total', len(response.content),
+                    method=method)
+    metrics.counter('appboy_responses_total', method=method,
+                    status=response.status_code)
+
+  def close(self):
+    """Closes the pooled connections."""
+    self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+  """Gets the client shared by calls that are not given one.
+
+  Returns:
+    The module wide AppBoyClient, created on first use.
+  """
+  global _default_client
+  with _default_client_lock:
+    if _default_client is None:
+      _default_client = AppBoyClient()
+    return _default_client
+
+
+@contextlib.contextmanager
+def push_client(client, max_in_flight):
+  """Gets a client whose pool holds a connection per concurrent request.
+
+  The pool blocks once exhausted, so a client pooling fewer connections than
+  max_in_flight would silently cap the concurrency of a push run.
+
+  Args:
+    client: AppBoyClient The client given to the push run, or None.
+    max_in_flight: int The max number of requests sent concurrently.
+
+  Yields:
+    The given client, else the shared client if its pool is large enough, else
+    a client sized for the run, closed once the run is done.
+
+  Raises:
+    ValueError: If the given client pools fewer than max_in_flight connections.
+  """
+  if client is not None:
+    if client.pool_size < max_in_flight:
+      raise ValueError('The client pools %d connections for %d requests in '
+                       'flight.' % (client.pool_size, max_in_flight))
+    yield client
+  elif max_in_flight <= DEFAULT_POOL_SIZE:
+    yield get_default_client()
+  else:
+    client = AppBoyClient(pool_size=max_in_flight)
+    try:
+      yield client
+    finally:
+      client.close()
+
+
+def get_users_response_object(request_url, app_group_id, client=None):
   """Gets the json response for a given api request.
 
   Args:
     request_url: string The request API endpoint.
     app_group_id: string App Group Identifier.    
+    client: AppBoyClient The client to send the request with. Defaults to the
+      shared client.
 
   Returns:
     A dictionary of the JSON response.
-  """
-  # Define the content type as a dictionary
-  headers_params = {'Content-Type':'application/json'}
 
+  Raises:
+    AppBoyError: If the response status is not 200.
+  """
+  client = client or get_default_client()
 
   # Store the request data as a dictionary
   data = {'app_group_id': app_group_id}
 
   # Do the HTTP get request
-  response = requests.get(request_url, data=data, headers=headers_params)
+  response = client.get(request_url, data)
 
-  # Check for HTTP codes other than 200
+  # Check for HTTP codes other than 200. Syncs run in pool processes, so the
+  # failure is raised for the shard to record instead of exiting.
   if response.status_code != 200:
-      print('Status:', response.status_code, 'Problem with the request. Exiting.')
-      exit()
+      raise AppBoyError(response)
 
   # Decode the JSON response into a dictionary and return the data
-  data = response.json()
+  with metrics.timer('appboy_decode_seconds'):
+    data = response.json()
 
   # Return the data
   return data
 
 
 
-def get_users_attributes(request_url, app_group_id):
+def get_users_attributes(request_url, app_group_id, client=None):
   """Gets the Attribute objects of all the existing users in a list.
 
   Args:
     request_url: string The request API endpoint.
     app_group_id: string App Group Identifier.    
+    client: AppBoyClient The client to send the request with.
 
   Returns:
     A list of dictionaries with all the users Attribute objects.
   """  
 
   # Decode the JSON response into a dictionary and use the data
-  data = get_users_response_object(request_url, app_group_id)
+  data = get_users_response_object(request_url, app_group_id, client)
 
   # Return list of all the users attributes and values
   return data['attributes']
 
-def get_users_events(request_url, app_group_id):
+def get_users_events(request_url, app_group_id, client=None):
   """Gets the Event objects of all the existing users in a list.
 
   Args:
     request_url: string The request API endpoint.
     app_group_id: string App Group Identifier.    
+    client: AppBoyClient The client to send the request with.
 
   Returns:
     A list of dictionaries with all the users Event objects.
   """  
 
   # Decode the JSON response into a dictionary and use the data
-  data = get_users_response_object(request_url, app_group_id)
+  data = get_users_response_object(request_url, app_group_id, client)
 
   # Return list of all the users attributes and values
   return data['events']
 
-def update_user(request_url, app_group_id, data):
+def download_users_export(request_url, app_group_id, path, client=None):
+  """Saves the JSON response of the users export to a file.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    path: str The path of the file to write.
+    client: AppBoyClient The client to send the request with. Defaults to the
+      shared client.
+
+  Raises:
+    AppBoyError: If the response status is not 200.
+  """
+  client = client or get_default_client()
+  response = client.get(request_url, {'app_group_id': app_group_id})
+  if response.status_code != 200:
+    raise AppBoyError(response)
+  with open(path, 'wb') as export:
+    export.write(response.content)
+
+def load_users_export(path):
+  """Reads a users export saved by download_users_export.
+
+  Args:
+    path: str The path of the export file.
+
+  Returns:
+    A dictionary of the JSON response.
+  """
+  with open(path, 'rb') as export:
+    with metrics.timer('appboy_decode_seconds'):
+      return json.load(export)
+
+def pack_zipcode(zipcode):
+  """Packs a five digit zip code into an int; other values are kept as is."""
+  if isinstance(zipcode, basestring) and len(zipcode) == 5 and zipcode.isdigit():
+    return int(zipcode)
+  return zipcode
+
+
+def unpack_zipcode(zipcode):
+  """Turns a zip code packed by pack_zipcode back into a string."""
+  if isinstance(zipcode, (int, long)):
+    return '%05d' % zipcode
+  return zipcode
+
+
+class UserRecord(object):
+  """A user Attribute object held in slots instead of a dictionary.
+
+  The record is read and updated like the dictionary it stands for, and is only
+  turned into one by to_object when its batch is sent. Five digit zip codes are
+  packed into an int, and fields other than the appboy.user columns go into a
+  dictionary that is only created when such a field is set.
+
+  Args:
+    row: tuple The values of USER_ATTRIBUTE_COLUMNS, in order.
+  """
+
+  __slots__ = USER_RECORD_FIELDS + ('extra',)
+
+  def __init__(self, row):
+    self.extra = None
+    for field, value in zip(USER_RECORD_FIELDS, row):
+      self[field] = value
+
+  def __getitem__(self, field):
+    if field in USER_RECORD_FIELD_SET:
+      value = getattr(self, field)
+      if field == 'user_zipcode':
+        value = unpack_zipcode(value)
+      return value
+    if self.extra is not None and field in self.extra:
+      return self.extra[field]
+    raise KeyError(field)
+
+  def __setitem__(self, field, value):
+    if field in USER_RECORD_FIELD_SET:
+      if field == 'user_zipcode':
+        value = pack_zipcode(value)
+      setattr(self, field, value)
+    else:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[field] = value
+
+  def __contains__(self, field):
+    return (field in USER_RECORD_FIELD_SET or
+            (self.extra is not None and field in self.extra))
+
+  def get(self, field, default=None):
+    try:
+      return self[field]
+    except KeyError:
+      return default
+
+  def iteritems(self):
+    for field in USER_RECORD_FIELDS:
+      yield field, self[field]
+    if self.extra is not None:
+      for item in self.extra.iteritems():
+        yield item
+
+  def to_object(self):
+    """Gets the Attribute object as a dictionary."""
+    return dict(self.iteritems())
+
+
+class InternTable(object):
+  """Maps repeated strings to small ints so each is stored only once."""
+
+  def __init__(self):
+    self.values = []
+    self.indexes = {}
+
+  def intern(self, value):
+    """Gets the index of a value, adding it to the table if it is new."""
+    index = self.indexes.get(value)
+    if index is None:
+      index = self.indexes[value] = len(self.values)
+      self.values.append(value)
+    return index
+
+  def __len__(self):
+    return len(self.values)
+
+
+def format_time(epoch):
+  """Formats an epoch timestamp as an ISO-8601 UTC time."""
+  return time.strftime(ISO_8601_FORMAT, time.gmtime(epoch))
+
+
+class EventColumns(object):
+  """Event objects stored column by column in typed arrays.
+
+  Each event takes an index into the external id table, an index into the event
+  name table and an int64 epoch timestamp, instead of a dictionary and its
+  strings. The name table can be shared between pages, since the same few event
+  names repeat across the whole table.
+
+  Args:
+    names: InternTable The event name table. Defaults to a new table.
+  """
+
+  def __init__(self, names=None):
+    self.names = names if names is not None else InternTable()
+    self.external_ids = InternTable()
+    self.user_indexes = array.array('I')
+    self.name_indexes = array.array('I')
+    self.times = array.array(INT64_TYPECODE)
+
+  def append(self, external_id, name, epoch):
+    """Adds an event.
+
+    Args:
+      external_id: str The external id of the user.
+      name: str The name of the event.
+      epoch: int The time of the event, in seconds since the epoch, or None
+        if it has none.
+    """
+    self.user_indexes.append(self.external_ids.intern(external_id))
+    self.name_indexes.append(self.names.intern(name))
+    self.times.append(NO_TIME if epoch is None else epoch)
+
+  def __len__(self):
+    return len(self.times)
+
+  def to_object(self, index, overrides=None):
+    """Gets an event as an Event object.
+
+    Args:
+      index: int The position of the event.
+      overrides: dict Fields to set on the Event object.
+
+    Returns:
+      The Event object as a dictionary.
+    """
+    epoch = self.times[index]
+    event = {
+        'external_id': self.external_ids.values[self.user_indexes[index]],
+        'name': self.names.values[self.name_indexes[index]],
+        'time': format_time(epoch) if epoch != NO_TIME else None,
+    }
+    if overrides:
+      event.update(overrides)
+    return event
+
+  def batches(self, size=BATCH_SIZE, overrides=None):
+    """Splits the events into lazily serialised batches.
+
+    Args:
+      size: int The max number of events per batch.
+      overrides: dict Fields to set on every Event object.
+
+    Yields:
+      EventBatch objects.
+    """
+    for start in xrange(0, len(self), size):
+      yield EventBatch(self, start, min(start + size, len(self)), overrides)
+
+
+class EventBatch(object):
+  """A slice of EventColumns, turned into Event objects only when sent."""
+
+  __slots__ = ('columns', 'start', 'stop', 'overrides')
+
+  def __init__(self, columns, start, stop, overrides=None):
+    self.columns = columns
+    self.start = start
+    self.stop = stop
+    self.overrides = overrides
+
+  def __len__(self):
+    return self.stop - self.start
+
+  def to_objects(self):
+    """Gets the Event objects of the batch as a list of dictionaries."""
+    return [self.columns.to_object(index, self.overrides)
+            for index in xrange(self.start, self.stop)]
+
+
+def remember(index, key, value, limit):
+  """Sets a key of an LRU OrderedDict, evicting its oldest key past limit."""
+  index[key] = value
+  if len(index) > limit:
+    index.popitem(last=False)
+
+
+class EventDeduper(object):
+  """Drops duplicate and repeated events from a stream of events.
+
+  An event whose user_events_id was already seen is a duplicate. An event with
+  the user and name of an event kept less than window seconds before or after
+  it is coalesced into that event, so a burst of identical events is sent as
+  its first event. Both indexes are LRUs of bounded size: forgetting an entry
+  can only let an extra event through, never drop a distinct one.
+
+  Args:
+    window: int Seconds within which a user's events of one name are
+      coalesced, or 0 to only drop duplicates.
+    max_ids: int The max number of event ids remembered.
+    max_keys: int The max number of (user, event name) pairs remembered.
+  """
+
+  def __init__(self, window=DEFAULT_COALESCE_WINDOW, max_ids=DEDUP_MAX_IDS,
+               max_keys=DEDUP_MAX_KEYS):
+    self.window = window
+    self.max_ids = max_ids
+    self.max_keys = max_keys
+    self.ids = collections.OrderedDict()
+    self.kept_times = collections.OrderedDict()
+    self.kept = 0
+    self.duplicates = 0
+    self.coalesced = 0
+
+  def keep(self, event_id, external_id, name, epoch):
+    """Tells whether an event is to be sent, remembering it if so.
+
+    Args:
+      event_id: int The user_events_id of the event, or None if it has none.
+      external_id: str The external id of the user.
+      name: str The name of the event.
+      epoch: int The time of the event, in seconds since the epoch, or None if
+        it has none; such an event is never coalesced.
+
+    Returns:
+      True if the event is to be sent.
+    """
+    if event_id is not None:
+      if event_id in self.ids:
+        self.duplicates += 1
+        return False
+      remember(self.ids, event_id, None, self.max_ids)
+    if self.window and epoch is not None:
+      key = (external_id, name)
+      # Popping and setting the pair again marks it as recently used.
+      kept_time = self.kept_times.pop(key, None)
+      if kept_time is not None and abs(epoch - kept_time) < self.window:
+        self.kept_times[key] = kept_time
+        self.coalesced += 1
+        return False
+      remember(self.kept_times, key, epoch, self.max_keys)
+    self.kept += 1
+    return True
+
+  def stats(self):
+    """Gets the number of events kept and dropped.
+
+    Returns:
+      A dictionary of the number of events 'kept', and of 'duplicates' and
+      'coalesced' events dropped.
+    """
+    return {'kept': self.kept, 'duplicates': self.duplicates,
+            'coalesced': self.coalesced}
+
+
+def update_user(request_url, app_group_id, data, client=None):
   """Updates the user data.
 
   Args:
     request_url: string The request API endpoint.
     app_group_id: string App Group Identifier.    
+    data: dict The /users/track payload.
+    client: AppBoyClient The client to send the request with. Defaults to the
+      shared client.
 
   Returns:
     A the JSON response of the put request.
-  """
-  # Define the content type as a dictionary
-  headers_params = {'Content-Type':'application/json'}
 
+  Raises:
+    AppBoyError: If the response status is not 200.
+  """
+  client = client or get_default_client()
 
   # Store the request data as a dictionary
   data['app_group_id']=app_group_id
 
-  # Do the HTTP get request
-  response = requests.post(request_url, data=data, headers=headers_params)
+  for field in OBJECT_FIELDS:
+    if field in data:
+      metrics.observe('appboy_batch_objects', len(data[field]),
+                      buckets=ApiMetrics.SIZE_BUCKETS, field=field)
 
-  # Check for HTTP codes other than 200
+  # Do the HTTP post request
+  with metrics.timer('appboy_update_user_seconds'):
+    response = client.post(request_url, data)
+
+  # Check for HTTP codes other than 200. Batches run on worker threads, so the
+  # failure is raised for the push loop to record instead of exiting.
   if response.status_code != 200:
-      print('Status:', response.status_code, 'Problem with the request. Exiting.')
-      exit()  
+      raise AppBoyError(response)
 
   # Return the response 
   return response
 
 
-def update_attribute_data(request_url, app_group_id, field, value):
-  """Updates an existing user Attribute object field with the given value.
+def shard_of(external_id, count):
+  """Gets the shard a user belongs to.
+
+  The shard is taken from a CRC32 of the external id, so it is the same in
+  every process and every run, unlike the salted built-in hash.
 
   Args:
-    request_url: string The request API endpoint.
-    app_group_id: string App Group Identifier.  
-    field: str The user data attribute field to be updated.
-    value: The new value to be updated.
+    external_id: str The external id of the user.
+    count: int The number of shards.
+
+  Returns:
+    The shard index, from 0 to count - 1.
   """
-  
-  attributes = get_users_attributes(request_url, app_group_id)
-  data = []
-  for user in attributes:    
-    user[field]=value
-    data.append(user)
-      
-  # The max of user objects per API call is 50 so split the data array into event chunks of 50
-  for i in xrange(0, len(data), 50):
-    yield data[i:i+n]
-    update = { 'attributes': data }
-    res = update_user(request_url, app_group_id, update)
-    print res.text
-    print res.status_code
-
-def update_event_data(request_url, app_group_id, field, value):
-  """Updates an existing user Event object field with the given value.
+  if external_id is None:
+    return 0
+  if isinstance(external_id, unicode):
+    external_id = external_id.encode('utf-8')
+  return (zlib.crc32(external_id) & 0xffffffff) % count
+
+
+def in_shard(objects, shard):
+  """Keeps the objects of the users in a shard.
 
   Args:
-    request_url: string The request API endpoint.
-    app_group_id: string App Group Identifier.  
-    field: str The user data Event object field to be updated.
-    value: The new value to be updated.
+    objects: iterable Dictionaries of user Attribute or Event objects.
+    shard: tuple The (index, count) of the shard, or None to keep every object.
+
+  Yields:
+    The objects of the users in the shard.
   """
-  
-  events = get_users_events(request_url, app_group_id)
-  data = []
-  for user in events:    
-    user[field]=value
-    data.append(user)
-  
-  # The max of user objects per API call is 50 so split the data array into event chunks of 50
-  for i in xrange(0, len(data), 50):
-    yield data[i:i+n]
-    update = { 'events': data }
-    res = update_user_attributes(request_url, app_group_id, update)
-    print res.text
-    print res.status_code
+  if shard is None:
+    for obj in objects:
+      yield obj
+    return
+  index, count = shard
+  for obj in objects:
+    if shard_of(obj.get('external_id'), count) == index:
+      yield obj
+
+
+def shard_condition(column, shard):
+  """Builds the SQL condition selecting the users of a shard.
+
+  Args:
+    column: str The column holding the user external id.
+    shard: tuple The (index, count) of the shard, or None for every user.
+
+  Returns:
+    A (sql, params) tuple, to be appended to a WHERE clause.
+  """
+  if shard is None:
+    return '', ()
+  index, count = shard
+  return ' AND shard_of(%s, ?) = ?' % column, (count, index)
+
+
+def connect_source(path):
+  """Opens the SQLite stand-in for the appboy tables.
+
+  The database file is attached as the appboy schema, so queries name the
+  tables appboy.user and appboy.user_events like the tables they stand in for.
+  The shard_of function is registered for the queries of sharded syncs.
+
+  Args:
+    path: str The path of the SQLite database file.
+
+  Returns:
+    A sqlite3 connection.
+  """
+  connection = sqlite3.connect(':memory:')
+  connection.execute('ATTACH DATABASE ? AS appboy', (path,))
+  connection.create_function('shard_of', 2, shard_of)
+  return connection
+
+
+def create_source_tables(connection):
+  """Creates the appboy tables if they do not exist yet.
+
+  Args:
+    connection: The connection returned by connect_source.
+  """
+  connection.executescript(SOURCE_SCHEMA)
+
+
+def iter_rows(connection, query, params=(), page_size=SOURCE_PAGE_SIZE):
+  """Reads the rows of a query one cursor page at a time.
+
+  SQLite steps through the result as pages are fetched, so only one page of
+  rows is held in memory and the first rows are available before the query has
+  been read to the end.
+
+  Args:
+    connection: The connection returned by connect_source.
+    query: str The SQL query.
+    params: tuple The query parameters.
+    page_size: int The number of rows fetched per page.
+
+  Yields:
+    The rows, as tuples.
+  """
+  cursor = connection.cursor()
+  cursor.arraysize = page_size
+  try:
+    cursor.execute(query, params)
+    while True:
+      with metrics.timer('appboy_source_fetch_seconds'):
+        rows = cursor.fetchmany()
+      if not rows:
+        return
+      for row in rows:
+        yield row
+  finally:
+    cursor.close()
+
+
+def iter_user_attributes(connection, app_group_id, page_size=SOURCE_PAGE_SIZE,
+                         shard=None):
+  """Streams the Attribute objects of the users in appboy.user.
+
+  Args:
+    connection: The connection returned by connect_source.
+    app_group_id: string App Group Identifier.
+    page_size: int The number of rows fetched per page.
+    shard: tuple The (index, count) of the shard to read, or None for every
+      user.
+
+  Yields:
+    A UserRecord per user with its Attribute object.
+  """
+  columns = [column for column, _ in USER_ATTRIBUTE_COLUMNS]
+  condition, shard_params = shard_condition('user_external_id', shard)
+  query = ('SELECT %s FROM appboy.user WHERE app_group_id = ?%s ORDER BY rowid'
+           % (', '.join(columns), condition))
+  params = (app_group_id,) + shard_params
+  for row in iter_rows(connection, query, params, page_size):
+    yield UserRecord(row)
+
+
+def iter_changed_user_attributes(connection, app_group_id, watermark=None,
+                                 page_size=SOURCE_PAGE_SIZE, shard=None):
+  """Streams the Attribute objects of the users changed after a watermark.
+
+  Users are read in (last_modified_at, user_external_id) order, so every user
+  before the last one of an acknowledged batch has been pushed, including
+  users sharing its last_modified_at.
+
+  Args:
+    connection: The connection returned by connect_source.
+    app_group_id: string App Group Identifier.
+    watermark: tuple The (last_modified_at, user_external_id) of the last user
+      pushed, or None to read every user.
+    page_size: int The number of rows fetched per page.
+    shard: tuple The (index, count) of the shard to read, or None for every
+      user.
+
+  Yields:
+    A UserRecord per user with its Attribute object.
+  """
+  last_modified_at, external_id = watermark or ('', '')
+  columns = [column for column, _ in USER_ATTRIBUTE_COLUMNS]
+  condition, shard_params = shard_condition('user_external_id', shard)
+  query = ('SELECT %s FROM appboy.user WHERE app_group_id = ?%s '
+           'AND (COALESCE(last_modified_at, \'\') > ? '
+           'OR (COALESCE(last_modified_at, \'\') = ? AND user_external_id > ?)) '
+           'ORDER BY COALESCE(last_modified_at, \'\'), user_external_id'
+           % (', '.join(columns), condition))
+  params = ((app_group_id,) + shard_params +
+            (last_modified_at, last_modified_at, external_id))
+  for row in iter_rows(connection, query, params, page_size):
+    yield UserRecord(row)
+
+
+def iter_event_columns(connection, app_group_id, page_size=SOURCE_PAGE_SIZE,
+                       shard=None, dedup=None, require_time=True):
+  """Streams the events in appboy.user_events as EventColumns pages.
+
+  The event times are converted to epoch seconds by SQLite, and no dictionary is
+  built per event; the pages share one event name table. Events without a
+  time, or with one SQLite cannot read, are skipped and counted in the
+  appboy_events_skipped_total metric, since an Event object needs a time,
+  unless the caller sets the time of every event.
+
+  Args:
+    connection: The connection returned by connect_source.
+    app_group_id: string App Group Identifier.
+    page_size: int The number of rows fetched, and events held, per page.
+    shard: tuple The (index, count) of the shard to read, or None for every
+      user.
+    dedup: EventDeduper The deduper the events are filtered through, if any.
+      The pages then hold only the kept events, so the batches stay full.
+    require_time: bool Whether events without a time are skipped. When False
+      they are kept with a None time, for the caller to set.
+
+  Yields:
+    EventColumns holding up to page_size events each.
+  """
+  condition, shard_params = shard_condition('u.user_external_id', shard)
+  query = ('SELECT e.user_events_id, u.user_external_id, e.name, '
+           'CAST(strftime(\'%%s\', e.time) AS INTEGER) '
+           'FROM appboy.user_events AS e '
+           'JOIN appboy.user AS u ON u.rowid = e.user_id '
+           'WHERE u.app_group_id = ?%s ORDER BY e.user_events_id' % condition)
+  names = InternTable()
+  columns = EventColumns(names)
+  for event_id, external_id, name, epoch in iter_rows(
+      connection, query, (app_group_id,) + shard_params, page_size):
+    if epoch is None and require_time:
+      metrics.counter('appboy_events_skipped_total', reason='no_time')
+      continue
+    if dedup is not None and not dedup.keep(event_id, external_id, name, epoch):
+      continue
+    columns.append(external_id, name, epoch)
+    if len(columns) == page_size:
+      yield columns
+      columns = EventColumns(names)
+  if len(columns):
+    yield columns
+
+
+def iter_users_with_events(connection, app_group_id,
+                           page_size=SOURCE_PAGE_SIZE, shard=None, dedup=None,
+                           require_time=True):
+  """Streams each user of appboy.user with its events, in one joined query.
+
+  The rows of a user and of its events come out together, so the tables are
+  read once and only one user's events are held at a time. Events without a
+  readable time are skipped, as by iter_event_columns, unless the caller sets
+  the time of every event.
+
+  Args:
+    connection: The connection returned by connect_source.
+    app_group_id: string App Group Identifier.
+    page_size: int The number of rows fetched per page.
+    shard: tuple The (index, count) of the shard to read, or None for every
+      user.
+    dedup: EventDeduper The deduper the events are filtered through, if any.
+    require_time: bool Whether events without a time are skipped. When False
+      they are kept with a None time, for the caller to set.
+
+  Yields:
+    (attributes, events) tuples: a UserRecord with the Attribute object of a
+    user, and a list of the user's Event objects.
+  """
+  columns = ['u.%s' % column for column, _ in USER_ATTRIBUTE_COLUMNS]
+  condition, shard_params = shard_condition('u.user_external_id', shard)
+  query = ('SELECT u.rowid, %s, e.user_events_id, e.name, '
+           'CAST(strftime(\'%%s\', e.time) AS INTEGER) '
+           'FROM appboy.user AS u '
+           'LEFT JOIN appboy.user_events AS e ON e.user_id = u.rowid '
+           'WHERE u.app_group_id = ?%s ORDER BY u.rowid, e.user_events_id'
+           % (', '.join(columns), condition))
+  width = len(columns) + 1
+  rows = iter_rows(connection, query, (app_group_id,) + shard_params, page_size)
+  for _, user_rows in itertools.groupby(rows, operator.itemgetter(0)):
+    events = []
+    for row in user_rows:
+      event_id, name, epoch = row[width:]
+      # A user without events comes out once, with no event columns.
+      if event_id is None:
+        continue
+      if epoch is None and require_time:
+        metrics.counter('appboy_events_skipped_total', reason='no_time')
+        continue
+      external_id = row[1]
+      if dedup is not None and not dedup.keep(event_id, external_id, name,
+                                              epoch):
+        continue
+      if epoch is not None:
+        epoch = format_time(epoch)
+      events.append({'external_id': external_id, 'name': name, 'time': epoch})
+    yield UserRecord(row[1:width]), events
+
+
+def is_retryable(error):
+  """Checks whether a failed request is worth sending again.
+
+  Args:
+    error: Exception The error raised while sending the request.
+
+  Returns:
+    True for throttling (429), server errors (5xx), timeouts and dropped
+    connections.
+  """
+  if isinstance(error, AppBoyError):
+    return error.status_code == 429 or error.status_code >= 500
+  return isinstance(error, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout))
+
+
+def get_retry_after(response):
+  """Gets the delay a response asks for in its Retry-After header.
+
+  Args:
+    response: The response object.
+
+  Returns:
+    The delay in seconds, or None if the header is missing or malformed.
+  """
+  value = response.headers.get('Retry-After')
+  if not value:
+    return None
+  if value.strip().isdigit():
+    return float(value)
+  # Otherwise the header holds an HTTP date.
+  parsed = email.utils.parsedate_tz(value)
+  if parsed is None:
+    return None
+  return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def retry_reason(error):
+  """Gets the metric label of a retried error: its status or its type."""
+  if isinstance(error, AppBoyError):
+    return error.status_code
+  return type(error).__name__
+
+
+class TokenBucket(object):
+  """A thread-safe token bucket refilled at a steady rate.
+
+  Args:
+    rate: float The number of tokens added per second.
+    capacity: float The max number of tokens held, i.e. the largest burst.
+  """
+
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.time()
+    self.paused_until = 0.0
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Blocks until a token is available and takes it."""
+    while True:
+      with self.lock:
+        now = time.time()
+        if now < self.paused_until:
+          wait = self.paused_until - now
+        else:
+          self.tokens = min(self.capacity,
+                            self.tokens + (now - self.updated) * self.rate)
+          self.updated = now
+          if self.tokens >= 1:
+            self.tokens -= 1
+            return
+          wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+  def pause(self, seconds):
+    """Holds every caller back and empties the bucket.
+
+    Args:
+      seconds: float How long to hold the callers back.
+    """
+    with self.lock:
+      self.paused_until = max(self.paused_until, time.time() + seconds)
+      self.tokens = 0.0
+      self.updated = self.paused_until
+
+
+class PushScheduler(object):
+  """Paces /users/track requests under the account quota and retries failures.
+
+  Every request takes a token from a bucket refilled at the hourly quota, so
+  the workers together never send faster than the account allows. A throttled
+  (429) or failed (5xx) batch is sent again on its own after the delay given by
+  Retry-After, or after a jittered exponential backoff. A 429 holds back every
+  worker, since the quota is shared.
+
+  Args:
+    requests_per_hour: int The /users/track quota of the account.
+    burst: int The number of requests that may be sent in a burst.
+    max_retries: int The number of times a batch is sent again before its
+      error is raised.
+  """
+
+  def __init__(self, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR,
+               burst=DEFAULT_BURST, max_retries=DEFAULT_MAX_RETRIES):
+    self.bucket = TokenBucket(requests_per_hour / 3600.0, burst)
+    self.max_retries = max_retries
+    self.retries = 0
+    self.lock = threading.Lock()
+
+  def backoff(self, attempt):
+    """Gets a jittered exponential backoff delay.
+
+    Args:
+      attempt: int The number of retries already made.
+
+    Returns:
+      The delay in seconds.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+  def send(self, request_url, app_group_id, data, client=None):
+    """Sends a batch through update_user, retrying it while it is retryable.
+
+    Args:
+      request_url: string The request API endpoint.
+      app_group_id: string App Group Identifier.
+      data: dict The /users/track payload.
+      client: AppBoyClient The client to send the request with.
+
+    Returns:
+      The response object.
+
+    Raises:
+      AppBoyError: If the batch still fails after max_retries retries, or
+        fails with an error that is not retryable.
+    """
+    attempt = 0
+    while True:
+      with metrics.timer('appboy_throttle_wait_seconds'):
+        self.bucket.acquire()
+      try:
+        return update_user(request_url, app_group_id, data, client)
+      except Exception as error:
+        if attempt >= self.max_retries or not is_retryable(error):
+          raise
+
+      delay = None
+      if isinstance(error, AppBoyError):
+        delay = get_retry_after(error.response)
+      if delay is None:
+        delay = self.backoff(attempt)
+      else:
+        # Spread the workers that were told to wait the same time.
+        delay += random.uniform(0, BACKOFF_BASE)
+      if isinstance(error, AppBoyError) and error.status_code == 429:
+        self.bucket.pause(delay)
+
+      with self.lock:
+        self.retries += 1
+      metrics.counter('appboy_retries_total', reason=retry_reason(error))
+      attempt += 1
+      time.sleep(delay)
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+  """Gets the scheduler shared by calls that are not given one.
+
+  Returns:
+    The module wide PushScheduler, created on first use.
+  """
+  global _default_scheduler
+  with _default_scheduler_lock:
+    if _default_scheduler is None:
+      _default_scheduler = PushScheduler()
+    return _default_scheduler
+
+
+def watermark_key(app_group_id, shard=None):
+  """Gets the key of the watermark of an app group or of one of its shards.
+
+  Args:
+    app_group_id: string App Group Identifier.
+    shard: tuple The (index, count) of the shard, or None for every user.
+
+  Returns:
+    The app group id, or for a shard, the app group id and the shard.
+  """
+  if shard is None:
+    return app_group_id
+  return '%s/%d-of-%d' % ((app_group_id,) + tuple(shard))
+
+
+class WatermarkStore(object):
+  """Persists the incremental sync high-water mark of each app group.
+
+  The watermarks live in their own database: committing on the source
+  connection would reset the cursor the users are being streamed from. The
+  shards of a sharded sync each keep their own, under watermark_key.
+
+  Args:
+    path: str The path of the SQLite database file holding the watermarks.
+  """
+
+  def __init__(self, path):
+    self.connection = sqlite3.connect(path)
+    self.connection.execute(WATERMARK_SCHEMA)
+    self.connection.commit()
+
+  def get(self, app_group_id):
+    """Gets the watermark of an app group.
+
+    Args:
+      app_group_id: string App Group Identifier.
+
+    Returns:
+      The (last_modified_at, user_external_id) of the last user pushed, or None
+      if the app group was never synced.
+    """
+    row = self.connection.execute(
+        'SELECT last_modified_at, user_external_id FROM sync_watermark '
+        'WHERE app_group_id = ?', (app_group_id,)).fetchone()
+    return tuple(row) if row else None
+
+  def set(self, app_group_id, watermark):
+    """Moves the watermark of an app group.
+
+    Args:
+      app_group_id: string App Group Identifier.
+      watermark: tuple The (last_modified_at, user_external_id) of the last
+        user pushed.
+    """
+    self.connection.execute(
+        'INSERT OR REPLACE INTO sync_watermark VALUES (?, ?, ?)',
+        (app_group_id,) + tuple(watermark))
+    self.connection.commit()
+
+  def close(self):
+    self.connection.close()
+
+
+def digest_value(value):
+  """Gets a short digest of an Attribute object field value.
+
+  Args:
+    value: The field value.
+
+  Returns:
+    The hex digest of the value's JSON form.
+  """
+  return hashlib.sha1(
+      json.dumps(value, sort_keys=True, default=str)).hexdigest()[:16]
+
+
+class DigestStore(object):
+  """Remembers what was last pushed for each user to skip unchanged fields.
+
+  A digest of every field of the last Attribute object pushed is kept per
+  external_id. Before a user goes into a batch its fields are compared with the
+  stored digests: only the changed fields are sent, and a user with no changes
+  is skipped. The digests of a batch are only stored once it is acknowledged.
+
+  Args:
+    path: str The path of the SQLite database file holding the digests.
+  """
+
+  def __init__(self, path):
+    self.connection = sqlite3.connect(path)
+    self.connection.execute(DIGEST_SCHEMA)
+    self.connection.commit()
+    # Digests of the users in batches that are not acknowledged yet.
+    self.pending = {}
+    self.skipped = 0
+
+  def lookup(self, external_ids):
+    """Gets the stored digests of some users.
+
+    Args:
+      external_ids: list The external ids of the users.
+
+    Returns:
+      A dictionary of the field digests of each user found, by external id.
+    """
+    rows = self.connection.execute(
+        'SELECT external_id, digests FROM pushed_digest WHERE external_id IN '
+        '(%s)' % ', '.join('?' * len(external_ids)), external_ids)
+    return dict((external_id, json.loads(digests))
+                for external_id, digests in rows)
+
+  def diff_objects(self, attributes, keep=('external_id',)):
+    """Reduces Attribute objects to the fields changed since the last push.
+
+    Args:
+      attributes: iterable Dictionaries of user Attribute objects.
+      keep: tuple The fields sent whether they changed or not.
+
+    Yields:
+      The Attribute objects of the changed users, with only their changed
+      fields and the kept ones.
+    """
+    for chunk in chunk_objects(attributes, DIGEST_LOOKUP_SIZE):
+      previous = self.lookup([user['external_id'] for user in chunk])
+      for user in chunk:
+        digests = dict((field, digest_value(value))
+                       for field, value in user.iteritems()
+                       if field != 'external_id')
+        stored = previous.get(user['external_id'], {})
+        changed = dict((field, user[field])
+                       for field, digest in digests.iteritems()
+                       if stored.get(field) != digest)
+        if not changed:
+          self.skipped += 1
+          continue
+        for field in keep:
+          if field in user:
+            changed[field] = user[field]
+        self.pending[user['external_id']] = digests
+        yield changed
+
+  def acknowledge(self, payload):
+    """Stores the digests of the users in an acknowledged payload.
+
+    Args:
+      payload: dict The /users/track payload.
+    """
+    rows = []
+    for user in payload.get('attributes', ()):
+      digests = self.pending.pop(user['external_id'], None)
+      if digests is not None:
+        rows.append((user['external_id'], json.dumps(digests)))
+    self.connection.executemany(
+        'INSERT OR REPLACE INTO pushed_digest VALUES (?, ?)', rows)
+    self.connection.commit()
+
+  def forget(self, payload):
+    """Drops the pending digests of the users in a failed payload.
+
+    Args:
+      payload: dict The /users/track payload.
+    """
+    for user in payload.get('attributes', ()):
+      self.pending.pop(user['external_id'], None)
+
+  def close(self):
+    self.connection.close()
+
+
+class PushSpool(object):
+  """An append-only on-disk log of the batches of a push run.
+
+  Every batch is written to the spool as it is read for sending, and a done
+  record is written once it is acknowledged. If the process dies, the next run
+  on the same spool sends the batches without a done record again, then skips
+  the batches of the source that were already spooled. The source has to yield
+  its batches in the same order, as the table readers do. Once a run has every
+  batch acknowledged the spool is emptied.
+
+  Delivery is at least once: a batch sent before a crash but not yet recorded
+  as done is sent again.
+
+  Args:
+    path: str The path of the spool file.
+    encoder: PayloadEncoder The encoder of the spooled payloads.
+    fsync: bool Whether to sync each batch to disk, to survive a crash of the
+      machine and not only of the process.
+  """
+
+  def __init__(self, path, encoder=None, fsync=False):
+    self.path = path
+    self.encoder = encoder or PayloadEncoder()
+    self.fsync = fsync
+    # Batches of a previous run not acknowledged yet, by sequence number.
+    self.unacknowledged = {}
+    self.written = 0
+    if os.path.exists(path):
+      self.load()
+    self.file = open(path, 'ab')
+    # Sequence numbers of the batches being sent, by payload id.
+    self.sequences = {}
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Reads the batches and done records left by a previous run.
+
+    A last line without its newline was torn by a crash. It is cut off, so the
+    records of this run are not appended to it and lost on the next load.
+    """
+    end = 0
+    with open(self.path, 'rb') as spool:
+      for line in spool:
+        if not line.endswith('\n'):
+          break
+        end += len(line)
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue
+        if 'done' in record:
+          self.unacknowledged.pop(record['done'], None)
+        else:
+          self.unacknowledged[record['seq']] = record['payload']
+          self.written = max(self.written, record['seq'] + 1)
+    if end < os.path.getsize(self.path):
+      with open(self.path, 'r+b') as spool:
+        spool.truncate(end)
+
+  def write(self, record):
+    with self.lock:
+      self.file.write(self.encoder.encode(record) + '\n')
+      self.file.flush()
+      if self.fsync:
+        os.fsync(self.file.fileno())
+
+  def spool(self, payloads):
+    """Spools payloads as they are read, resuming a previous run first.
+
+    Args:
+      payloads: iterable The /users/track payloads of the run, from the start.
+
+    Yields:
+      The unacknowledged payloads of the previous run, then the payloads not
+      spooled yet.
+    """
+    for seq in sorted(self.unacknowledged):
+      payload = self.unacknowledged.pop(seq)
+      self.sequences[id(payload)] = seq
+      yield payload
+    for payload in itertools.islice(payloads, self.written, None):
+      seq = self.written
+      self.written += 1
+      self.write({'seq': seq, 'payload': payload})
+      self.sequences[id(payload)] = seq
+      yield payload
+
+  def acknowledge(self, payload):
+    """Records an acknowledged payload as done.
+
+    Args:
+      payload: dict The /users/track payload.
+    """
+    self.write({'done': self.sequences.pop(id(payload))})
+
+  def forget(self, payload):
+    """Leaves a failed payload in the spool for the next run.
+
+    Args:
+      payload: dict The /users/track payload.
+    """
+    self.sequences.pop(id(payload), None)
+
+  def clear(self):
+    """Empties the spool once every batch of the run is acknowledged."""
+    with self.lock:
+      self.file.seek(0)
+      self.file.truncate()
+    self.written = 0
+
+  def close(self):
+    self.file.close()
+
+
+def chunk_objects(objects, size=BATCH_SIZE):
+  """Splits an iterable of objects into lists of at most size objects.
+
+  Args:
+    objects: iterable The objects to split.
+    size: int The max number of objects per chunk.
+
+  Yields:
+    Lists of objects, in the order they were read.
+  """
+  iterator = iter(objects)
+  while True:
+    chunk = list(itertools.islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def set_field(objects, field, value):
+  """Sets the given field on every object as it is read.
+
+  Args:
+    objects: iterable Dictionaries of user Attribute or Event objects.
+    field: str The field to be updated.
+    value: The new value to be updated.
+
+  Yields:
+    The updated objects.
+  """
+  for obj in objects:
+    obj[field] = value
+    yield obj
+
+
+def take_payload(queues, size):
+  """Takes up to size objects of each type off the queues into a payload."""
+  payload = {}
+  for field, queue in queues.iteritems():
+    if queue:
+      payload[field] = [queue.popleft() for _ in xrange(min(size, len(queue)))]
+  return payload
+
+
+def pack_payloads(groups, size=BATCH_SIZE):
+  """Packs Attribute, Event and Purchase objects into requests as full as allowed.
+
+  Each type has its own queue, and a payload is taken as soon as one queue
+  holds size objects, with up to size objects of every type. The requests are
+  then as few as the fullest type needs, and each queue stays under size
+  objects plus one group. Objects of a type keep their order, but the objects
+  of one group may go out in different requests.
+
+  Args:
+    groups: iterable Dictionaries of lists of objects by OBJECT_FIELDS field,
+      such as the 'attributes' and 'events' of one user.
+    size: int The max number of objects of each type per request.
+
+  Yields:
+    /users/track payloads.
+  """
+  queues = dict((field, collections.deque()) for field in OBJECT_FIELDS)
+  for group in groups:
+    for field, objects in group.iteritems():
+      queues[field].extend(objects)
+    while any(len(queue) >= size for queue in queues.itervalues()):
+      yield take_payload(queues, size)
+  while any(queues.itervalues()):
+    yield take_payload(queues, size)
+
+
+def iter_push_results(send, payloads, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+  """Sends payloads from a bounded pool of worker threads.
+
+  The payloads are read lazily: only max_in_flight * PENDING_PER_WORKER of them
+  are queued, in flight or waiting to be collected at any time, so memory does
+  not grow with the number of payloads. Results are yielded in the order the
+  payloads were read, whatever order the requests complete in.
+
+  Args:
+    send: callable Sends one payload and returns its response.
+    payloads: iterable The payloads to send.
+    max_in_flight: int The max number of requests sent concurrently.
+
+  Yields:
+    (index, payload, response, error) tuples. error is the exception raised by
+    send, in which case response is None.
+  """
+  tasks = Queue.Queue()
+  results = {}
+  collected = threading.Condition()
+
+  def worker():
+    while True:
+      task = tasks.get()
+      if task is None:
+        return
+      index, payload = task
+      try:
+        outcome = (send(payload), None)
+      except Exception as error:
+        outcome = (None, error)
+      with collected:
+        results[index] = outcome
+        collected.notify()
+
+  workers = [threading.Thread(target=worker) for _ in xrange(max_in_flight)]
+  for thread in workers:
+    thread.daemon = True
+    thread.start()
+
+  window = max_in_flight * PENDING_PER_WORKER
+  pending = {}
+  payloads = iter(payloads)
+  exhausted = False
+  submitted = 0
+  index = 0
+  try:
+    while True:
+      # Keep the window full while there are payloads left to read.
+      while not exhausted and submitted - index < window:
+        try:
+          payload = next(payloads)
+        except StopIteration:
+          exhausted = True
+          break
+        pending[submitted] = payload
+        tasks.put((submitted, payload))
+        submitted += 1
+
+      if index == submitted:
+        return
+
+      # Wait for the oldest outstanding payload so results stay in order.
+      with collected:
+        while index not in results:
+          collected.wait()
+        response, error = results.pop(index)
+
+      yield index, pending.pop(index), response, error
+      index += 1
+  finally:
+    for _ in workers:
+      tasks.put(None)
+
+
+def push_payloads(request_url, app_group_id, payloads,
+                  max_in_flight=DEFAULT_MAX_IN_FLIGHT, client=None,
+                  scheduler=None, digests=None, spool=None):
+  """Pushes /users/track payloads concurrently and summarises the run.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    payloads: iterable The /users/track payloads, one per batch.
+    max_in_flight: int The max number of requests sent concurrently.
+    client: AppBoyClient The client to send the requests with. Its pool has to
+      hold at least max_in_flight connections. Defaults to a client sized for
+      the run.
+    scheduler: PushScheduler The scheduler pacing and retrying the requests.
+      Defaults to the shared scheduler.
+    digests: DigestStore The store told which payloads were acknowledged.
+    spool: PushSpool The spool the payloads are written to before being sent,
+      to resume the run after a crash.
+
+  Returns:
+    A dictionary with the number of 'batches' read, the number 'sent' and a
+    list of (index, error) tuples for the 'failed' ones.
+
+  Raises:
+    ValueError: If the client pools fewer than max_in_flight connections.
+  """
+  scheduler = scheduler or get_default_scheduler()
+  stores = [store for store in (digests, spool) if store is not None]
+  if spool is not None:
+    payloads = spool.spool(payloads)
+
+  summary = {'batches': 0, 'sent': 0, 'failed': []}
+  with push_client(client, max_in_flight) as client:
+
+    def send(payload):
+      return scheduler.send(request_url, app_group_id, payload, client)
+
+    for index, payload, response, error in iter_push_results(
+        send, payloads, max_in_flight):
+      summary['batches'] += 1
+      if error is None:
+        summary['sent'] += 1
+        for store in stores:
+          store.acknowledge(payload)
+      else:
+        summary['failed'].append((index, error))
+        for store in stores:
+          store.forget(payload)
+  if spool is not None and not summary['failed']:
+    spool.clear()
+  return summary
+
+
+def print_push_summary(summary):
+  """Prints the summary returned by push_payloads.
+
+  Args:
+    summary: dict The summary of a push run.
+  """
+  print 'Sent %d of %d batches.' % (summary['sent'], summary['batches'])
+  for index, error in summary['failed']:
+    print 'Batch %d failed: %s' % (index, error)
+
+
+def update_attribute_data(request_url, app_group_id, field, value,
+                          max_in_flight=DEFAULT_MAX_IN_FLIGHT, client=None,
+                          connection=None, scheduler=None, digests=None,
+                          shard=None, export=None):
+  """Updates an existing user Attribute object field with the given value.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.  
+    field: str The user data attribute field to be updated.
+    value: The new value to be updated.
+    max_in_flight: int The max number of requests sent concurrently.
+    client: AppBoyClient The client to send the requests with.
+    connection: The connection returned by connect_source, to read the objects
+      from the appboy tables instead of the API.
+    scheduler: PushScheduler The scheduler pacing and retrying the requests.
+    digests: DigestStore The store used to send only the changed fields.
+    shard: tuple The (index, count) of the shard of users to update, or None
+      for every user.
+    export: dict The users export already fetched from the API, if any.
+
+  Returns:
+    The summary of the push run, with the number of 'unchanged' users skipped
+    by the digests if any were given.
+  """
+  
+  # Stream the objects from the tables when given a source, else from the API.
+  if connection is not None:
+    attributes = iter_user_attributes(connection, app_group_id, shard=shard)
+  elif export is not None:
+    attributes = in_shard(export['attributes'], shard)
+  else:
+    attributes = in_shard(
+        get_users_attributes(request_url, app_group_id, client), shard)
+  # Diff before the field is set, since a run-stamped value would make every
+  # user look changed; the field is still sent with every changed user.
+  if digests is not None:
+    attributes = digests.diff_objects(attributes)
+  attributes = set_field(attributes, field, value)
+      
+  # The max of user objects per API call is 50 so split the data into chunks of 50
+  payloads = ({'attributes': chunk} for chunk in chunk_objects(attributes))
+  summary = push_payloads(request_url, app_group_id, payloads, max_in_flight,
+                          client, scheduler, digests)
+  print_push_summary(summary)
+  if digests is not None:
+    summary['unchanged'] = digests.skipped
+  return summary
+
+def update_event_data(request_url, app_group_id, field, value,
+                      max_in_flight=DEFAULT_MAX_IN_FLIGHT, client=None,
+                      connection=None, scheduler=None, shard=None, spool=None,
+                      dedup=None, export=None):
+  """Updates an existing user Event object field with the given value.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.  
+    field: str The user data Event object field to be updated.
+    value: The new value to be updated.
+    max_in_flight: int The max number of requests sent concurrently.
+    client: AppBoyClient The client to send the requests with.
+    connection: The connection returned by connect_source, to read the objects
+      from the appboy tables instead of the API.
+    scheduler: PushScheduler The scheduler pacing and retrying the requests.
+    shard: tuple The (index, count) of the shard of users to update, or None
+      for every user.
+    spool: PushSpool The spool used to resume the run after a crash.
+    dedup: EventDeduper The deduper dropping duplicate and repeated events
+      read from the tables, if any.
+    export: dict The users export already fetched from the API, if any.
+
+  Returns:
+    The summary of the push run, with the 'dedup' stats of the deduper if one
+    was given.
+  """
+  
+  # Stream the events from the tables when given a source, else from the API.
+  # The table events stay in columns until each batch is sent.
+  if connection is not None:
+    payloads = ({'events': batch}
+                for columns in iter_event_columns(
+                    connection, app_group_id, shard=shard, dedup=dedup,
+                    require_time=field != 'time')
+                for batch in columns.batches(BATCH_SIZE, {field: value}))
+  else:
+    if export is not None:
+      events = in_shard(export['events'], shard)
+    else:
+      events = in_shard(
+          get_users_events(request_url, app_group_id, client), shard)
+  
+    # The max of user objects per API call is 50 so split the data into chunks of 50
+    payloads = ({'events': chunk}
+                for chunk in chunk_objects(set_field(events, field, value)))
+  summary = push_payloads(request_url, app_group_id, payloads, max_in_flight,
+                          client, scheduler, spool=spool)
+  print_push_summary(summary)
+  if dedup is not None:
+    summary['dedup'] = dedup.stats()
+    print 'Dropped %d duplicate and %d coalesced events.' % (
+        dedup.duplicates, dedup.coalesced)
+  return summary
+
+
+def update_user_data(request_url, app_group_id, connection,
+                     attribute_fields=None, event_fields=None,
+                     max_in_flight=DEFAULT_MAX_IN_FLIGHT, client=None,
+                     scheduler=None, shard=None, dedup=None, spool=None,
+                     digests=None):
+  """Updates the Attribute and Event objects of every user in one pass.
+
+  appboy.user is read joined with appboy.user_events, and each request carries
+  up to BATCH_SIZE objects of each type, instead of one pass and one set of
+  half-empty requests per type.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    connection: The connection returned by connect_source.
+    attribute_fields: dict Fields to set on every Attribute object.
+    event_fields: dict Fields to set on every Event object.
+    max_in_flight: int The max number of requests sent concurrently.
+    client: AppBoyClient The client to send the requests with.
+    scheduler: PushScheduler The scheduler pacing and retrying the requests.
+    shard: tuple The (index, count) of the shard of users to update, or None
+      for every user.
+    dedup: EventDeduper The deduper dropping duplicate and repeated events,
+      if any.
+    spool: PushSpool The spool used to resume the run after a crash. The
+      joined query reads the users in rowid order, so the payloads come out
+      in the same order on every run.
+    digests: DigestStore The store used to send only the changed attribute
+      fields. The attributes are compared before attribute_fields are set,
+      and a user with no changed field is sent without its Attribute object.
+      Skipping users changes the payloads from one run to the next, so it
+      cannot be used with a spool.
+
+  Returns:
+    The summary of the push run, with the 'dedup' stats of the deduper and the
+    number of 'unchanged' users skipped by the digests, if given.
+
+  Raises:
+    ValueError: If both a spool and digests are given.
+  """
+  if spool is not None and digests is not None:
+    raise ValueError('A spool cannot resume a run that skips unchanged users.')
+
+  def groups():
+    users = iter_users_with_events(
+        connection, app_group_id, shard=shard, dedup=dedup,
+        require_time='time' not in (event_fields or {}))
+    for chunk in chunk_objects(users, DIGEST_LOOKUP_SIZE):
+      changed = None
+      if digests is not None:
+        changed = dict((user['external_id'], user) for user in
+                       digests.diff_objects(user for user, _ in chunk))
+      for attributes, events in chunk:
+        if changed is not None:
+          attributes = changed.get(attributes['external_id'])
+        if attributes is not None:
+          for field, value in (attribute_fields or {}).iteritems():
+            attributes[field] = value
+        if event_fields:
+          for event in events:
+            event.update(event_fields)
+        yield {'attributes': [attributes] if attributes is not None else [],
+               'events': events}
+
+  summary = push_payloads(request_url, app_group_id, pack_payloads(groups()),
+                          max_in_flight, client, scheduler, digests, spool)
+  print_push_summary(summary)
+  if digests is not None:
+    summary['unchanged'] = digests.skipped
+  if dedup is not None:
+    summary['dedup'] = dedup.stats()
+    print 'Dropped %d duplicate and %d coalesced events.' % (
+        dedup.duplicates, dedup.coalesced)
+  return summary
+
+
+def sync_user_attributes(request_url, app_group_id, connection, watermarks,
+                         max_in_flight=DEFAULT_MAX_IN_FLIGHT, client=None,
+                         scheduler=None, digests=None, shard=None):
+  """Pushes the users changed since the last sync and moves the watermark.
+
+  The watermark only moves past a batch once it and every batch before it have
+  been acknowledged. After a failure the remaining batches are still sent, and
+  the next run picks up again from the first unacknowledged one.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    connection: The connection returned by connect_source.
+    watermarks: WatermarkStore The store holding the app group watermark.
+    max_in_flight: int The max number of requests sent concurrently.
+    client: AppBoyClient The client to send the requests with.
+    scheduler: PushScheduler The scheduler pacing and retrying the requests.
+    digests: DigestStore The store used to send only the changed fields.
+    shard: tuple The (index, count) of the shard of users to sync, or None for
+      every user. Each shard moves its own watermark.
+
+  Returns:
+    The summary of the push run.
+  """
+  scheduler = scheduler or get_default_scheduler()
+  key = watermark_key(app_group_id, shard)
+
+  attributes = iter_changed_user_attributes(
+      connection, app_group_id, watermarks.get(key), shard=shard)
+  if digests is not None:
+    # Keep the watermark fields on every user sent.
+    attributes = digests.diff_objects(
+        attributes, keep=('external_id', 'last_modified_at'))
+  payloads = ({'attributes': chunk} for chunk in chunk_objects(attributes))
+
+  summary = {'batches': 0, 'sent': 0, 'failed': []}
+  with push_client(client, max_in_flight) as client:
+
+    def send(payload):
+      return scheduler.send(request_url, app_group_id, payload, client)
+
+    for index, payload, response, error in iter_push_results(
+        send, payloads, max_in_flight):
+      summary['batches'] += 1
+      if error is not None:
+        summary['failed'].append((index, error))
+        if digests is not None:
+          digests.forget(payload)
+        continue
+      summary['sent'] += 1
+      if digests is not None:
+        digests.acknowledge(payload)
+      if not summary['failed']:
+        last = payload['attributes'][-1]
+        watermarks.set(key,
+                       (last['last_modified_at'] or '', last['external_id']))
+
+  print_push_summary(summary)
+  return summary
+
+
+class SyncShard(object):
+  """A slice of an app group's users, synced by one process.
+
+  Args:
+    app_group_id: string App Group Identifier.
+    index: int The index of the shard.
+    count: int The number of shards the app group is split into.
+    requests_per_hour: int The share of the app group quota given to the shard.
+  """
+
+  def __init__(self, app_group_id, index=0, count=1,
+               requests_per_hour=DEFAULT_REQUESTS_PER_HOUR):
+    self.app_group_id = app_group_id
+    self.index = index
+    self.count = count
+    self.requests_per_hour = requests_per_hour
+
+  @property
+  def shard(self):
+    """The (index, count) of the shard, or None if the group is not split."""
+    if self.count == 1:
+      return None
+    return (self.index, self.count)
+
+  def __str__(self):
+    return '%s [%d/%d]' % (self.app_group_id, self.index + 1, self.count)
+
+  @property
+  def spool_name(self):
+    """The name of the spool file of the shard."""
+    return '%s-%d-of-%d.spool' % (self.app_group_id, self.index, self.count)
+
+
+def plan_shards(app_group_ids, shards_per_group=1,
+                requests_per_hour=DEFAULT_REQUESTS_PER_HOUR):
+  """Splits app groups into shards, sharing each group's quota between them.
+
+  Args:
+    app_group_ids: list The App Group Identifiers.
+    shards_per_group: int The number of shards each app group is split into,
+      by external_id hash.
+    requests_per_hour: int The /users/track quota of each app group.
+
+  Returns:
+    A list of SyncShard objects.
+  """
+  return [SyncShard(app_group_id, index, shards_per_group,
+                    requests_per_hour // shards_per_group)
+          for app_group_id in app_group_ids
+          for index in xrange(shards_per_group)]
+
+
+def summarize_errors(summary):
+  """Replaces the errors of a push summary with their messages.
+
+  The summaries are sent back from the shard processes, and an AppBoyError
+  holding its response does not pickle reliably.
+
+  Args:
+    summary: dict The summary of a push run.
+
+  Returns:
+    The summary, with (index, message) tuples as its 'failed' list.
+  """
+  summary['failed'] = [(index, str(error)) for index, error in summary['failed']]
+  return summary
+
+
+def new_shard_stats(shard, error=None):
+  """Builds the stats of a shard before it is run.
+
+  Args:
+    shard: SyncShard The shard.
+    error: str The error that stopped the shard, if any.
+
+  Returns:
+    The stats dictionary described by run_sync_shard.
+  """
+  return {'shard': str(shard), 'attributes': None, 'events': None,
+          'users': None, 'elapsed': 0.0, 'error': error, 'metrics': None}
+
+
+def run_sync_shard(job):
+  """Syncs one shard with its own connections and rate-limit budget.
+
+  Runs in a pool process, so it is a module-level function taking a single,
+  picklable argument.
+
+  Args:
+    job: tuple The (request_url, shard, source_path, max_in_flight, now,
+      coalesce_window, export_path, spool_dir, watermark_path) of the run;
+      source_path is None to read the objects from the API, coalesce_window
+      None to send every event, export_path the users export saved by the
+      parent process, or None for the shard to fetch it, spool_dir the
+      directory of the shard spools, or None not to spool, watermark_path the
+      WatermarkStore of an incremental sync, or None to push every user, and
+      digest_path the DigestStore used to skip unchanged attributes, or None.
+
+  Returns:
+    A dictionary with the 'shard', its push summaries, the 'elapsed' seconds,
+    the 'error' that stopped it, if any, and the snapshot of the 'metrics' it
+    recorded. A shard read from the tables has one 'users' summary, or one
+    'attributes' summary if it is incremental; one read from the API has an
+    'attributes' and an 'events' summary.
+  """
+  (request_url, shard, source_path, max_in_flight, now, coalesce_window,
+   export_path, spool_dir, watermark_path, digest_path) = job
+  stats = new_shard_stats(shard)
+  # Pool processes are reused, and forked with the metrics of the parent, so
+  # the registry only holds this shard's metrics when it is snapshot.
+  metrics.reset()
+  start = time.time()
+  client = AppBoyClient(pool_size=max_in_flight)
+  scheduler = PushScheduler(requests_per_hour=shard.requests_per_hour)
+  connection = connect_source(source_path) if source_path else None
+  dedup = None
+  if coalesce_window is not None:
+    dedup = EventDeduper(coalesce_window)
+  spool = None
+  if connection is not None and spool_dir is not None:
+    spool = PushSpool(os.path.join(spool_dir, shard.spool_name),
+                      client.encoder)
+  watermarks = None
+  if connection is not None and watermark_path is not None:
+    watermarks = WatermarkStore(watermark_path)
+  digests = DigestStore(digest_path) if digest_path is not None else None
+  try:
+    if watermarks is not None:
+      # Only the users changed since the shard's watermark, as they are.
+      stats['attributes'] = summarize_errors(sync_user_attributes(
+          request_url, shard.app_group_id, connection, watermarks,
+          max_in_flight, client, scheduler, digests, shard=shard.shard))
+    elif connection is not None:
+      # One pass over the tables, packing attributes and events together.
+      stats['users'] = summarize_errors(update_user_data(
+          request_url, shard.app_group_id, connection,
+          {'last_modified_at': now}, {'time': time.time()}, max_in_flight,
+          client, scheduler, shard=shard.shard, dedup=dedup, spool=spool,
+          digests=digests))
+    else:
+      # One export serves both passes.
+      if export_path is not None:
+        export = load_users_export(export_path)
+      else:
+        export = get_users_response_object(request_url, shard.app_group_id,
+                                           client)
+      stats['attributes'] = summarize_errors(update_attribute_data(
+          request_url, shard.app_group_id, 'last_modified_at', now,
+          max_in_flight, client, scheduler=scheduler, digests=digests,
+          shard=shard.shard, export=export))
+      stats['events'] = summarize_errors(update_event_data(
+          request_url, shard.app_group_id, 'time', time.time(),
+          max_in_flight, client, scheduler=scheduler, shard=shard.shard,
+          export=export))
+  except Exception as error:
+    # Keep the other shards going; the failure is reported with the stats.
+    stats['error'] = '%s: %s' % (type(error).__name__, error)
+  finally:
+    if digests is not None:
+      digests.close()
+    if watermarks is not None:
+      watermarks.close()
+    if spool is not None:
+      spool.close()
+    if connection is not None:
+      connection.close()
+    client.close()
+  stats['elapsed'] = time.time() - start
+  stats['metrics'] = metrics.snapshot()
+  return stats
+
+
+def merge_sync_stats(results):
+  """Adds up the stats of the shards of a sync run.
+
+  Args:
+    results: iterable The dictionaries returned by run_sync_shard.
+
+  The metrics recorded by each shard are merged into the registry of this
+  process, so the run shows in its ApiMetrics exports.
+
+  Returns:
+    A dictionary with the per-shard 'results', the 'batches' read and 'sent',
+    the 'duplicates' and 'coalesced' events dropped and the 'unchanged' users
+    skipped across every shard, and the 'failed' batches and shards as
+    (shard, error) tuples.
+  """
+  merged = {'results': [], 'batches': 0, 'sent': 0, 'duplicates': 0,
+            'coalesced': 0, 'unchanged': 0, 'failed': []}
+  for stats in results:
+    snapshot = stats.pop('metrics', None)
+    if snapshot:
+      metrics.merge(snapshot)
+    merged['results'].append(stats)
+    if stats['error'] is not None:
+      merged['failed'].append((stats['shard'], stats['error']))
+    for summary in (stats['attributes'], stats['events'], stats['users']):
+      if summary is None:
+        continue
+      merged['batches'] += summary['batches']
+      merged['sent'] += summary['sent']
+      if 'dedup' in summary:
+        merged['duplicates'] += summary['dedup']['duplicates']
+        merged['coalesced'] += summary['dedup']['coalesced']
+      merged['unchanged'] += summary.get('unchanged', 0)
+      for index, error in summary['failed']:
+        merged['failed'].append((stats['shard'], 'Batch %d: %s' % (index, error)))
+  return merged
+
+
+def sync_app_groups(request_url, app_group_ids, source_path=None,
+                    shards_per_group=1, processes=DEFAULT_PROCESSES,
+                    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                    requests_per_hour=DEFAULT_REQUESTS_PER_HOUR,
+                    coalesce_window=None, spool_dir=None,
+                    watermark_path=None, digest_path=None):
+  """Syncs many app groups across a pool of processes.
+
+  Every shard runs in its own process with its own connection pool and its own
+  share of its app group quota, so a slow app group only holds up its own
+  process. The shards are collected as they finish.
+
+  When the objects are read from the API and app groups are split, the users
+  export of each app group is downloaded once, to a temporary file, before
+  the shards start. Every shard still parses the whole export and keeps its
+  own users, but the export is only transferred once per app group.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_ids: list The App Group Identifiers.
+    source_path: str The path of the SQLite stand-in for the appboy tables, or
+      None to read the objects from the API.
+    shards_per_group: int The number of shards each app group is split into.
+    processes: int The number of processes syncing shards at the same time.
+    max_in_flight: int The max number of requests each shard sends at once.
+    requests_per_hour: int The /users/track quota of each app group.
+    coalesce_window: int Seconds within which a user's events of one name
+      read from the tables are coalesced, 0 to only drop duplicate events, or
+      None to send every event.
+    spool_dir: str The directory holding a spool per shard, to resume the
+      shards read from the tables after a crash, or None not to spool. A
+      rerun has to use the same shards_per_group to find its spools. The API
+      export gives no order to resume from, so shards read from the API are
+      not spooled.
+    watermark_path: str The path of the WatermarkStore of an incremental
+      sync, or None to push every user. When given, each shard pushes only
+      the attributes of the users changed since its own watermark, and the
+      events are not pushed. A rerun has to use the same shards_per_group
+      to find its watermarks.
+    digest_path: str The path of the DigestStore shared by the shards, to send
+      only the attribute fields changed since they were last pushed, or None
+      to send every field.
+
+  Returns:
+    The stats merged by merge_sync_stats.
+
+  Raises:
+    ValueError: If an incremental sync is asked for without a source_path, or
+      digests with a spool_dir.
+  """
+  if watermark_path is not None and source_path is None:
+    raise ValueError('An incremental sync reads the users from the tables.')
+  if digest_path is not None and spool_dir is not None:
+    raise ValueError('A spool cannot resume a run that skips unchanged users.')
+  now = datetime.datetime.utcnow()
+  shards = plan_shards(app_group_ids, shards_per_group, requests_per_hour)
+  export_dir = None
+  export_paths = {}
+  export_errors = {}
+  if source_path is None and shards_per_group > 1:
+    export_dir = tempfile.mkdtemp(prefix='appboy-export-')
+    client = AppBoyClient()
+    try:
+      for index, app_group_id in enumerate(app_group_ids):
+        path = os.path.join(export_dir, '%d.json' % index)
+        try:
+          download_users_export(request_url, app_group_id, path, client)
+        except Exception as error:
+          export_errors[app_group_id] = '%s: %s' % (type(error).__name__,
+                                                    error)
+        else:
+          export_paths[app_group_id] = path
+    finally:
+      client.close()
+  # The shards of an app group whose export failed are not run.
+  skipped = [new_shard_stats(shard, export_errors[shard.app_group_id])
+             for shard in shards if shard.app_group_id in export_errors]
+  shards = [shard for shard in shards
+            if shard.app_group_id not in export_errors]
+
+  if spool_dir is not None and not os.path.isdir(spool_dir):
+    os.makedirs(spool_dir)
+  jobs = [(request_url, shard, source_path, max_in_flight, now,
+           coalesce_window, export_paths.get(shard.app_group_id), spool_dir,
+           watermark_path, digest_path)
+          for shard in shards]
+  pool = multiprocessing.Pool(min(processes, len(jobs)) or 1)
+  try:
+    merged = merge_sync_stats(itertools.chain(
+        skipped, pool.imap_unordered(run_sync_shard, jobs)))
+  finally:
+    pool.close()
+    pool.join()
+    if export_dir is not None:
+      shutil.rmtree(export_dir, ignore_errors=True)
+  print_sync_stats(merged)
+  return merged
+
+
+def print_sync_stats(merged):
+  """Prints the stats returned by sync_app_groups.
+
+  Args:
+    merged: dict The merged stats of a sync run.
+  """
+  for stats in merged['results']:
+    print '%s done in %.1fs.' % (stats['shard'], stats['elapsed'])
+  print 'Sent %d of %d batches across %d shards.' % (
+      merged['sent'], merged['batches'], len(merged['results']))
+  if merged['duplicates'] or merged['coalesced']:
+    print 'Dropped %d duplicate and %d coalesced events.' % (
+        merged['duplicates'], merged['coalesced'])
+  if merged['unchanged']:
+    print 'Skipped %d unchanged users.' % merged['unchanged']
+  for shard, error in merged['failed']:
+    print '%s failed: %s' % (shard, error)
 
 
 def main():
   # Define the request endpoint.
   request_url = 'https://api.appboy.com/users/track'
 
-  # App Group Identifier.
-  app_group_id = '38a46418-0026-4b7b-8931-41cd5224ac07'
+  # App Group Identifiers.
+  app_group_ids = ['38a46418-0026-4b7b-8931-41cd5224ac07']
   
   # TaskA1: Update user attributes and user event data on an AppBoy account for all users in the tables!
-  update_attribute_data(request_url, app_group_id, 'last_modified_at', datetime.datetime.utcnow())
-  update_event_data(request_url, app_group_id, 'time', time.time())
+  sync_app_groups(request_url, app_group_ids)
   
 if __name__ == '__main__':
   main()
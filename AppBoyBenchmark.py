@@ -0,0 +1,487 @@
+"""Benchmarks the AppBoy push path against a local stub of the /users/track endpoint.
+
+The stub server speaks HTTP/1.1 with keep-alive and counts the TCP connections
+it accepts, so the runs below show whether batches reuse pooled connections or
+pay for a new connection each. Like the real endpoint it rejects batches of
+more than 50 objects per type, and it can answer some requests with a 429 to
+exercise the retries. The source runs push a SQLite stand-in of the appboy
+tables through update_attribute_data and update_event_data, then through the
+single pass of update_user_data, and report the requests per second, p50/p99
+latency and peak RSS. The memory benchmark
+compares events held as dictionaries with events held in EventColumns, and the
+encoding benchmark times the JSON body of a 50-object batch.
+
+Sample Application Usage:
+
+  $ python AppBoyBenchmark.py
+
+"""
+
+import BaseHTTPServer
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import requests
+
+import AppBoyApi
+import BenchmarkHarness
+
+# App Group Identifier sent with the benchmark batches.
+APP_GROUP_ID = 'benchmark-app-group'
+
+# Requests per hour given to the benchmark schedulers, so runs are not paced.
+UNLIMITED_QUOTA = 10 ** 9
+
+
+class StubStats(object):
+  """Counts the connections, requests and objects seen by the stub server.
+
+  Args:
+    throttle_every: int Answer every this many requests with a 429, or 0 to
+      never throttle.
+  """
+
+  def __init__(self, throttle_every=0):
+    self.throttle_every = throttle_every
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.connections = 0
+      self.requests = 0
+      self.objects = 0
+      self.throttled = 0
+      self.rejected = 0
+
+  def connection(self):
+    with self.lock:
+      self.connections += 1
+
+  def request(self):
+    """Counts a request and tells whether it is one to throttle.
+
+    Returns:
+      True if the request is to be answered with a 429.
+    """
+    with self.lock:
+      self.requests += 1
+      return (bool(self.throttle_every) and
+              self.requests % self.throttle_every == 0)
+
+  def count(self, name, value=1):
+    with self.lock:
+      setattr(self, name, getattr(self, name) + value)
+
+
+class StubTrackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers /users/track requests the way the endpoint does.
+
+  A batch with more than BATCH_SIZE objects of a type is rejected with a 400,
+  and every throttle_every-th request of the server is answered with a 429.
+  Other requests get a success message.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  # The status line and headers are written one by one; without this each
+  # response waits out the client's delayed ACK.
+  disable_nagle_algorithm = True
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.stats.connection()
+
+  def do_GET(self):
+    self.read_body()
+    self.send_json('{"attributes": [], "events": []}')
+
+  def do_POST(self):
+    body, throttled = self.read_body()
+    if throttled:
+      self.server.stats.count('throttled')
+      self.send_json('{"message": "rate limited"}', 429, {'Retry-After': '0'})
+      return
+    if self.headers.getheader('Content-Encoding') == 'gzip':
+      body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    data = json.loads(body)
+    for field in AppBoyApi.OBJECT_FIELDS:
+      objects = len(data.get(field, ()))
+      if objects > AppBoyApi.BATCH_SIZE:
+        self.server.stats.count('rejected')
+        self.send_json('{"message": "more than %d %s"}' % (
+            AppBoyApi.BATCH_SIZE, field), 400)
+        return
+      self.server.stats.count('objects', objects)
+    self.send_json('{"message": "success"}')
+
+  def read_body(self):
+    length = int(self.headers.getheader('Content-Length', 0))
+    body = self.rfile.read(length)
+    throttled = self.server.stats.request()
+    if self.server.latency:
+      time.sleep(self.server.latency)
+    return body, throttled
+
+  def send_json(self, body, status=200, headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def start_stub_server(handler=StubTrackHandler, latency=0.0,
+                      throttle_every=0):
+  """Starts a stub server on a free local port.
+
+  Args:
+    handler: class The request handler class.
+    latency: float Seconds the server waits before answering each request.
+    throttle_every: int Answer every this many requests with a 429, or 0 to
+      never throttle.
+
+  Returns:
+    The running server. Its stats attribute counts connections and requests.
+  """
+  return BenchmarkHarness.start_server(
+      handler, stats=StubStats(throttle_every), latency=latency)
+
+
+def make_payloads(batches):
+  """Builds /users/track payloads of 50 attribute objects each.
+
+  Args:
+    batches: int The number of payloads.
+
+  Yields:
+    The payloads.
+  """
+  for batch in xrange(batches):
+    yield {'attributes': [
+        {'external_id': '%d-%d' % (batch, i), 'first_name': 'Benchmark'}
+        for i in xrange(AppBoyApi.BATCH_SIZE)]}
+
+
+def print_run(name, server, batches, elapsed, max_in_flight):
+  """Prints the figures of one benchmark run.
+
+  Args:
+    name: str The name of the run.
+    server: The stub server the run was sent to.
+    batches: int The number of batches sent.
+    elapsed: float The wall time of the run, in seconds.
+    max_in_flight: int The max number of requests sent concurrently.
+  """
+  print '------ %s -------' % name
+  print 'Batches            = %d' % batches
+  print 'Connections opened = %d' % server.stats.connections
+  print 'Requests served    = %d' % server.stats.requests
+  print 'Elapsed            = %.3fs' % elapsed
+  print 'Batches per second = %.1f' % (batches / elapsed)
+  print 'Latency per batch  = %.2fms' % (
+      elapsed * 1000.0 * max_in_flight / batches)
+  print
+
+
+def bench_connection_reuse(batches=500,
+                           max_in_flight=AppBoyApi.DEFAULT_MAX_IN_FLIGHT,
+                           latency=0.002):
+  """Compares one connection per batch with the pooled AppBoyClient.
+
+  Args:
+    batches: int The number of batches to send in each run.
+    max_in_flight: int The max number of requests sent concurrently.
+    latency: float Seconds the stub server waits before answering.
+  """
+  server = start_stub_server(latency=latency)
+  request_url = 'http://127.0.0.1:%d/users/track' % server.server_address[1]
+
+  # A new connection per batch, as module-level requests.post does.
+  encoder = AppBoyApi.PayloadEncoder()
+  def send_unpooled(payload):
+    return requests.post(request_url, data=encoder.encode(payload),
+                         headers=AppBoyApi.JSON_HEADERS)
+
+  start = time.time()
+  for _ in AppBoyApi.iter_push_results(send_unpooled, make_payloads(batches),
+                                       max_in_flight):
+    pass
+  print_run('One connection per batch', server, batches, time.time() - start,
+            max_in_flight)
+
+  # The pooled, keep-alive client, with a quota the stub never reaches.
+  server.stats.reset()
+  client = AppBoyApi.AppBoyClient(pool_size=max_in_flight)
+  scheduler = AppBoyApi.PushScheduler(requests_per_hour=UNLIMITED_QUOTA)
+  start = time.time()
+  AppBoyApi.push_payloads(request_url, APP_GROUP_ID, make_payloads(batches),
+                          max_in_flight, client, scheduler)
+  print_run('Pooled AppBoyClient', server, batches, time.time() - start,
+            max_in_flight)
+  client.close()
+
+  server.stop()
+
+
+class TimedClient(AppBoyApi.AppBoyClient):
+  """An AppBoyClient recording the latency of every request it sends.
+
+  Args:
+    recorder: LatencyRecorder The recorder of the latencies.
+    **kwargs: The arguments of AppBoyClient.
+  """
+
+  def __init__(self, recorder, **kwargs):
+    AppBoyApi.AppBoyClient.__init__(self, **kwargs)
+    self.recorder = recorder
+
+  def post(self, request_url, data):
+    start = time.time()
+    try:
+      return AppBoyApi.AppBoyClient.post(self, request_url, data)
+    finally:
+      self.recorder.record(time.time() - start)
+
+
+def make_source(path, users, events_per_user):
+  """Fills a SQLite stand-in of the appboy tables.
+
+  Args:
+    path: str The path of the SQLite database file.
+    users: int The number of users.
+    events_per_user: int The number of events of each user.
+  """
+  connection = AppBoyApi.connect_source(path)
+  AppBoyApi.create_source_tables(connection)
+  with connection:
+    connection.executemany(
+        'INSERT INTO appboy.user VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (('user-%d' % i, 'user-%d@example.com' % i, 1, APP_GROUP_ID,
+          'Benchmark', 'User', '%05d' % (i % 100000), 'Boston',
+          '2017-01-01 00:00:00') for i in xrange(users)))
+    # The users were inserted into an empty table, so user i has rowid i + 1.
+    connection.executemany(
+        'INSERT INTO appboy.user_events VALUES (?, ?, ?, ?)',
+        ((i, i // events_per_user + 1, 'event-%d' % (i % 20),
+          time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1500000000 + i)))
+         for i in xrange(users * events_per_user)))
+  connection.close()
+
+
+def push_source(request_url, source_path, update, fields, max_in_flight):
+  """Pushes the source tables through an update function, printing its figures.
+
+  Args:
+    request_url: string The request API endpoint.
+    source_path: str The path of the SQLite database file.
+    update: callable update_attribute_data, update_event_data or
+      update_user_data.
+    fields: dict The arguments naming the fields to update and their values.
+    max_in_flight: int The max number of requests sent concurrently.
+  """
+  recorder = BenchmarkHarness.LatencyRecorder()
+  client = TimedClient(recorder, pool_size=max_in_flight)
+  scheduler = AppBoyApi.PushScheduler(requests_per_hour=UNLIMITED_QUOTA)
+  connection = AppBoyApi.connect_source(source_path)
+  start = time.time()
+  summary = update(request_url, APP_GROUP_ID, max_in_flight=max_in_flight,
+                   client=client, connection=connection, scheduler=scheduler,
+                   **fields)
+  BenchmarkHarness.print_load_run(
+      update.__name__, recorder, time.time() - start,
+      batches_sent=summary['sent'], batches_failed=len(summary['failed']),
+      retries=scheduler.retries)
+  connection.close()
+  client.close()
+
+
+def bench_source_push(users=20000, events_per_user=5,
+                      max_in_flight=AppBoyApi.DEFAULT_MAX_IN_FLIGHT,
+                      latency=0.002, throttle_every=0):
+  """Pushes a generated source through each update function.
+
+  The source goes through update_attribute_data and update_event_data, then
+  through update_user_data, which sends both in one pass. Each update runs in
+  its own process, so its peak RSS is its own.
+
+  Args:
+    users: int The number of users in the source.
+    events_per_user: int The number of events of each user.
+    max_in_flight: int The max number of requests sent concurrently.
+    latency: float Seconds the stub server waits before answering.
+    throttle_every: int Answer every this many requests with a 429, or 0 to
+      never throttle.
+  """
+  directory = tempfile.mkdtemp()
+  try:
+    source_path = os.path.join(directory, 'source.db')
+    make_source(source_path, users, events_per_user)
+    server = start_stub_server(latency=latency, throttle_every=throttle_every)
+    request_url = 'http://127.0.0.1:%d/users/track' % server.server_address[1]
+    for update, fields in (
+        (AppBoyApi.update_attribute_data,
+         {'field': 'home_city', 'value': 'Berlin'}),
+        (AppBoyApi.update_event_data, {'field': 'name', 'value': 'benchmark'}),
+        (AppBoyApi.update_user_data,
+         {'attribute_fields': {'home_city': 'Berlin'},
+          'event_fields': {'name': 'benchmark'}})):
+      server.stats.reset()
+      BenchmarkHarness.run_isolated(push_source, request_url, source_path,
+                                    update, fields, max_in_flight)
+      print 'Server: %d objects, %d throttled (429), %d rejected (400)' % (
+          server.stats.objects, server.stats.throttled, server.stats.rejected)
+      print
+    server.stop()
+  finally:
+    shutil.rmtree(directory)
+
+
+def deep_sizeof(obj):
+  """Gets the memory held by an object and everything it references.
+
+  Args:
+    obj: The object to measure.
+
+  Returns:
+    The size in bytes, counting shared objects once.
+  """
+  seen = set()
+  stack = [obj]
+  total = 0
+  while stack:
+    obj = stack.pop()
+    if id(obj) in seen:
+      continue
+    seen.add(id(obj))
+    total += sys.getsizeof(obj)
+    if isinstance(obj, dict):
+      stack.extend(obj.iterkeys())
+      stack.extend(obj.itervalues())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+      stack.extend(obj)
+    elif hasattr(obj, '__dict__'):
+      stack.append(obj.__dict__)
+    elif hasattr(obj, '__slots__'):
+      stack.extend(getattr(obj, slot) for slot in obj.__slots__
+                   if hasattr(obj, slot))
+  return total
+
+
+def make_event_rows(events, users=100000, names=20):
+  """Builds event rows with a new string object per value, as a cursor does.
+
+  Args:
+    events: int The number of rows.
+    users: int The number of distinct users.
+    names: int The number of distinct event names.
+
+  Yields:
+    (external_id, name, epoch) tuples.
+  """
+  for i in xrange(events):
+    yield (u'user-%d' % (i % users), u'event-%d' % (i % names),
+           1500000000 + i)
+
+
+def bench_event_memory(events=1000000):
+  """Compares the memory held by events as dictionaries and as EventColumns.
+
+  Args:
+    events: int The number of events.
+  """
+  dicts = [{'external_id': external_id, 'name': name,
+            'time': AppBoyApi.format_time(epoch)}
+           for external_id, name, epoch in make_event_rows(events)]
+  dict_bytes = deep_sizeof(dicts)
+  del dicts
+
+  columns = AppBoyApi.EventColumns()
+  for external_id, name, epoch in make_event_rows(events):
+    columns.append(external_id, name, epoch)
+  column_bytes = deep_sizeof(columns)
+
+  print '------ Event memory -------'
+  print 'Events              = %d' % events
+  print 'Dictionaries        = %.1fMB' % (dict_bytes / 1048576.0)
+  print 'EventColumns        = %.1fMB' % (column_bytes / 1048576.0)
+  print 'Bytes per event     = %.1f vs %.1f' % (
+      float(dict_bytes) / events, float(column_bytes) / events)
+  print 'Reduction           = %.1fx' % (float(dict_bytes) / column_bytes)
+  print
+
+
+def make_attribute_payload():
+  """Builds a /users/track payload of 50 attribute objects with datetimes.
+
+  Returns:
+    The payload.
+  """
+  now = datetime.datetime.utcnow()
+  return {'app_group_id': APP_GROUP_ID, 'attributes': [
+      {'external_id': 'user-%d' % i, 'email': 'user-%d@example.com' % i,
+       'optin_status': 1, 'first_name': 'Benchmark', 'last_name': 'User',
+       'user_zipcode': '02134', 'home_city': 'Boston', 'last_modified_at': now}
+      for i in xrange(AppBoyApi.BATCH_SIZE)]}
+
+
+def time_encode(encode, payload, batches):
+  """Times the encoding of a payload.
+
+  Args:
+    encode: callable Encodes one payload.
+    payload: dict The payload.
+    batches: int The number of times to encode it.
+
+  Returns:
+    The mean encode time, in microseconds.
+  """
+  start = time.time()
+  for _ in xrange(batches):
+    encode(payload)
+  return (time.time() - start) * 1000000.0 / batches
+
+
+def bench_payload_encoding(batches=20000):
+  """Compares json.dumps per batch with the shared PayloadEncoder.
+
+  Args:
+    batches: int The number of 50-object batches to encode in each run.
+  """
+  payload = make_attribute_payload()
+  print '------ Payload encoding -------'
+  print 'Batches             = %d' % batches
+  print 'json.dumps          = %.1fus per batch' % time_encode(
+      lambda data: json.dumps(data, default=AppBoyApi.encode_default),
+      payload, batches)
+  stdlib = AppBoyApi.PayloadEncoder()
+  print 'PayloadEncoder      = %.1fus per batch (%s)' % (
+      time_encode(stdlib.encode, payload, batches), stdlib.backend)
+  encoder = AppBoyApi.PayloadEncoder(use_simplejson=True)
+  if encoder.backend != stdlib.backend:
+    print 'PayloadEncoder      = %.1fus per batch (%s)' % (
+        time_encode(encoder.encode, payload, batches), encoder.backend)
+  print
+
+
+def main():
+  bench_connection_reuse()
+  bench_source_push()
+  bench_source_push(users=5000, throttle_every=100)
+  bench_event_memory()
+  bench_payload_encoding()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,694 @@
+"""Async variants of the AppBoy and Google Analytics Management API calls.
+
+AppBoyApi.py and GoogleAnalyticsMgtApi.py block a thread on every request,
+which does not fit an asyncio application. This module mirrors their calls
+as coroutines: get_users_response_object, update_user, create_dimension,
+update_dimension and the hierarchy listings. They share one aiohttp session
+per client, with pooled keep-alive connections. A semaphore bounds the
+requests in flight, so one event loop can keep thousands of them going
+without a thread each.
+
+The other modules are Python 2 and asyncio is Python 3, so this module is
+Python 3 and does not import them. Its constants and retry rules follow
+theirs: /users/track is paced under the hourly quota and retried on 429 and
+5xx. Management API calls are paced in queries per second and retried on
+rate limits and 5xx. A rate limit holds back every request of the client.
+
+Install aiohttp to use it:
+
+ $ pip install aiohttp
+
+Sample Application Usage:
+
+  async def main():
+    async with AsyncAppBoyClient() as client:
+      users = await get_users_response_object(request_url, app_group_id, client)
+      await push_payloads(request_url, app_group_id, payloads, client)
+
+    async with AsyncManagementClient(credentials) as client:
+      tree = await traverse_hierarchy(client)
+
+  asyncio.run(main())
+
+"""
+
+import asyncio
+import datetime
+import email.utils
+import json
+import random
+import time
+
+# aiohttp is only needed once a client is created.
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+# The max of user objects per API call.
+BATCH_SIZE = 50
+
+# Default number of requests a client keeps in flight.
+DEFAULT_MAX_IN_FLIGHT = 1000
+
+# Default number of keep-alive connections pooled per client. Requests beyond
+# it wait for a free connection rather than opening more.
+DEFAULT_POOL_SIZE = 100
+
+# Default seconds to wait for an API to answer.
+DEFAULT_TIMEOUT = 60
+
+# Default /users/track quota of the account, in requests per hour.
+DEFAULT_REQUESTS_PER_HOUR = 50000
+
+# Default pace of the Management API calls, under its limit of 10 queries per
+# second per user.
+DEFAULT_QPS = 8.0
+
+# Default number of times a throttled or failed request is sent again.
+DEFAULT_MAX_RETRIES = 5
+
+# Bounds, in seconds, of the exponential backoff between retries.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+
+# Separators of the compact JSON request bodies.
+JSON_SEPARATORS = (',', ':')
+
+# Headers sent with every JSON request body.
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Root of the Management API calls.
+MANAGEMENT_API_URL = 'https://www.googleapis.com/analytics/v3/'
+
+# Items requested per page of a Management API collection.
+DEFAULT_PAGE_SIZE = 1000
+
+# Reasons of the 403 errors the API answers when it is called too fast, as
+# opposed to a lack of permission or an exhausted daily quota.
+RATE_LIMIT_REASONS = frozenset(
+    ['userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded'])
+
+# Seconds before its expiry an access token is refreshed.
+TOKEN_REFRESH_MARGIN = 60
+
+
+class ApiError(Exception):
+  """Raised when an API answers a request with an error status.
+
+  Args:
+    status: int The HTTP status of the response.
+    content: bytes The body of the response.
+  """
+
+  def __init__(self, status, content):
+    Exception.__init__(self, 'Status: %s Problem with the request.' % status)
+    self.status = status
+    self.content = content
+
+
+class AppBoyError(ApiError):
+  """Raised when the AppBoy API answers with a status other than 200."""
+
+
+class ManagementApiError(ApiError):
+  """Raised when the Management API answers with an error status."""
+
+  @property
+  def reason(self):
+    """The reason of the first error listed, or None if there is none."""
+    try:
+      return json.loads(self.content)['error']['errors'][0]['reason']
+    except (ValueError, TypeError, KeyError, IndexError):
+      return None
+
+
+def encode_default(obj):
+  """Turns the values the JSON encoder does not know into JSON values.
+
+  Records with a to_object or to_objects method, such as the UserRecord and
+  EventBatch objects of AppBoyApi, are turned into their objects, and
+  datetimes into ISO-8601 UTC times.
+
+  Args:
+    obj: The value to encode.
+
+  Returns:
+    A value the JSON encoder can write.
+
+  Raises:
+    TypeError: If the value cannot be encoded.
+  """
+  if hasattr(obj, 'to_object'):
+    return obj.to_object()
+  if hasattr(obj, 'to_objects'):
+    return obj.to_objects()
+  if isinstance(obj, datetime.datetime):
+    # Naive datetimes are taken to be UTC, as datetime.utcnow() returns.
+    offset = obj.utcoffset()
+    if offset is not None:
+      obj = obj.replace(tzinfo=None) - offset
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second)
+  if isinstance(obj, datetime.date):
+    return obj.isoformat()
+  raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def get_retry_after(headers):
+  """Gets the delay a response asks for in its Retry-After header.
+
+  Args:
+    headers: The headers of the response.
+
+  Returns:
+    The delay in seconds, or None if the header is missing or malformed.
+  """
+  value = headers.get('Retry-After')
+  if not value:
+    return None
+  if value.strip().isdigit():
+    return float(value)
+  # Otherwise the header holds an HTTP date.
+  parsed = email.utils.parsedate_tz(value)
+  if parsed is None:
+    return None
+  return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class AsyncHttpClient(object):
+  """Sends paced, retried requests over a pooled aiohttp session.
+
+  Request starts are spaced interval seconds apart across every coroutine,
+  and at most max_in_flight requests are sent or waiting for their response
+  at once. The session is created on first use. Create the client inside the
+  running loop, since its semaphore belongs to the loop it is first used in.
+
+  Args:
+    interval: float The min seconds between two request starts, or 0.
+    max_in_flight: int The max number of requests in flight.
+    pool_size: int The max number of pooled connections.
+    timeout: float Seconds to wait for a response.
+    max_retries: int The number of times a request is sent again before its
+      error is raised.
+
+  Raises:
+    ImportError: If aiohttp is not installed.
+  """
+
+  error = ApiError
+
+  def __init__(self, interval=0.0, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+               pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+               max_retries=DEFAULT_MAX_RETRIES):
+    if aiohttp is None:
+      raise ImportError('The async clients need aiohttp.')
+    self.interval = interval
+    self.pool_size = pool_size
+    self.timeout = timeout
+    self.max_retries = max_retries
+    self.semaphore = asyncio.Semaphore(max_in_flight)
+    self.session = None
+    self.next_slot = 0.0
+    self.paused_until = 0.0
+    self.requests = 0
+    self.retries = 0
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
+
+  def get_session(self):
+    if self.session is None:
+      self.session = aiohttp.ClientSession(
+          connector=aiohttp.TCPConnector(limit=self.pool_size),
+          timeout=aiohttp.ClientTimeout(total=self.timeout))
+    return self.session
+
+  async def close(self):
+    """Closes the pooled connections."""
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
+
+  async def pace(self):
+    """Waits for the next request slot, and takes it."""
+    now = asyncio.get_running_loop().time()
+    slot = max(now, self.next_slot, self.paused_until)
+    self.next_slot = slot + self.interval
+    if slot > now:
+      await asyncio.sleep(slot - now)
+
+  def hold(self, seconds):
+    """Holds back every request of the client for some time."""
+    self.paused_until = max(self.paused_until,
+                            asyncio.get_running_loop().time() + seconds)
+
+  def backoff(self, attempt):
+    """Gets a jittered exponential backoff delay.
+
+    Args:
+      attempt: int The number of retries already made.
+
+    Returns:
+      The delay in seconds.
+    """
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(
+        0.5, 1.0)
+
+  def retry_delay(self, status, headers, content, attempt):
+    """Gets how long to wait before sending a failed request again.
+
+    Args:
+      status: int The HTTP status of the response.
+      headers: The headers of the response.
+      content: bytes The body of the response.
+      attempt: int The number of retries already made.
+
+    Returns:
+      The delay in seconds, or None if the request is not worth sending again.
+    """
+    if status >= 500:
+      return self.backoff(attempt)
+    return None
+
+  async def request(self, method, url, params=None, data=None, headers=None):
+    """Sends a request, again while it fails with a retryable error.
+
+    Args:
+      method: str The HTTP method.
+      url: str The URL.
+      params: dict The query parameters.
+      data: The body: bytes, or a dictionary sent form encoded.
+      headers: dict The headers.
+
+    Returns:
+      The body of the response, as bytes.
+
+    Raises:
+      ApiError: If the request still fails after max_retries retries, or
+        fails with an error that is not retryable.
+      aiohttp.ClientError: If the connection still fails after max_retries
+        retries.
+      asyncio.TimeoutError: If the request still times out after max_retries
+        retries.
+    """
+    attempt = 0
+    while True:
+      await self.pace()
+      try:
+        async with self.semaphore:
+          self.requests += 1
+          async with self.get_session().request(
+              method, url, params=params, data=data,
+              headers=headers) as response:
+            content = await response.read()
+      except (aiohttp.ClientError, asyncio.TimeoutError):
+        if attempt >= self.max_retries:
+          raise
+        delay = self.backoff(attempt)
+      else:
+        if response.status < 300:
+          return content
+        delay = None
+        if attempt < self.max_retries:
+          delay = self.retry_delay(response.status, response.headers,
+                                   content, attempt)
+        if delay is None:
+          raise self.error(response.status, content)
+      self.retries += 1
+      attempt += 1
+      await asyncio.sleep(delay)
+
+
+class AsyncAppBoyClient(AsyncHttpClient):
+  """Sends AppBoy API requests from an event loop.
+
+  Requests are paced under the hourly quota. A throttled (429) or failed (5xx)
+  request is sent again after the delay given by Retry-After, or after a
+  jittered exponential backoff, and a 429 holds back every request, since the
+  quota is shared.
+
+  Args:
+    requests_per_hour: int The /users/track quota of the account, or None to
+      not pace the requests.
+    **kwargs: The arguments of AsyncHttpClient, but interval.
+  """
+
+  error = AppBoyError
+
+  def __init__(self, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, **kwargs):
+    interval = 3600.0 / requests_per_hour if requests_per_hour else 0.0
+    AsyncHttpClient.__init__(self, interval, **kwargs)
+
+  def retry_delay(self, status, headers, content, attempt):
+    if status != 429 and status < 500:
+      return None
+    delay = get_retry_after(headers)
+    if delay is None:
+      delay = self.backoff(attempt)
+    else:
+      # Spread the requests that were told to wait the same time.
+      delay += random.uniform(0, BACKOFF_BASE)
+    if status == 429:
+      self.hold(delay)
+    return delay
+
+  async def get(self, request_url, data):
+    """Sends a GET request with the data form encoded, as AppBoyClient does.
+
+    Returns:
+      The decoded JSON response.
+    """
+    return json.loads(await self.request('GET', request_url, data=data))
+
+  async def post(self, request_url, data):
+    """Sends a POST request with a JSON body.
+
+    Returns:
+      The decoded JSON response, or the body as bytes if it is not JSON.
+    """
+    body = json.dumps(data, default=encode_default, separators=JSON_SEPARATORS)
+    content = await self.request('POST', request_url, data=body,
+                                 headers=JSON_HEADERS)
+    # The payload was accepted, so a body that does not decode is no failure.
+    try:
+      return json.loads(content)
+    except ValueError:
+      return content
+
+
+async def get_users_response_object(request_url, app_group_id, client):
+  """Gets the json response for a given api request.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    client: AsyncAppBoyClient The client to send the request with.
+
+  Returns:
+    A dictionary of the JSON response.
+
+  Raises:
+    AppBoyError: If the response status is not 200.
+  """
+  return await client.get(request_url, {'app_group_id': app_group_id})
+
+
+async def get_users_attributes(request_url, app_group_id, client):
+  """Gets the Attribute objects of all the existing users in a list."""
+  data = await get_users_response_object(request_url, app_group_id, client)
+  return data['attributes']
+
+
+async def get_users_events(request_url, app_group_id, client):
+  """Gets the Event objects of all the existing users in a list."""
+  data = await get_users_response_object(request_url, app_group_id, client)
+  return data['events']
+
+
+async def update_user(request_url, app_group_id, data, client):
+  """Updates the user data.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    data: dict The /users/track payload.
+    client: AsyncAppBoyClient The client to send the request with.
+
+  Returns:
+    The decoded JSON response, or the body as bytes if it is not JSON.
+
+  Raises:
+    AppBoyError: If the response status is not 200.
+  """
+  data['app_group_id'] = app_group_id
+  return await client.post(request_url, data)
+
+
+async def push_payloads(request_url, app_group_id, payloads, client,
+                        max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+  """Sends /users/track payloads concurrently.
+
+  max_in_flight coroutines take the payloads off one iterator, so a long
+  stream of payloads is read as it is sent, not all at once.
+
+  Args:
+    request_url: string The request API endpoint.
+    app_group_id: string App Group Identifier.
+    payloads: iterable The /users/track payloads.
+    client: AsyncAppBoyClient The client to send the requests with.
+    max_in_flight: int The max number of payloads being sent at once.
+
+  Returns:
+    A dictionary with the number of 'batches' read, the number 'sent' and a
+    list of (index, error) tuples for the 'failed' ones.
+  """
+  summary = {'batches': 0, 'sent': 0, 'failed': []}
+  batches = enumerate(payloads)
+
+  async def worker():
+    # The loop runs one coroutine at a time, so they can share the iterator.
+    for index, payload in batches:
+      summary['batches'] += 1
+      try:
+        await update_user(request_url, app_group_id, payload, client)
+      except (ApiError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+        summary['failed'].append((index, error))
+      else:
+        summary['sent'] += 1
+
+  # An unexpected error stops the other coroutines rather than leaving them
+  # sending in the background.
+  workers = [asyncio.create_task(worker()) for _ in range(max_in_flight)]
+  try:
+    await asyncio.gather(*workers)
+  except BaseException:
+    for task in workers:
+      task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    raise
+  summary['failed'].sort(key=lambda failure: failure[0])
+  return summary
+
+
+class AsyncManagementClient(AsyncHttpClient):
+  """Makes Management API calls from an event loop.
+
+  Calls are paced in queries per second. A call failing with a rate limit
+  error (429, or 403 with a rate limit reason) or a server error is made
+  again after a jittered exponential backoff, and a rate limit also holds back
+  every other call.
+
+  Args:
+    credentials: The OAuth 2.0 credentials, such as the oauth2client
+      credentials GoogleAnalyticsMgtApi authorizes with: any object whose
+      get_access_token method returns an (access_token, expires_in) tuple,
+      refreshing the token when needed. It is called on a worker thread.
+    qps: float The max number of queries per second, or None to not pace
+      the calls.
+    base_url: str The root of the Management API calls.
+    **kwargs: The arguments of AsyncHttpClient, but interval.
+  """
+
+  error = ManagementApiError
+
+  def __init__(self, credentials, qps=DEFAULT_QPS,
+               base_url=MANAGEMENT_API_URL, **kwargs):
+    AsyncHttpClient.__init__(self, 1.0 / qps if qps else 0.0, **kwargs)
+    self.credentials = credentials
+    self.base_url = base_url
+    self.token = None
+    self.token_expiry = 0.0
+    self.token_lock = asyncio.Lock()
+
+  def retry_delay(self, status, headers, content, attempt):
+    rate_limited = status == 429 or (
+        status == 403 and
+        ManagementApiError(status, content).reason in RATE_LIMIT_REASONS)
+    if not rate_limited and status < 500:
+      return None
+    delay = self.backoff(attempt)
+    if rate_limited:
+      self.hold(delay)
+    return delay
+
+  async def access_token(self):
+    """Gets the access token, refreshing it off the loop when it expires."""
+    loop = asyncio.get_running_loop()
+    async with self.token_lock:
+      if self.token is None or loop.time() >= self.token_expiry:
+        token, expires_in = await loop.run_in_executor(
+            None, self.credentials.get_access_token)
+        self.token = token
+        self.token_expiry = (loop.time() + (expires_in or 3600) -
+                             TOKEN_REFRESH_MARGIN)
+      return self.token
+
+  async def call(self, method, path, params=None, body=None):
+    """Makes a Management API call.
+
+    Args:
+      method: str The HTTP method.
+      path: str The path of the call, under base_url.
+      params: dict The query parameters.
+      body: dict The resource sent, if any.
+
+    Returns:
+      The decoded JSON response.
+
+    Raises:
+      ManagementApiError: If the call still fails after max_retries retries,
+        or fails with an error that is not retryable.
+    """
+    headers = {'Authorization': 'Bearer %s' % await self.access_token()}
+    data = None
+    if body is not None:
+      headers.update(JSON_HEADERS)
+      data = json.dumps(body, separators=JSON_SEPARATORS)
+    content = await self.request(method, self.base_url + path, params=params,
+                                 data=data, headers=headers)
+    return json.loads(content) if content else {}
+
+
+async def fetch_page(client, path, start_index, max_results):
+  """Fetches one page of a collection.
+
+  Returns:
+    The response object of the page.
+  """
+  return await client.call('GET', path, {'start-index': start_index,
+                                         'max-results': max_results})
+
+
+async def list_collections(client, paths, page_size=DEFAULT_PAGE_SIZE):
+  """Lists every item of many collections, fetching their pages concurrently.
+
+  The first page of every collection is fetched at once. Its totalResults and
+  itemsPerPage give the start-index of every other page, and those pages are
+  then fetched at once as well.
+
+  Args:
+    client: AsyncManagementClient The client to make the calls with.
+    paths: list The paths of the collections, under the client base_url.
+    page_size: int The max-results of each page.
+
+  Returns:
+    A list of the items of each collection, in the order of paths.
+  """
+  first_pages = await asyncio.gather(*[
+      fetch_page(client, path, 1, page_size) for path in paths])
+
+  owners = []
+  pages = []
+  for index, (path, page) in enumerate(zip(paths, first_pages)):
+    per_page = page.get('itemsPerPage') or page_size
+    for start_index in range(1 + per_page, page.get('totalResults', 0) + 1,
+                             per_page):
+      owners.append(index)
+      pages.append(fetch_page(client, path, start_index, per_page))
+
+  items = [list(page.get('items', [])) for page in first_pages]
+  for index, page in zip(owners, await asyncio.gather(*pages)):
+    items[index].extend(page.get('items', []))
+  return items
+
+
+async def list_items(client, path, page_size=DEFAULT_PAGE_SIZE):
+  """Lists every item of a collection, such as 'management/segments'."""
+  items, = await list_collections(client, [path], page_size)
+  return items
+
+
+async def traverse_hierarchy(client, page_size=DEFAULT_PAGE_SIZE):
+  """Lists every account, web property and view (profile) of the user.
+
+  Args:
+    client: AsyncManagementClient The client to make the calls with.
+    page_size: int The max-results of each page.
+
+  Returns:
+    A list with a dictionary per account, holding the 'account' resource and
+    its 'webproperties'. Each of those holds the 'webproperty' resource and its
+    'profiles' resources, as GoogleAnalyticsMgtApi.traverse_hierarchy returns.
+
+  Raises:
+    ManagementApiError: If an error occured when accessing the API.
+  """
+  accounts = await list_items(client, 'management/accounts', page_size)
+  webproperties = await list_collections(client, [
+      'management/accounts/%s/webproperties' % account['id']
+      for account in accounts], page_size)
+
+  tree = []
+  property_nodes = []
+  profile_paths = []
+  for account, account_webproperties in zip(accounts, webproperties):
+    account_node = {'account': account, 'webproperties': []}
+    for webproperty in account_webproperties:
+      property_node = {'webproperty': webproperty, 'profiles': []}
+      account_node['webproperties'].append(property_node)
+      property_nodes.append(property_node)
+      profile_paths.append('management/accounts/%s/webproperties/%s/profiles'
+                           % (account['id'], webproperty['id']))
+    tree.append(account_node)
+
+  for property_node, profiles in zip(
+      property_nodes,
+      await list_collections(client, profile_paths, page_size)):
+    property_node['profiles'] = profiles
+  return tree
+
+
+def dimensions_path(account_id, web_property_id):
+  return ('management/accounts/%s/webproperties/%s/customDimensions'
+          % (account_id, web_property_id))
+
+
+async def create_dimension(client, account_id, web_property_id, name, scope,
+                           active=True):
+  """Creates a new custom dimension.
+
+  Args:
+    client: AsyncManagementClient The client to make the call with.
+    account_id: str The Account ID for the custom dimension to create.
+    web_property_id: str The Web property ID for the custom dimension to create.
+    name: str The name of the custom dimension.
+    scope: str The scope of the custom dimension: HIT, SESSION, USER or PRODUCT.
+    active: bool Whether the custom dimension is active.
+
+  Returns:
+    The created custom dimension resource.
+
+  Raises:
+    ManagementApiError: If an error occured when accessing the API.
+  """
+  return await client.call(
+      'POST', dimensions_path(account_id, web_property_id),
+      body={'name': name, 'scope': scope, 'active': active})
+
+
+async def update_dimension(client, account_id, web_property_id, dimension_id,
+                           field, value):
+  """Updates an existing custom dimension field with the given value.
+
+  Args:
+    client: AsyncManagementClient The client to make the call with.
+    account_id: str The Account ID for the custom dimension to update.
+    web_property_id: str The Web property ID for the custom dimension to update.
+    dimension_id: str The ID of the custom dimension to update.
+    field: str The custom dimension field to be updated.
+    value: The new value to be updated.
+
+  Returns:
+    The updated custom dimension resource.
+
+  Raises:
+    ManagementApiError: If an error occured when accessing the API.
+  """
+  return await client.call(
+      'PUT', '%s/%s' % (dimensions_path(account_id, web_property_id),
+                        dimension_id),
+      body={field: value})
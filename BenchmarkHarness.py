@@ -0,0 +1,139 @@
+"""Shared pieces of the offline benchmarks of the AppBoy and Google Analytics clients.
+
+The benchmarks answer the API calls from local stand-in servers, so they run
+without credentials. Each load run is made in a child process while the
+stand-in server keeps serving from the parent, which gives every run its own
+peak RSS and keeps the server off the client's interpreter lock.
+"""
+
+import BaseHTTPServer
+import multiprocessing
+import resource
+import SocketServer
+import sys
+import threading
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """A threaded HTTP server that handles each connection on its own thread."""
+
+  daemon_threads = True
+
+  # Accept many connections opening at once, as a load run's do, instead of
+  # dropping them past the default backlog of 5 until the client retries.
+  request_queue_size = 1024
+
+  def process_request(self, request, client_address):
+    # Drop the finished threads, so a long run does not hold on to every
+    # connection it ever served.
+    self.handler_threads = [thread for thread in self.handler_threads
+                            if thread.is_alive()]
+    thread = threading.Thread(target=self.process_request_thread,
+                              args=(request, client_address))
+    thread.daemon = True
+    self.handler_threads.append(thread)
+    thread.start()
+
+  def handle_error(self, request, client_address):
+    # Clients dropping idle keep-alive connections is expected here.
+    pass
+
+  def stop(self):
+    """Stops serving and waits for the connection threads to finish."""
+    self.shutdown()
+    self.server_close()
+    for thread in list(self.handler_threads):
+      thread.join(1.0)
+
+
+def start_server(handler, **settings):
+  """Starts a stub server on a free local port.
+
+  Args:
+    handler: class The request handler class.
+    **settings: Attributes set on the server for the handler to read.
+
+  Returns:
+    The running server.
+  """
+  server = StubServer(('127.0.0.1', 0), handler)
+  server.handler_threads = []
+  for name, value in settings.iteritems():
+    setattr(server, name, value)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+class LatencyRecorder(object):
+  """Records the latency of every request of a run."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = []
+
+  def record(self, seconds):
+    with self.lock:
+      self.latencies.append(seconds)
+
+  def percentile(self, percent):
+    """Gets a latency percentile, in seconds, or 0 if nothing was recorded."""
+    with self.lock:
+      latencies = sorted(self.latencies)
+    if not latencies:
+      return 0.0
+    index = int(round(percent / 100.0 * (len(latencies) - 1)))
+    return latencies[index]
+
+  def __len__(self):
+    return len(self.latencies)
+
+
+def peak_rss_mb():
+  """Gets the peak resident set size of the current process, in megabytes."""
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return usage * RSS_UNIT / 1048576.0
+
+
+def print_load_run(name, recorder, elapsed, **counts):
+  """Prints the throughput, latency and memory figures of a load run.
+
+  Args:
+    name: str The name of the run.
+    recorder: LatencyRecorder The latencies of the requests of the run.
+    elapsed: float The wall time of the run, in seconds.
+    **counts: More figures to print, by name.
+  """
+  print '------ %s -------' % name
+  print 'Requests            = %d' % len(recorder)
+  for label, count in sorted(counts.iteritems()):
+    print '%-19s = %s' % (label.replace('_', ' ').capitalize(), count)
+  print 'Elapsed             = %.3fs' % elapsed
+  print 'Requests per second = %.1f' % (len(recorder) / elapsed)
+  print 'Latency p50         = %.2fms' % (recorder.percentile(50) * 1000.0)
+  print 'Latency p99         = %.2fms' % (recorder.percentile(99) * 1000.0)
+  print 'Peak RSS            = %.1fMB' % peak_rss_mb()
+  print
+
+
+def run_isolated(function, *args):
+  """Runs a function in a child process and waits for it.
+
+  Args:
+    function: callable The function to run.
+    *args: The arguments of the function.
+
+  Raises:
+    RuntimeError: If the child process fails.
+  """
+  sys.stdout.flush()
+  process = multiprocessing.Process(target=function, args=args)
+  process.start()
+  process.join()
+  if process.exitcode != 0:
+    raise RuntimeError('%s exited with %s' % (function.__name__,
+                                              process.exitcode))
@@ -0,0 +1,575 @@
+"""Benchmarks the Google Analytics Management API calls against a local stand-in of the API.
+
+The stand-in serves a discovery document pointing the client at itself, the
+paginated accounts, web properties, profiles and segments collections, the
+custom dimensions of each web property, and the multipart batch endpoint. It caps every page
+at page_limit items whatever max-results asks for, so the traversal follows
+the pagination of each collection. The runs build the service from the
+discovery document, then drive print_results, the custom dimension functions
+and reconcile_dimensions across every web property, and report the requests per second,
+p50/p99 latency and peak RSS of each.
+
+Sample Application Usage:
+
+  $ python GoogleAnalyticsBenchmark.py
+
+"""
+
+import BaseHTTPServer
+import email.parser
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+from apiclient.discovery import build
+import httplib2
+
+import BenchmarkHarness
+import GoogleAnalyticsMgtApi
+
+# Path the stand-in serves the discovery document from.
+DISCOVERY_PATH = '/discovery/v1/apis/analytics/v3/rest'
+
+# Path of the Management API and of its batch endpoint on the stand-in.
+SERVICE_PATH = 'analytics/v3/'
+BATCH_PATH = 'batch/analytics/v3'
+
+# Max items the stand-in returns per page.
+DEFAULT_PAGE_LIMIT = 50
+
+# Queries per second given to the benchmark executor, so runs are not paced.
+UNLIMITED_QPS = 10.0 ** 9
+
+# Scopes the stand-in accepts for a custom dimension.
+DIMENSION_SCOPES = frozenset(['HIT', 'SESSION', 'USER', 'PRODUCT'])
+
+# Path of the custom dimensions collection of a web property.
+DIMENSIONS_PATH = ('management/accounts/{accountId}/webproperties/'
+                   '{webPropertyId}/customDimensions')
+
+# Desired custom dimensions of the reconcile runs, by index.
+RECONCILED_DIMENSIONS = {
+    1: {'name': 'benchmark', 'scope': 'HIT'},
+    2: {'name': 'benchmarkSession', 'scope': 'SESSION'},
+    3: {'name': 'benchmarkUser', 'scope': 'USER'},
+}
+
+# (resource, method, HTTP method, path) of the methods in the discovery
+# document.
+MANAGEMENT_METHODS = [
+    ('accounts', 'list', 'GET', 'management/accounts'),
+    ('webproperties', 'list', 'GET',
+     'management/accounts/{accountId}/webproperties'),
+    ('profiles', 'list', 'GET',
+     'management/accounts/{accountId}/webproperties/{webPropertyId}/profiles'),
+    ('segments', 'list', 'GET', 'management/segments'),
+    ('customDimensions', 'list', 'GET', DIMENSIONS_PATH),
+    ('customDimensions', 'insert', 'POST', DIMENSIONS_PATH),
+    ('customDimensions', 'update', 'PUT',
+     DIMENSIONS_PATH + '/{customDimensionId}'),
+    ('customDimensions', 'patch', 'PATCH',
+     DIMENSIONS_PATH + '/{customDimensionId}'),
+]
+
+
+def make_discovery_document(root_url):
+  """Builds the discovery document of the stand-in Management API.
+
+  Args:
+    root_url: str The root URL of the stand-in, ending with a slash.
+
+  Returns:
+    The discovery document, as a dictionary.
+  """
+  resources = {}
+  for resource, method, http_method, path in MANAGEMENT_METHODS:
+    path_parameters = re.findall(r'{(\w+)}', path)
+    parameters = dict((name, {'type': 'string', 'required': True,
+                              'location': 'path'})
+                      for name in path_parameters)
+    if method == 'list':
+      parameters['max-results'] = {'type': 'integer', 'location': 'query'}
+      parameters['start-index'] = {'type': 'integer', 'location': 'query'}
+    description = {
+        'id': 'analytics.management.%s.%s' % (resource, method),
+        'path': path, 'httpMethod': http_method, 'parameters': parameters,
+        'parameterOrder': path_parameters, 'response': {'$ref': 'Resource'}}
+    if http_method != 'GET':
+      description['request'] = {'$ref': 'Resource'}
+    resources.setdefault(resource, {'methods': {}})['methods'][method] = (
+        description)
+  return {
+      'kind': 'discovery#restDescription', 'discoveryVersion': 'v1',
+      'id': 'analytics:v3', 'name': 'analytics', 'version': 'v3',
+      'protocol': 'rest', 'rootUrl': root_url, 'servicePath': SERVICE_PATH,
+      'baseUrl': root_url + SERVICE_PATH, 'batchPath': BATCH_PATH,
+      'parameters': {'alt': {'type': 'string', 'default': 'json',
+                             'location': 'query'}},
+      'schemas': {'Resource': {'id': 'Resource', 'type': 'object',
+                               'additionalProperties': {'type': 'any'}}},
+      'resources': {'management': {'resources': resources}}}
+
+
+def account_item(index):
+  account_id = str(100000 + index)
+  return {'id': account_id, 'kind': 'analytics#account',
+          'name': 'Account %d' % index, 'created': '2017-01-01T00:00:00.000Z',
+          'updated': '2017-01-01T00:00:00.000Z',
+          'selfLink': 'management/accounts/%s' % account_id,
+          'childLink': {'href': 'management/accounts/%s/webproperties'
+                                % account_id,
+                        'type': 'analytics#webproperties'}}
+
+
+def webproperty_item(account_id, index):
+  web_property_id = 'UA-%s-%d' % (account_id, index + 1)
+  link = 'management/accounts/%s/webproperties/%s' % (account_id,
+                                                      web_property_id)
+  return {'id': web_property_id, 'kind': 'analytics#webproperty',
+          'accountId': account_id, 'internalWebPropertyId': str(index),
+          'websiteUrl': 'http://example.com/%d' % index,
+          'created': '2017-01-01T00:00:00.000Z',
+          'updated': '2017-01-01T00:00:00.000Z', 'selfLink': link,
+          'parentLink': {'href': 'management/accounts/%s' % account_id,
+                         'type': 'analytics#account'},
+          'childLink': {'href': link + '/profiles',
+                        'type': 'analytics#profiles'}}
+
+
+def profile_item(account_id, web_property_id, index):
+  link = 'management/accounts/%s/webproperties/%s' % (account_id,
+                                                      web_property_id)
+  return {'id': str(index), 'kind': 'analytics#profile',
+          'accountId': account_id, 'webPropertyId': web_property_id,
+          'internalWebPropertyId': '0', 'name': 'View %d' % index,
+          'currency': 'USD', 'timezone': 'Europe/Berlin', 'defaultPage': '',
+          'excludeQueryParameters': '', 'siteSearchCategoryParameters': '',
+          'siteSearchQueryParameters': '',
+          'created': '2017-01-01T00:00:00.000Z',
+          'updated': '2017-01-01T00:00:00.000Z',
+          'selfLink': '%s/profiles/%d' % (link, index),
+          'parentLink': {'href': link, 'type': 'analytics#webproperty'},
+          'childLink': {'href': '%s/profiles/%d/goals' % (link, index),
+                        'type': 'analytics#goals'}}
+
+
+def segment_item(index):
+  return {'id': str(index), 'kind': 'analytics#segment',
+          'name': 'Segment %d' % index,
+          'definition': 'sessions::condition::ga:browser==Chrome',
+          'created': '2017-01-01T00:00:00.000Z',
+          'updated': '2017-01-01T00:00:00.000Z',
+          'selfLink': 'management/segments/%d' % index}
+
+
+def error_response(status, reason, message):
+  return status, {'error': {'code': status, 'message': message,
+                            'errors': [{'reason': reason,
+                                        'message': message}]}}
+
+
+class StandInStats(object):
+  """Counts the HTTP requests and API calls seen by the stand-in."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.requests = 0
+      self.calls = 0
+
+  def count(self, name):
+    with self.lock:
+      value = getattr(self, name) + 1
+      setattr(self, name, value)
+      return value
+
+
+class StandInDimensions(object):
+  """Holds the custom dimensions written to the stand-in, by web property."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.properties = {}
+
+  def list(self, account_id, web_property_id):
+    with self.lock:
+      return [dict(dimension) for dimension in
+              self.properties.get((account_id, web_property_id), [])]
+
+  def insert(self, account_id, web_property_id, dimension):
+    """Adds a custom dimension at the next free index and returns it."""
+    with self.lock:
+      dimensions = self.properties.setdefault((account_id, web_property_id),
+                                              [])
+      index = len(dimensions) + 1
+      dimension = dict(dimension, id='ga:dimension%d' % index, index=index,
+                       accountId=account_id, webPropertyId=web_property_id,
+                       kind='analytics#customDimension')
+      dimension.setdefault('active', True)
+      dimensions.append(dimension)
+      return dict(dimension)
+
+  def update(self, account_id, web_property_id, dimension_id, fields):
+    """Sets fields of a custom dimension and returns it, or None if missing."""
+    with self.lock:
+      for dimension in self.properties.get((account_id, web_property_id), []):
+        if dimension['id'] == dimension_id:
+          dimension.update((field, value) for field, value in fields.items()
+                           if field not in ('id', 'index', 'kind'))
+          return dict(dimension)
+      return None
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers the Management API calls of the benchmarks.
+
+  The server gives the size of the hierarchy: its accounts, its
+  webproperties per account, its profiles per webproperty and its segments,
+  and holds the custom dimensions written to it.
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  # The status line and headers are written one by one; without this each
+  # response waits out the client's delayed ACK.
+  disable_nagle_algorithm = True
+
+  def do_GET(self):
+    self.handle_request()
+
+  def do_POST(self):
+    self.handle_request()
+
+  def do_PUT(self):
+    self.handle_request()
+
+  def do_PATCH(self):
+    self.handle_request()
+
+  def handle_request(self):
+    length = int(self.headers.getheader('Content-Length', 0))
+    body = self.rfile.read(length)
+    self.server.stats.count('requests')
+    if self.server.latency:
+      time.sleep(self.server.latency)
+
+    path = urlparse.urlsplit(self.path).path
+    if path == DISCOVERY_PATH:
+      root_url = 'http://%s:%d/' % self.server.server_address
+      self.send_body(200, json.dumps(make_discovery_document(root_url)))
+    elif path == '/' + BATCH_PATH:
+      self.send_batch(body)
+    else:
+      status, response = self.call(self.command, self.path, body)
+      self.send_body(status, json.dumps(response))
+
+  def call(self, method, uri, body):
+    """Answers one Management API call.
+
+    Args:
+      method: str The HTTP method.
+      uri: str The path and query of the call.
+      body: str The JSON body of the call.
+
+    Returns:
+      The (status, response object) of the call.
+    """
+    self.server.stats.count('calls')
+    parts = urlparse.urlsplit(uri)
+    path = [urllib.unquote(segment)
+            for segment in parts.path[len('/' + SERVICE_PATH):].split('/')]
+    query = dict(urlparse.parse_qsl(parts.query))
+    server = self.server
+
+    if method == 'GET' and path == ['management', 'accounts']:
+      return self.page(query, server.accounts, account_item)
+    if method == 'GET' and path == ['management', 'segments']:
+      return self.page(query, server.segments, segment_item)
+    if method == 'GET' and path[3:] == ['webproperties']:
+      return self.page(query, server.webproperties,
+                       lambda index: webproperty_item(path[2], index))
+    if method == 'GET' and path[5:] == ['profiles']:
+      return self.page(query, server.profiles,
+                       lambda index: profile_item(path[2], path[4], index))
+    if method == 'GET' and path[5:] == ['customDimensions']:
+      dimensions = server.dimensions.list(path[2], path[4])
+      return self.page(query, len(dimensions),
+                       lambda index: dimensions[index])
+    if path[5:6] == ['customDimensions'] and method != 'GET':
+      return self.write_dimension(method, path[2], path[4], path[6:], body)
+    return error_response(404, 'notFound', 'No such method: %s' % uri)
+
+  def page(self, query, total, make_item):
+    """Answers a list call with one page of a collection.
+
+    Args:
+      query: dict The query parameters of the call.
+      total: int The number of items of the collection.
+      make_item: callable Builds the item at an index of the collection.
+
+    Returns:
+      The (status, response object) of the call.
+    """
+    start_index = int(query.get('start-index', 1))
+    per_page = min(int(query.get('max-results', 1000)),
+                   self.server.page_limit)
+    stop = min(total, start_index - 1 + per_page)
+    response = {'items': [make_item(index)
+                          for index in xrange(start_index - 1, stop)],
+                'totalResults': total, 'itemsPerPage': per_page,
+                'startIndex': start_index}
+    if stop < total:
+      response['nextLink'] = 'start-index=%d' % (stop + 1)
+    if start_index > 1:
+      response['previousLink'] = 'start-index=%d' % max(
+          1, start_index - per_page)
+    return 200, response
+
+  def write_dimension(self, method, account_id, web_property_id,
+                      dimension_path, body):
+    """Answers a custom dimension insert or update.
+
+    Args:
+      method: str The HTTP method.
+      account_id: str The Account ID of the custom dimension.
+      web_property_id: str The Web property ID of the custom dimension.
+      dimension_path: list The path segments after customDimensions.
+      body: str The JSON body of the call.
+
+    Returns:
+      The (status, response object) of the call.
+    """
+    dimension = json.loads(body or '{}')
+    if 'scope' in dimension and dimension['scope'] not in DIMENSION_SCOPES:
+      return error_response(400, 'badRequest', 'Invalid scope.')
+    dimensions = self.server.dimensions
+    if method == 'POST':
+      if dimension_path or not dimension.get('name'):
+        return error_response(400, 'badRequest', 'A name is required.')
+      return 200, dimensions.insert(account_id, web_property_id, dimension)
+    if len(dimension_path) == 1:
+      dimension = dimensions.update(account_id, web_property_id,
+                                    dimension_path[0], dimension)
+      if dimension is not None:
+        return 200, dimension
+    return error_response(404, 'notFound', 'No such custom dimension.')
+
+  def send_batch(self, body):
+    """Answers a multipart batch request, making each of its calls."""
+    message = email.parser.Parser().parsestr(
+        'Content-Type: %s\r\n\r\n%s' % (self.headers.getheader('Content-Type'),
+                                        body))
+    boundary = 'batch_stand_in'
+    parts = []
+    for part in message.get_payload():
+      request_line, request = part.get_payload().split('\n', 1)
+      method, uri, _ = request_line.split(' ', 2)
+      call_body = re.split(r'\r?\n\r?\n', request, 1)[1]
+      status, response = self.call(method, uri, call_body)
+      content = json.dumps(response)
+      parts.append(
+          '--%s\r\nContent-Type: application/http\r\n'
+          'Content-ID: <response-%s>\r\n\r\n'
+          'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+          'Content-Length: %d\r\n\r\n%s\r\n' % (
+              boundary, part['Content-ID'][1:-1], status,
+              self.responses[status][0], len(content), content))
+    self.send_body(200, ''.join(parts) + '--%s--\r\n' % boundary,
+                   'multipart/mixed; boundary=%s' % boundary)
+
+  def send_body(self, status, body, content_type='application/json'):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def start_stand_in(accounts=5, webproperties=20, profiles=10, segments=100,
+                   page_limit=DEFAULT_PAGE_LIMIT, latency=0.002):
+  """Starts the stand-in Management API on a free local port.
+
+  Args:
+    accounts: int The number of accounts.
+    webproperties: int The number of web properties of each account.
+    profiles: int The number of profiles of each web property.
+    segments: int The number of segments.
+    page_limit: int The max number of items per page.
+    latency: float Seconds the stand-in waits before answering each request.
+
+  Returns:
+    The running server. Its stats attribute counts requests and calls, and
+    its dimensions attribute holds the custom dimensions written to it.
+  """
+  return BenchmarkHarness.start_server(
+      StandInHandler, stats=StandInStats(), dimensions=StandInDimensions(),
+      accounts=accounts,
+      webproperties=webproperties, profiles=profiles, segments=segments,
+      page_limit=page_limit, latency=latency)
+
+
+class TimedHttp(object):
+  """An Http object recording the latency of every request it sends.
+
+  Args:
+    recorder: LatencyRecorder The recorder of the latencies.
+  """
+
+  def __init__(self, recorder):
+    self.http = httplib2.Http()
+    self.recorder = recorder
+
+  def request(self, *args, **kwargs):
+    start = time.time()
+    try:
+      return self.http.request(*args, **kwargs)
+    finally:
+      self.recorder.record(time.time() - start)
+
+  def __getattr__(self, name):
+    return getattr(self.http, name)
+
+
+def build_service(server, recorder):
+  """Builds the service from the discovery document of the stand-in.
+
+  Args:
+    server: The running stand-in.
+    recorder: LatencyRecorder The recorder of the request latencies.
+
+  Returns:
+    The service object, and a factory of Http objects for worker threads.
+  """
+  # Pace nothing, so the runs measure the client rather than the quota.
+  GoogleAnalyticsMgtApi.get_default_executor().interval = 1.0 / UNLIMITED_QPS
+  discovery_url = 'http://%s:%d%s' % (server.server_address + (DISCOVERY_PATH,))
+  service = build('analytics', 'v3', http=TimedHttp(recorder),
+                  discoveryServiceUrl=discovery_url, cache_discovery=False)
+  return service, lambda: TimedHttp(recorder)
+
+
+def list_properties(server):
+  """Gets the (account_id, web_property_id) of every stand-in web property."""
+  properties = []
+  for account_index in xrange(server.accounts):
+    account_id = account_item(account_index)['id']
+    for index in xrange(server.webproperties):
+      properties.append(
+          (account_id, webproperty_item(account_id, index)['id']))
+  return properties
+
+
+def run_print_results(server, concurrency):
+  """Builds the service and prints the whole hierarchy, discarding the output."""
+  recorder = BenchmarkHarness.LatencyRecorder()
+  start = time.time()
+  service, http_factory = build_service(server, recorder)
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    GoogleAnalyticsMgtApi.print_results(service, concurrency, http_factory)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  BenchmarkHarness.print_load_run(
+      'print_results', recorder, time.time() - start,
+      profiles=server.accounts * server.webproperties * server.profiles)
+
+
+def create_and_update_dimension(service, account_id, web_property_id):
+  """Creates a custom dimension with one call, then renames it with another."""
+  GoogleAnalyticsMgtApi.create_dimension(
+      service, account_id, web_property_id, 'benchmark', 'HIT')
+  GoogleAnalyticsMgtApi.update_dimension(
+      service, account_id, web_property_id, 'ga:dimension1', 'name',
+      'benchmarkA')
+
+
+def reconcile_property(service, account_id, web_property_id):
+  """Reconciles the custom dimensions of a web property to the benchmark ones.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    account_id: str The Account ID of the custom dimensions.
+    web_property_id: str The Web property ID of the custom dimensions.
+
+  Returns:
+    The plan, as returned by plan_dimensions.
+  """
+  return GoogleAnalyticsMgtApi.reconcile_dimensions(
+      service, account_id, web_property_id, RECONCILED_DIMENSIONS)
+
+
+def run_dimensions(server, function, max_in_flight):
+  """Runs a custom dimension function across every stand-in web property.
+
+  What the function prints is discarded; its failures are counted instead.
+  """
+  recorder = BenchmarkHarness.LatencyRecorder()
+  service, http_factory = build_service(server, recorder)
+  properties = list_properties(server)
+  start = time.time()
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    results = GoogleAnalyticsMgtApi.map_properties(
+        service, function, properties, max_in_flight, http_factory)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+  BenchmarkHarness.print_load_run(
+      function.__name__, recorder, time.time() - start,
+      web_properties=len(properties),
+      failed=sum(1 for result in results if result[3] is not None))
+
+
+def bench_management_api(concurrency=GoogleAnalyticsMgtApi.DEFAULT_CONCURRENCY,
+                         **settings):
+  """Drives print_results and the custom dimension functions against the stand-in.
+
+  Each run is made in its own process, so its peak RSS is its own. The stand-in
+  keeps the custom dimensions written by each run. reconcile_dimensions runs
+  twice, first against web properties without dimensions, then against up to
+  date ones, where it only lists them.
+
+  Args:
+    concurrency: int The max number of calls or properties in flight.
+    **settings: The arguments of start_stand_in.
+  """
+  server = start_stand_in(**settings)
+  runs = [(run_print_results, (server, concurrency)),
+          (run_dimensions, (server, reconcile_property, concurrency)),
+          (run_dimensions, (server, reconcile_property, concurrency)),
+          (run_dimensions, (server, GoogleAnalyticsMgtApi.provision_property,
+                            concurrency)),
+          (run_dimensions, (server, create_and_update_dimension,
+                            concurrency))]
+  for function, args in runs:
+    server.stats.reset()
+    BenchmarkHarness.run_isolated(function, *args)
+    print 'Stand-in: %d requests, %d calls' % (server.stats.requests,
+                                               server.stats.calls)
+    print
+  server.stop()
+
+
+def main():
+  bench_management_api()
+
+if __name__ == '__main__':
+  main()
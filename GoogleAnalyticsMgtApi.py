@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """This application demonstrates a use case with tasks on Working with Google Analytics Management API using Python.
 
 # predefinition1: You must have signed up for a new project in the Google APIs console:
@@ -23,16 +24,682 @@ Sample Application Usage:
 """
 
 import argparse
+import collections
+import csv
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+import urlparse
 
 from apiclient.discovery import build
+from apiclient.discovery import build_from_document
+from apiclient.discovery import DISCOVERY_URI
+from apiclient.errors import HttpError
 import httplib2
 from oauth2client import client
 from oauth2client import file
 from oauth2client import tools
-from urllib2 import HTTPError
 
+import ApiMetrics
+
+# pyarrow is only needed to export to Parquet.
+try:
+  import pyarrow
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+# Latency, size and retry metrics of the calls, exported by ApiMetrics.
+metrics = ApiMetrics.get_default_registry()
+
+# The max number of calls the Management API accepts in one batch request.
+MAX_BATCH_REQUESTS = 30
+
+# Items requested per page of a Management API collection.
+DEFAULT_PAGE_SIZE = 1000
+
+# Default number of listing calls in flight, kept under the Management API
+# limit of 10 queries per second per user.
+DEFAULT_CONCURRENCY = 4
+
+# How many pages, per worker, an export fetches before writing them.
+PAGES_PER_WORKER = 2
+
+# Rows buffered per Parquet row group.
+PARQUET_ROW_GROUP_SIZE = 10000
+
+# Flat export columns of each collection, and the resource field path of each.
+ACCOUNT_COLUMNS = [
+    ('account_id', ('id',)),
+    ('kind', ('kind',)),
+    ('self_link', ('selfLink',)),
+    ('account_name', ('name',)),
+    ('created', ('created',)),
+    ('updated', ('updated',)),
+    ('child_link_href', ('childLink', 'href')),
+    ('child_link_type', ('childLink', 'type')),
+]
+WEBPROPERTY_COLUMNS = [
+    ('kind', ('kind',)),
+    ('account_id', ('accountId',)),
+    ('web_property_id', ('id',)),
+    ('internal_web_property_id', ('internalWebPropertyId',)),
+    ('web_property_name', ('name',)),
+    ('website_url', ('websiteUrl',)),
+    ('created', ('created',)),
+    ('updated', ('updated',)),
+    ('self_link', ('selfLink',)),
+    ('parent_link_href', ('parentLink', 'href')),
+    ('parent_link_type', ('parentLink', 'type')),
+    ('child_link_href', ('childLink', 'href')),
+    ('child_link_type', ('childLink', 'type')),
+]
+PROFILE_COLUMNS = [
+    ('kind', ('kind',)),
+    ('account_id', ('accountId',)),
+    ('web_property_id', ('webPropertyId',)),
+    ('internal_web_property_id', ('internalWebPropertyId',)),
+    ('profile_id', ('id',)),
+    ('profile_name', ('name',)),
+    ('currency', ('currency',)),
+    ('timezone', ('timezone',)),
+    ('default_page', ('defaultPage',)),
+    ('exclude_query_parameters', ('excludeQueryParameters',)),
+    ('site_search_category_parameters', ('siteSearchCategoryParameters',)),
+    ('site_search_query_parameters', ('siteSearchQueryParameters',)),
+    ('created', ('created',)),
+    ('updated', ('updated',)),
+    ('self_link', ('selfLink',)),
+    ('parent_link_href', ('parentLink', 'href')),
+    ('parent_link_type', ('parentLink', 'type')),
+    ('child_link_href', ('childLink', 'href')),
+    ('child_link_type', ('childLink', 'type')),
+]
+
+# The Http object of each traversal worker thread.
+_thread_state = threading.local()
+
+# Default seconds a cached Management API response is used without asking the
+# API whether it changed.
+DEFAULT_CACHE_TTL = 3600
+
+# Path main caches the Management API responses at, between runs.
+CACHE_PATH = 'analytics_cache.db'
+
+# Path segment of the Management API calls whose responses are cached.
+MANAGEMENT_PATH = '/management/'
+
+# Request line of each call in the body of a batch request.
+BATCH_REQUEST_LINE = re.compile(
+    r'^(GET|POST|PUT|PATCH|DELETE) (/\S*) HTTP/\d\.\d\r?$', re.M)
+
+# Default pace of the Management API calls, under its limit of 10 queries per
+# second per user.
+DEFAULT_QPS = 8.0
+
+# Default number of times a throttled or failed call is made again.
+DEFAULT_MAX_RETRIES = 5
+
+# Bounds, in seconds, of the exponential backoff between retries.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 64.0
+
+# Reasons of the 403 errors the API answers when it is called too fast, as
+# opposed to a lack of permission or an exhausted daily quota.
+RATE_LIMIT_REASONS = frozenset(
+    ['userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded'])
+
+# Default seconds a cached discovery document is used before it is fetched again.
+DEFAULT_DISCOVERY_TTL = 24 * 3600
+
+# Path main caches the discovery document of the Analytics API at.
+DISCOVERY_PATH = 'analytics_v3_discovery.json'
+
+# Authorized Http objects of this process, by (api_name, client secrets, scope).
+_authorized_http = {}
+_authorized_http_lock = threading.Lock()
+
+# Discovery documents read by this process, by path.
+_discovery_documents = {}
+_discovery_documents_lock = threading.Lock()
+
+# Table holding the cached Management API responses.
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache
+(
+  uri text PRIMARY KEY,
+  etag text,
+  content blob,
+  fetched_at real
+)
+"""
+
+
+class MetadataCache(object):
+  """Persists Management API responses by request URI.
+
+  A response younger than the TTL is used as it is. An older one is revalidated
+  with its ETag: the API answers 304 Not Modified if the collection did not
+  change, which costs a round trip but no transfer of the collection.
+
+  Args:
+    path: str The path of the SQLite database file holding the responses.
+    ttl: float Seconds a response is used without being revalidated.
+  """
+
+  def __init__(self, path, ttl=DEFAULT_CACHE_TTL):
+    self.ttl = ttl
+    self.connection = sqlite3.connect(path, check_same_thread=False)
+    self.connection.execute(CACHE_SCHEMA)
+    self.connection.commit()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.revalidated = 0
+    self.misses = 0
+
+  def get(self, uri):
+    """Gets a cached response.
+
+    Args:
+      uri: str The request URI.
+
+    Returns:
+      The (etag, content, fetched_at) of the response, or None if not cached.
+    """
+    with self.lock:
+      row = self.connection.execute(
+          'SELECT etag, content, fetched_at FROM response_cache WHERE uri = ?',
+          (uri,)).fetchone()
+    if row is None:
+      return None
+    etag, content, fetched_at = row
+    return etag, str(content), fetched_at
+
+  def set(self, uri, etag, content):
+    """Stores a response, or marks a revalidated one as fresh again.
+
+    Args:
+      uri: str The request URI.
+      etag: str The ETag of the response.
+      content: str The response body.
+    """
+    with self.lock:
+      self.connection.execute(
+          'INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)',
+          (uri, etag, sqlite3.Binary(content), time.time()))
+      self.connection.commit()
+
+  def invalidate(self, prefix=''):
+    """Drops the responses of the URIs starting with a prefix.
+
+    Args:
+      prefix: str The URI prefix, or '' to drop every response.
+    """
+    with self.lock:
+      self.connection.execute(
+          'DELETE FROM response_cache WHERE substr(uri, 1, ?) = ?',
+          (len(prefix), prefix))
+      self.connection.commit()
+
+  def expire(self, prefix=''):
+    """Makes the responses of the URIs starting with a prefix stale.
+
+    They are kept with their ETag, so the next read revalidates them instead
+    of being answered from the cache.
+
+    Args:
+      prefix: str The URI prefix, or '' to expire every response.
+    """
+    with self.lock:
+      self.connection.execute(
+          'UPDATE response_cache SET fetched_at = 0 '
+          'WHERE substr(uri, 1, ?) = ?', (len(prefix), prefix))
+      self.connection.commit()
+
+  def count(self, outcome):
+    with self.lock:
+      setattr(self, outcome, getattr(self, outcome) + 1)
+
+  def stats(self):
+    """Gets the hit and miss counters.
+
+    Returns:
+      A dictionary with the number of fresh 'hits', the number of responses
+      'revalidated' with a 304, and the number of 'misses' fetched in full.
+    """
+    with self.lock:
+      return {'hits': self.hits, 'revalidated': self.revalidated,
+              'misses': self.misses}
+
+  def close(self):
+    self.connection.close()
+
+
+class CachingHttp(object):
+  """Wraps an Http object to answer Management API reads from a MetadataCache.
+
+  GET requests under MANAGEMENT_PATH are cached. Any other request to the
+  Management API drops the cached responses of the collection it writes to,
+  and a batch request those of the collections its calls write to. Any other
+  write whose calls cannot be read drops them all.
+
+  Args:
+    http: The authorized Http object sending the requests.
+    cache: MetadataCache The cache of the responses.
+  """
+
+  def __init__(self, http, cache):
+    self.http = http
+    self.cache = cache
+
+  def request(self, uri, method='GET', body=None, headers=None, *args,
+              **kwargs):
+    if MANAGEMENT_PATH not in uri:
+      if method != 'GET':
+        self.invalidate_batch(uri, body)
+      return self.http.request(uri, method, body, headers, *args, **kwargs)
+    if method != 'GET':
+      self.invalidate_collection(uri, method)
+      return self.http.request(uri, method, body, headers, *args, **kwargs)
+
+    cached = self.cache.get(uri)
+    headers = dict(headers or {})
+    if cached is not None:
+      etag, content, fetched_at = cached
+      if time.time() - fetched_at < self.cache.ttl:
+        self.cache.count('hits')
+        return httplib2.Response({'status': '200', 'etag': etag}), content
+      if etag:
+        headers['if-none-match'] = etag
+
+    response, content = self.http.request(uri, method, body, headers, *args,
+                                          **kwargs)
+    if response.status == 304 and cached is not None:
+      self.cache.count('revalidated')
+      self.cache.set(uri, etag, cached[1])
+      return httplib2.Response({'status': '200', 'etag': etag}), cached[1]
+    self.cache.count('misses')
+    if response.status == 200:
+      self.cache.set(uri, response.get('etag'), content)
+    return response, content
+
+  def is_fresh(self, uri):
+    """Checks whether a GET of the URI would be answered from the cache."""
+    cached = self.cache.get(uri)
+    return cached is not None and time.time() - cached[2] < self.cache.ttl
+
+  def invalidate_collection(self, uri, method):
+    """Drops the cached responses of the collection a write goes to."""
+    parts = urlparse.urlsplit(uri)
+    path = parts.path
+    if method != 'POST':
+      # Updates and deletes name the resource; its collection is the parent.
+      path = path.rsplit('/', 1)[0]
+    self.cache.invalidate('%s://%s%s' % (parts.scheme, parts.netloc, path))
+
+  def invalidate_batch(self, uri, body):
+    """Drops the cached responses of the collections a batch writes to.
+
+    The calls are read from the request lines of the batch body. If none is
+    found, the request is not a known batch and every response is dropped.
+    """
+    calls = BATCH_REQUEST_LINE.findall(body or '')
+    if not calls:
+      self.cache.invalidate()
+      return
+    parts = urlparse.urlsplit(uri)
+    for method, path in calls:
+      if method != 'GET':
+        self.invalidate_collection(
+            '%s://%s%s' % (parts.scheme, parts.netloc, path), method)
+
+  def expire_collection(self, uri):
+    """Makes the next reads of every page of a collection revalidate."""
+    parts = urlparse.urlsplit(uri)
+    self.cache.expire('%s://%s%s' % (parts.scheme, parts.netloc, parts.path))
+
+  def __getattr__(self, name):
+    return getattr(self.http, name)
+
+
+def error_reason(error):
+  """Gets the reason given in the body of an HttpError.
+
+  Args:
+    error: HttpError The error.
+
+  Returns:
+    The reason of the first error listed, or None if there is none.
+  """
+  try:
+    errors = json.loads(error.content)['error']['errors']
+    return errors[0]['reason']
+  except (ValueError, TypeError, KeyError, IndexError):
+    return None
+
+
+def is_retryable(error):
+  """Checks whether a failed call is worth making again.
+
+  Args:
+    error: Exception The error raised by the call.
+
+  Returns:
+    True for rate limit errors (429, or 403 with a rate limit reason), server
+    errors (5xx), timeouts and dropped connections.
+  """
+  if isinstance(error, HttpError):
+    status = error.resp.status
+    if status == 429 or status >= 500:
+      return True
+    return status == 403 and error_reason(error) in RATE_LIMIT_REASONS
+  return isinstance(error, socket.error)
+
+
+def is_rate_limited(error):
+  """Checks whether a call failed because the API was called too fast."""
+  return isinstance(error, HttpError) and (
+      error.resp.status == 429 or error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def served_from_cache(request, http=None):
+  """Checks whether a call would be answered by a CachingHttp without a request."""
+  http = http or getattr(request, 'http', None)
+  return (isinstance(http, CachingHttp) and request.method == 'GET' and
+          http.is_fresh(request.uri))
+
+
+def count_received(request, method):
+  """Counts the response bytes of a call as its response is deserialized."""
+  postproc = request.postproc
+
+  def count(response, content):
+    metrics.counter('ga_bytes_received_total', len(content or ''),
+                    method=method)
+    return postproc(response, content)
+
+  request.postproc = count
+
+
+class ApiExecutor(object):
+  """Executes every Management API call, pacing it and retrying failures.
+
+  Calls are spaced to stay under qps queries per second across all threads; a
+  batch request counts once per call it holds. A call that fails with a rate
+  limit, server or connection error is made again after a jittered exponential
+  backoff, and a rate limit error also holds back every other call for that
+  time. The latency, calls and retries of each API method are recorded, and
+  also exported through ApiMetrics.
 
-def get_service(api_name, api_version, scope, client_secrets_path):
+  Args:
+    qps: float The max number of queries per second.
+    max_retries: int The number of times a call is made again before its error
+      is raised.
+  """
+
+  def __init__(self, qps=DEFAULT_QPS, max_retries=DEFAULT_MAX_RETRIES):
+    self.interval = 1.0 / qps
+    self.max_retries = max_retries
+    self.next_slot = 0.0
+    self.lock = threading.Lock()
+    self.methods = {}
+
+  def pace(self, cost=1):
+    """Blocks until the next cost query slots are free, and takes them."""
+    with self.lock:
+      now = time.time()
+      slot = max(now, self.next_slot)
+      self.next_slot = slot + cost * self.interval
+    if slot > now:
+      time.sleep(slot - now)
+    metrics.observe('ga_throttle_wait_seconds', max(0.0, slot - now))
+
+  def hold(self, seconds):
+    """Holds back every call for some time."""
+    with self.lock:
+      self.next_slot = max(self.next_slot, time.time() + seconds)
+
+  def backoff(self, attempt):
+    """Gets a jittered exponential backoff delay.
+
+    Args:
+      attempt: int The number of retries already made.
+
+    Returns:
+      The delay in seconds.
+    """
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(
+        0.5, 1.0)
+
+  def wait(self, error, attempt):
+    """Sleeps before a retry, holding back every call if rate limited."""
+    delay = self.backoff(attempt)
+    if is_rate_limited(error):
+      self.hold(delay)
+    time.sleep(delay)
+
+  def record(self, method, seconds, retried=False, failed=False):
+    metrics.observe('ga_api_call_seconds', seconds, method=method)
+    if retried:
+      metrics.counter('ga_retries_total', method=method)
+    elif failed:
+      metrics.counter('ga_failures_total', method=method)
+    with self.lock:
+      stats = self.methods.get(method)
+      if stats is None:
+        stats = self.methods[method] = {
+            'calls': 0, 'retries': 0, 'failures': 0, 'seconds': 0.0,
+            'max_seconds': 0.0}
+      if retried:
+        stats['retries'] += 1
+      else:
+        stats['calls'] += 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        if failed:
+          stats['failures'] += 1
+
+  def execute(self, request, http=None, cost=1, max_retries=None):
+    """Executes a call, retrying it while it fails with a retryable error.
+
+    Args:
+      request: The unexecuted HttpRequest or BatchHttpRequest.
+      http: The Http object to send the request with. Defaults to the one of
+        the request.
+      cost: int The number of queries the call counts as.
+      max_retries: int The number of times the call is made again. Defaults to
+        the max_retries of the executor.
+
+    Returns:
+      The deserialized response of the call.
+
+    Raises:
+      HttpError: If the call still fails after max_retries retries, or fails
+        with an error that is not retryable.
+    """
+    method = getattr(request, 'methodId', None) or 'batch'
+    if method == 'batch':
+      metrics.observe('ga_batch_calls', cost, buckets=ApiMetrics.SIZE_BUCKETS)
+    else:
+      count_received(request, method)
+    body = getattr(request, 'body', None)
+    if max_retries is None:
+      max_retries = self.max_retries
+    attempt = 0
+    while True:
+      if not served_from_cache(request, http):
+        self.pace(cost)
+      if body:
+        metrics.counter('ga_bytes_sent_total', len(body), method=method)
+      start = time.time()
+      try:
+        with metrics.in_flight('ga_calls_in_flight'):
+          response = request.execute(http=http)
+      except Exception, error:
+        if attempt >= max_retries or not is_retryable(error):
+          self.record(method, time.time() - start, failed=True)
+          raise
+      else:
+        self.record(method, time.time() - start)
+        return response
+      self.record(method, time.time() - start, retried=True)
+      self.wait(error, attempt)
+      attempt += 1
+
+  def stats(self):
+    """Gets the recorded stats of each API method.
+
+    Returns:
+      A dictionary of the 'calls', 'retries', 'failures', total 'seconds' and
+      'max_seconds' latency of each API method, by method id.
+    """
+    with self.lock:
+      return dict((method, dict(stats))
+                  for method, stats in self.methods.items())
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def get_default_executor():
+  """Gets the executor shared by calls that are not given one.
+
+  Returns:
+    The module wide ApiExecutor, created on first use.
+  """
+  global _default_executor
+  with _default_executor_lock:
+    if _default_executor is None:
+      _default_executor = ApiExecutor()
+    return _default_executor
+
+
+def print_executor_stats(executor=None):
+  """Prints the latency and retries of each API method.
+
+  Args:
+    executor: ApiExecutor The executor the calls were made with. Defaults to
+      the shared executor.
+  """
+  executor = executor or get_default_executor()
+  print '------ API Calls -------'
+  for method, stats in sorted(executor.stats().items()):
+    mean = stats['seconds'] / stats['calls'] if stats['calls'] else 0.0
+    print ('%-45s calls = %d retries = %d failures = %d mean = %.0fms '
+           'max = %.0fms' % (method, stats['calls'], stats['retries'],
+                             stats['failures'], mean * 1000,
+                             stats['max_seconds'] * 1000))
+  print
+
+
+def get_authorized_http(api_name, scope, client_secrets_path):
+  """Gets an Http object authorized with the stored credentials.
+
+  The credentials are read, and the Http object built, once per process; the
+  argument parser and the Flow object are only built if the native client flow
+  has to run.
+
+  Args:
+    api_name: string The name of the api to connect to.
+    scope: A list of strings representing the auth scopes to authorize for the
+      connection.
+    client_secrets_path: string A path to a valid client secrets file.
+
+  Returns:
+    The authorized Http object.
+  """
+  key = (api_name, client_secrets_path, tuple(scope))
+  with _authorized_http_lock:
+    http = _authorized_http.get(key)
+    if http is not None:
+      return http
+
+    # Prepare credentials, and authorize HTTP object with them.
+    # If the credentials don't exist or are invalid run through the native client
+    # flow. The Storage object will ensure that if successful the good
+    # credentials will get written back to a file.
+    storage = file.Storage(api_name + '.dat')
+    credentials = storage.get()
+    if credentials is None or credentials.invalid:
+      # Parse command-line arguments.
+      parser = argparse.ArgumentParser(
+          formatter_class=argparse.RawDescriptionHelpFormatter,
+          parents=[tools.argparser])
+      flags = parser.parse_args([])
+
+      # Set up a Flow object to be used if we need to authenticate.
+      flow = client.flow_from_clientsecrets(
+          client_secrets_path, scope=scope,
+          message=tools.message_if_missing(client_secrets_path))
+      credentials = tools.run_flow(flow, storage, flags)
+    http = _authorized_http[key] = credentials.authorize(http=httplib2.Http())
+    return http
+
+
+def get_discovery_document(api_name, api_version, discovery_path,
+                           ttl=DEFAULT_DISCOVERY_TTL):
+  """Gets a discovery document from a local copy, fetching it when needed.
+
+  The document is fetched when the copy is missing or older than the TTL, and
+  kept in memory for the rest of the process. If it cannot be fetched, an
+  outdated copy is still used.
+
+  Args:
+    api_name: string The name of the api.
+    api_version: string The api version.
+    discovery_path: str The path of the local copy.
+    ttl: float Seconds the local copy is used before it is fetched again.
+
+  Returns:
+    The discovery document, as a JSON string.
+
+  Raises:
+    HttpError: If the API answers with an error and there is no local copy.
+    httplib2.HttpLib2Error, socket.error: If the API cannot be reached and
+      there is no local copy.
+  """
+  with _discovery_documents_lock:
+    document = _discovery_documents.get(discovery_path)
+    if document is not None:
+      return document
+
+    try:
+      age = time.time() - os.path.getmtime(discovery_path)
+    except OSError:
+      age = None
+    if age is None or age > ttl:
+      uri = DISCOVERY_URI.format(api=api_name, apiVersion=api_version)
+      try:
+        response, content = httplib2.Http().request(uri)
+      except (httplib2.HttpLib2Error, socket.error):
+        # The API cannot be reached, so an outdated copy is still used.
+        if age is None:
+          raise
+      else:
+        if response.status == 200:
+          # Write a new copy and move it over the old one, so a concurrent
+          # reader never sees half a document.
+          partial_path = '%s.%d' % (discovery_path, os.getpid())
+          with open(partial_path, 'wb') as partial:
+            partial.write(content)
+          os.rename(partial_path, discovery_path)
+        elif age is None:
+          raise HttpError(response, content, uri=uri)
+
+    with open(discovery_path, 'rb') as cached:
+      document = _discovery_documents[discovery_path] = cached.read()
+    return document
+
+
+def get_service(api_name, api_version, scope, client_secrets_path, cache=None,
+                discovery_path=None):
   """Get a service that communicates to a Google API.
 
   Args:
@@ -41,35 +708,154 @@ def get_service(api_name, api_version, scope, client_secrets_path):
     scope: A list of strings representing the auth scopes to authorize for the
       connection.
     client_secrets_path: string A path to a valid client secrets file.
+    cache: MetadataCache The cache answering the Management API reads, if any.
+    discovery_path: str The path of a local copy of the discovery document to
+      build the service from, instead of fetching the document on every call.
 
   Returns:
     A service that is connected to the specified API.
   """
-  # Parse command-line arguments.
-  parser = argparse.ArgumentParser(
-      formatter_class=argparse.RawDescriptionHelpFormatter,
-      parents=[tools.argparser])
-  flags = parser.parse_args([])
-
-  # Set up a Flow object to be used if we need to authenticate.
-  flow = client.flow_from_clientsecrets(
-      client_secrets_path, scope=scope,
-      message=tools.message_if_missing(client_secrets_path))
-
-  # Prepare credentials, and authorize HTTP object with them.
-  # If the credentials don't exist or are invalid run through the native client
-  # flow. The Storage object will ensure that if successful the good
-  # credentials will get written back to a file.
-  storage = file.Storage(api_name + '.dat')
-  credentials = storage.get()
-  if credentials is None or credentials.invalid:
-    credentials = tools.run_flow(flow, storage, flags)
-  http = credentials.authorize(http=httplib2.Http())
+  with metrics.timer('ga_get_service_seconds', stage='authorize'):
+    http = get_authorized_http(api_name, scope, client_secrets_path)
+  if cache is not None:
+    http = CachingHttp(http, cache)
 
   # Build the service object.
-  service = build(api_name, api_version, http=http)
+  with metrics.timer('ga_get_service_seconds', stage='build'):
+    if discovery_path is None:
+      return build(api_name, api_version, http=http)
+    document = get_discovery_document(api_name, api_version, discovery_path)
+    return build_from_document(document, http=http)
 
-  return service
+
+def report_batch_result(request_id, response, exception):
+  """Prints the outcome of a call that failed in a batch request.
+
+  Args:
+    request_id: str The id the call was added to the batch with.
+    response: dict The deserialized response of the call.
+    exception: HttpError The error of the call, or None if it succeeded.
+  """
+  if exception is None:
+    return
+  if isinstance(exception, HttpError):
+    print ('There was an API error for %s : %s : %s' %
+           (request_id, exception.resp.status, exception.resp.reason))
+  else:
+    print 'There was an error for %s : %s' % (request_id, exception)
+
+
+def execute_batch(service, requests, callback=report_batch_result,
+                  max_batch_requests=MAX_BATCH_REQUESTS, executor=None):
+  """Executes API calls grouped into multipart batch requests.
+
+  Each call still succeeds or fails on its own: the callback is called once per
+  call with its response or its error. Calls failing with a retryable error are
+  batched again after a backoff, up to the executor's max_retries. Retries are
+  only made here: the executor sends each batch request once, and if it fails,
+  with an HttpError or any other error, every call of the batch fails with
+  that error and is retried or reported like the others.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    requests: iterable (request_id, request) tuples of unexecuted API calls.
+    callback: callable Called with the request_id, response and exception of
+      every call.
+    max_batch_requests: int The max number of calls per batch request.
+    executor: ApiExecutor The executor pacing and retrying the batch requests.
+      Defaults to the shared executor.
+
+  Returns:
+    A dictionary of the (response, exception) of each call, by request_id.
+  """
+  executor = executor or get_default_executor()
+  results = {}
+  pending = list(requests)
+  attempt = 0
+  while pending:
+    retry = []
+    for start in range(0, len(pending), max_batch_requests):
+      chunk = pending[start:start + max_batch_requests]
+      outcomes = {}
+
+      def collect(request_id, response, exception):
+        outcomes[request_id] = (response, exception)
+
+      batch = service.new_batch_http_request(callback=collect)
+      for request_id, request in chunk:
+        batch.add(request, request_id=request_id)
+      try:
+        executor.execute(batch, cost=len(chunk), max_retries=0)
+      except Exception, error:
+        # The batch request itself failed, so the calls not answered yet
+        # fail with its error.
+        for request_id, _ in chunk:
+          outcomes.setdefault(request_id, (None, error))
+
+      for request_id, request in chunk:
+        response, exception = outcomes[request_id]
+        if (exception is not None and attempt < executor.max_retries and
+            is_retryable(exception)):
+          retry.append((request_id, request))
+          retry_error = exception
+          continue
+        results[request_id] = (response, exception)
+        callback(request_id, response, exception)
+
+    if retry:
+      executor.wait(retry_error, attempt)
+      attempt += 1
+    pending = retry
+  return results
+
+
+def insert_dimension_request(service, account_id, web_property_id, name, scope,
+                             active=True):
+  """Builds the API call creating a custom dimension, without executing it.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    account_id: str The Account ID for the custom dimension to create.
+    web_property_id: str The Web property ID for the custom dimension to create.
+    name: str The name of the custom dimension.
+    scope: str The scope of the custom dimension: HIT, SESSION, USER or PRODUCT.
+    active: bool Whether the custom dimension is active.
+
+  Returns:
+    The unexecuted HttpRequest.
+  """
+  dimension_body = {
+    'name': name,
+    'scope': scope,
+    'active': active
+  }
+  return service.management().customDimensions().insert(
+    accountId=account_id,
+    webPropertyId=web_property_id,
+    body=dimension_body
+  )
+
+
+def update_dimension_request(service, account_id, web_property_id, dimension_id,
+                             field, value):
+  """Builds the API call updating a custom dimension field, without executing it.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    account_id: str The Account ID for the custom dimension to update.
+    web_property_id: str The Web property ID for the custom dimension to update.
+    dimension_id: str The ID of the custom dimension to update.
+    field: str The custom dimension field to be updated.
+    value: The new value to be updated.
+
+  Returns:
+    The unexecuted HttpRequest.
+  """
+  return service.management().customDimensions().update(
+    accountId=account_id,
+    webPropertyId=web_property_id,
+    customDimensionId=dimension_id,
+    body={field: value})
 
 
 def create_dimension(service, account_id, web_property_id, name, scope, active=True):
@@ -84,22 +870,14 @@ def create_dimension(service, account_id, web_property_id, name, scope, active=T
     active: bool Boolean indicating whether the custom dimension is active. Default value is True.
   """
   try:
-    dimension_body={
-      'name': name,
-      'scope': scope,
-      'active': active
-    }   
-    service.management().customDimensions().insert(
-      accountId=account_id,
-      webPropertyId=web_property_id,
-      body=dimension_body
-    ).execute()
+    get_default_executor().execute(insert_dimension_request(
+      service, account_id, web_property_id, name, scope, active))
 
   except TypeError, error:
     # Handle errors in constructing a query.
     print 'There was an error in constructing your query : %s' % error
 
-  except HTTPError, error:
+  except HttpError, error:
     # Handle API errors.
     print ('There was an API error : %s : %s' %
            (error.resp.status, error.resp.reason))
@@ -107,14 +885,34 @@ def create_dimension(service, account_id, web_property_id, name, scope, active=T
 def create_dimensions(service, account_id, web_property_id):
   """Creates 10 custom session dimensions ('dimension1'...'dimension10').
 
+  The inserts are sent one after the other, not batched: the API gives each new
+  dimension the next free index, and a batch request does not keep the order
+  of its calls, so 'dimension3' could become ga:dimension1 and the updates by
+  index would then change the wrong dimensions.
+
   Args:
     service: The service object built by the Google API Python client library.
     account_id: str The Account ID for the custom dimension to update.
     web_property_id: str The Web property ID for the custom dimension to create.    
+
+  Returns:
+    A dictionary of the (response, exception) of each insert made, by dimension
+    name, like the results of execute_batch.
   """
+  executor = get_default_executor()
+  results = {}
   for i in range(1, 11):
     name = 'dimension'+str(i)   
-    create_dimension(service, account_id, web_property_id, name, 'SESSION')
+    try:
+      response = executor.execute(insert_dimension_request(
+        service, account_id, web_property_id, name, 'SESSION'))
+    except HttpError, error:
+      results[name] = (None, error)
+      report_batch_result(name, None, error)
+      # The next inserts would be given the wrong indexes.
+      break
+    results[name] = (response, None)
+  return results
 
 def update_dimension(service, account_id, web_property_id, dimension_id, field, value):
   """Updates an existing custom dimension field with the given value.
@@ -126,14 +924,9 @@ def update_dimension(service, account_id, web_property_id, dimension_id, field,
     field: str The custom dimension field to be updated.
     value: The new value to be updated.
   """
-  update_body={}
-  update_body[field]=value
   try:
-    service.management().customDimensions().update(
-      accountId=account_id,
-      webPropertyId=web_property_id,
-      customDimensionId=dimension_id,
-      body=update_body).execute()
+    get_default_executor().execute(update_dimension_request(
+      service, account_id, web_property_id, dimension_id, field, value))
 
   except TypeError, error:
     # Handle errors in constructing a query.
@@ -151,11 +944,17 @@ def update_dimensions_name(service, account_id, web_property_id):
     service: The service object built by the Google API Python client library.
     account_id: str The Account ID for the custom dimension to update.
     web_property_id: str The Web property ID for the custom dimension to update.
+
+  Returns:
+    The results of execute_batch, by dimension ID.
   """
+  requests = []
   for i in range(1, 6):
     dimension_id='ga:dimension' + str(i)
     new_name='dimension' + chr(i + ord('A'))
-    update_dimension(service, account_id, web_property_id, dimension_id, 'name', new_name)
+    requests.append((dimension_id, update_dimension_request(
+      service, account_id, web_property_id, dimension_id, 'name', new_name)))
+  return execute_batch(service, requests)
 
 def update_dimensions_scope(service, account_id, web_property_id):
   """Updates an existing custom dimension scope. Changes the scope of 'dimension6'...'dimension10' to a PRODUCT.
@@ -164,45 +963,700 @@ def update_dimensions_scope(service, account_id, web_property_id):
     service: The service object built by the Google API Python client library.
     account_id: str The Account ID for the custom dimension to update.
     web_property_id: str The Web property ID for the custom dimension to update.
+
+  Returns:
+    The results of execute_batch, by dimension ID.
   """
+  requests = []
   for i in range(6, 11):
     dimension_id='ga:dimension'+str(i)    
-    update_dimension(service, account_id, web_property_id, dimension_id, 'scope', 'PRODUCT')
+    requests.append((dimension_id, update_dimension_request(
+      service, account_id, web_property_id, dimension_id, 'scope', 'PRODUCT')))
+  return execute_batch(service, requests)
 
-def print_results(service):
-  """Traverses the management API hiearchy and prints results.
+# Custom dimension fields managed by the reconciler.
+DIMENSION_FIELDS = ('name', 'scope', 'active')
 
-  This retrieves and prints the authorized user's accounts,
-  retrieves and prints all the web properties for the first account,
-  retrieves and prints all the views (profiles) for the first web property of the user's account.
+
+def plan_dimensions(existing, desired):
+  """Computes the writes that bring the custom dimensions to a desired state.
+
+  Custom dimensions cannot be deleted, and the API gives each new one the next
+  free index, so missing dimensions are inserted in index order and the desired
+  indexes must not leave a gap after the existing ones. Dimensions that are not
+  in the desired state are left as they are.
+
+  Args:
+    existing: list The custom dimension resources of the web property.
+    desired: dict The desired 'name', 'scope' and, optionally, 'active' (True by
+      default) of each custom dimension, by index.
+
+  Returns:
+    A list of actions, dictionaries with the 'action' ('insert' or 'update'),
+    the dimension 'index' and 'id', the 'body' to send and, for updates, the
+    'changes' as (old, new) tuples by field.
+
+  Raises:
+    ValueError: If a desired index would leave a gap in the indexes.
+  """
+  current = dict((dimension['index'], dimension) for dimension in existing)
+  next_index = max(current.keys() or [0]) + 1
+  plan = []
+  for index in sorted(desired):
+    state = dict(desired[index])
+    state.setdefault('active', True)
+    body = dict((field, state[field]) for field in DIMENSION_FIELDS)
+    dimension_id = 'ga:dimension%d' % index
+
+    dimension = current.get(index)
+    if dimension is None:
+      if index != next_index:
+        raise ValueError('Custom dimension %d cannot be created before '
+                         'dimension %d exists.' % (index, next_index))
+      next_index += 1
+      plan.append({'action': 'insert', 'index': index, 'id': dimension_id,
+                   'body': body})
+      continue
+
+    changes = dict((field, (dimension.get(field), body[field]))
+                   for field in DIMENSION_FIELDS
+                   if dimension.get(field) != body[field])
+    if changes:
+      plan.append({'action': 'update', 'index': index,
+                   'id': dimension['id'], 'body': body, 'changes': changes})
+  return plan
+
+
+def print_dimension_plan(plan):
+  """Prints the actions returned by plan_dimensions.
+
+  Args:
+    plan: list The actions of the plan.
+  """
+  print '------ Custom Dimension Plan -------'
+  for action in plan:
+    if action['action'] == 'insert':
+      print 'Insert %s : %s' % (action['id'], ', '.join(
+          '%s=%s' % (field, action['body'][field])
+          for field in DIMENSION_FIELDS))
+    else:
+      print 'Update %s : %s' % (action['id'], ', '.join(
+          '%s %s -> %s' % (field, old, new)
+          for field, (old, new) in sorted(action['changes'].items())))
+  if not plan:
+    print 'Custom dimensions are up to date.'
+  print
+
+
+def reconcile_dimensions(service, account_id, web_property_id, desired,
+                         dry_run=False):
+  """Brings the custom dimensions of a web property to a desired state.
+
+  The existing dimensions are read with one paginated list call, and only the
+  writes in the plan are made: the inserts one after the other, since their
+  order sets the indexes, and the updates in one batch request. Against an up
+  to date web property this costs the list call and no write.
+
+  The list call is never answered from a fresh cached response: a plan made
+  from a stale list could insert a dimension that already exists and shift
+  the index of every later one, which cannot be undone. A cached list is
+  revalidated with its ETag instead.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    account_id: str The Account ID of the custom dimensions.
+    web_property_id: str The Web property ID of the custom dimensions.
+    desired: dict The desired 'name', 'scope' and 'active' of each custom
+      dimension, by index.
+    dry_run: bool Whether to only print the plan.
+
+  Returns:
+    The plan, as returned by plan_dimensions.
+  """
+  list_method = service.management().customDimensions().list
+  http = getattr(_thread_state, 'http', None) or service._http
+  if isinstance(http, CachingHttp):
+    http.expire_collection(list_method(
+        accountId=account_id, webPropertyId=web_property_id).uri)
+  existing = list_items(list_method, accountId=account_id,
+                        webPropertyId=web_property_id)
+  plan = plan_dimensions(existing, desired)
+  print_dimension_plan(plan)
+  if dry_run:
+    return plan
+
+  for action in plan:
+    if action['action'] != 'insert':
+      continue
+    body = action['body']
+    try:
+      get_default_executor().execute(insert_dimension_request(
+          service, account_id, web_property_id, body['name'], body['scope'],
+          body['active']))
+    except HttpError, error:
+      report_batch_result(action['id'], None, error)
+      # The next inserts would be given the wrong indexes.
+      break
+
+  updates = [(action['id'], service.management().customDimensions().update(
+                  accountId=account_id, webPropertyId=web_property_id,
+                  customDimensionId=action['id'], body=action['body']))
+             for action in plan if action['action'] == 'update']
+  if updates:
+    execute_batch(service, updates)
+  return plan
+
+
+def get_http_factory(service):
+  """Gets a factory of authorized Http objects sharing the service credentials.
+
+  httplib2.Http is not thread-safe, so each traversal worker thread needs its
+  own.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+
+  Returns:
+    A callable returning a new authorized Http object, or None if the service
+    Http object is not authorized by oauth2client.
+  """
+  http = service._http
+  cache = None
+  if isinstance(http, CachingHttp):
+    http, cache = http.http, http.cache
+  credentials = getattr(http.request, 'credentials', None)
+  if credentials is None:
+    return None
+  if cache is not None:
+    return lambda: CachingHttp(credentials.authorize(httplib2.Http()), cache)
+  return lambda: credentials.authorize(httplib2.Http())
+
+
+class ServicePool(object):
+  """Hands each worker thread its own service object.
+
+  The service objects are built from the discovery document of the given
+  service, each on its own Http object from the http factory. The Http objects
+  share one credentials object, so an access token refreshed by one thread is
+  used by all of them, and oauth2client's Storage lock keeps two threads from
+  refreshing it at once.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    http_factory: callable Returns a new authorized Http object. Defaults to
+      one sharing the service credentials.
+
+  Raises:
+    ValueError: If no http factory is given and the service Http object is not
+      authorized by oauth2client.
+  """
+
+  def __init__(self, service, http_factory=None):
+    self.http_factory = http_factory or get_http_factory(service)
+    if self.http_factory is None:
+      raise ValueError('The service Http object has no credentials to share.')
+    # Each build gets its own copy: building a service fixes up the document.
+    self.document = json.dumps(service._rootDesc)
+    self.local = threading.local()
+
+  def get(self):
+    """Gets the service object of the current thread, building it on first use."""
+    service = getattr(self.local, 'service', None)
+    if service is None:
+      service = self.local.service = build_from_document(
+          self.document, http=self.http_factory())
+    return service
+
+
+def map_properties(service, function, properties,
+                   max_in_flight=DEFAULT_CONCURRENCY, http_factory=None):
+  """Runs a function across many web properties from a pool of threads.
+
+  Each thread calls the function with its own service object from a
+  ServicePool, so at most max_in_flight properties are worked on, and at most
+  that many requests are in flight, at once.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    function: callable Called with a service object, an account ID and a web
+      property ID.
+    properties: iterable (account_id, web_property_id) tuples.
+    max_in_flight: int The max number of properties worked on at once.
+    http_factory: callable Returns a new authorized Http object for each
+      thread. Defaults to one sharing the service credentials.
+
+  Returns:
+    A list of (account_id, web_property_id, result, error) tuples, in the
+    order of properties. error is the exception raised by the function, in
+    which case result is None.
+  """
+  services = ServicePool(service, http_factory)
+
+  def run(web_property):
+    account_id, web_property_id = web_property
+    try:
+      result = function(services.get(), account_id, web_property_id)
+    except Exception, error:
+      return account_id, web_property_id, None, error
+    return account_id, web_property_id, result, None
+
+  pool = ThreadPool(max_in_flight)
+  try:
+    return pool.map(run, properties)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def provision_property(service, account_id, web_property_id):
+  """Creates the custom dimensions of a web property, then renames and rescopes them.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    account_id: str The Account ID of the custom dimensions.
+    web_property_id: str The Web property ID of the custom dimensions.
+  """
+  create_dimensions(service, account_id, web_property_id)
+  update_dimensions_name(service, account_id, web_property_id)
+  update_dimensions_scope(service, account_id, web_property_id)
+
+
+def init_worker_http(http_factory):
+  """Gives the current traversal worker thread its own Http object."""
+  _thread_state.http = http_factory() if http_factory is not None else None
+
+
+def fetch_page(page):
+  """Fetches one page of a collection.
+
+  Args:
+    page: tuple The (list_method, kwargs, start_index, max_results) of the page.
+
+  Returns:
+    The response object of the page.
+  """
+  list_method, kwargs, start_index, max_results = page
+  request = list_method(start_index=start_index, max_results=max_results,
+                        **kwargs)
+  return get_default_executor().execute(
+      request, http=getattr(_thread_state, 'http', None))
+
+
+def list_items(list_method, page_size=DEFAULT_PAGE_SIZE, **kwargs):
+  """Lists every item of a collection, one page after the other.
+
+  Args:
+    list_method: The list method of the collection.
+    page_size: int The max-results of each page.
+    **kwargs: The parameters of the list method.
+
+  Returns:
+    The items of the collection.
+  """
+  items = []
+  start_index = 1
+  while True:
+    page = fetch_page((list_method, kwargs, start_index, page_size))
+    items.extend(page.get('items', []))
+    start_index += page.get('itemsPerPage') or page_size
+    if not page.get('nextLink') or start_index > page.get('totalResults', 0):
+      return items
+
+
+def remaining_pages(list_method, kwargs, first_page, page_size):
+  """Gets the pages of a collection after its first one.
+
+  Args:
+    list_method: The list method of the collection.
+    kwargs: dict The parameters of the list method.
+    first_page: The response object of the first page.
+    page_size: int The max-results asked for the first page.
+
+  Returns:
+    A list of the (list_method, kwargs, start_index, max_results) of each page.
+  """
+  per_page = first_page.get('itemsPerPage') or page_size
+  return [(list_method, kwargs, start_index, per_page)
+          for start_index in range(1 + per_page,
+                                   first_page.get('totalResults', 0) + 1,
+                                   per_page)]
+
+
+def list_collections(pool, listings, page_size=DEFAULT_PAGE_SIZE):
+  """Lists every item of many collections, fetching their pages concurrently.
+
+  The first page of every collection is fetched at once. Its totalResults and
+  itemsPerPage give the start-index of every other page, and those pages are
+  then fetched at once as well.
+
+  Args:
+    pool: ThreadPool The pool the pages are fetched on.
+    listings: list (list_method, kwargs) tuples of the collections to list.
+    page_size: int The max-results of each page.
+
+  Returns:
+    A list of the items of each collection, in the order of listings.
+  """
+  first_pages = pool.map(fetch_page, [
+      (list_method, kwargs, 1, page_size) for list_method, kwargs in listings])
+
+  owners = []
+  pages = []
+  for index, ((list_method, kwargs), page) in enumerate(
+      zip(listings, first_pages)):
+    for other_page in remaining_pages(list_method, kwargs, page, page_size):
+      owners.append(index)
+      pages.append(other_page)
+
+  items = [list(page.get('items', [])) for page in first_pages]
+  for index, page in zip(owners, pool.map(fetch_page, pages)):
+    items[index].extend(page.get('items', []))
+  return items
+
+
+def traverse_hierarchy(service, concurrency=DEFAULT_CONCURRENCY,
+                       page_size=DEFAULT_PAGE_SIZE, http_factory=None):
+  """Lists every account, web property and view (profile) of the user.
+
+  The web properties of all the accounts, then the profiles of all the web
+  properties, are listed concurrently, following the pagination of each
+  collection.
 
   Args:
     service: The service object built by the Google API Python client library.
+    concurrency: int The max number of listing calls in flight.
+    page_size: int The max-results of each page.
+    http_factory: callable Returns a new authorized Http object for each worker
+      thread. Without one the calls share the service Http object, and so are
+      made one at a time.
+
+  Returns:
+    A list with a dictionary per account, holding the 'account' resource and
+    its 'webproperties'. Each of those holds the 'webproperty' resource and its
+    'profiles' resources.
 
   Raises:
     HttpError: If an error occured when accessing the API.
-    AccessTokenRefreshError: If the current token was invalid.
   """
+  management = service.management()
+  if http_factory is None:
+    concurrency = 1
+  pool = ThreadPool(concurrency, init_worker_http, (http_factory,))
+  try:
+    accounts, = list_collections(
+        pool, [(management.accounts().list, {})], page_size)
+    webproperties = list_collections(
+        pool, [(management.webproperties().list, {'accountId': account['id']})
+               for account in accounts], page_size)
+
+    tree = []
+    property_nodes = []
+    profile_listings = []
+    for account, account_webproperties in zip(accounts, webproperties):
+      account_node = {'account': account, 'webproperties': []}
+      for webproperty in account_webproperties:
+        property_node = {'webproperty': webproperty, 'profiles': []}
+        account_node['webproperties'].append(property_node)
+        property_nodes.append(property_node)
+        profile_listings.append((management.profiles().list, {
+            'accountId': account['id'], 'webPropertyId': webproperty['id']}))
+      tree.append(account_node)
+
+    for property_node, profiles in zip(
+        property_nodes, list_collections(pool, profile_listings, page_size)):
+      property_node['profiles'] = profiles
+  finally:
+    pool.close()
+    pool.join()
+  return tree
+
+
+def fetch_page_items(page):
+  """Fetches one page of a collection in a pool, keeping only its items.
+
+  Args:
+    page: tuple The (list_method, kwargs, start_index, max_results) of the page.
+
+  Returns:
+    The items of the page, and the page itself if it is the first one.
+  """
+  response = fetch_page(page)
+  return response.get('items', []), response if page[2] == 1 else None
 
-  accounts = service.management().accounts().list().execute()
-  print_accounts(accounts)
 
-  if accounts.get('items'):
-    firstAccountId = accounts.get('items')[0].get('id')
-    webproperties = service.management().webproperties().list(
-        accountId=firstAccountId).execute()
+def iter_collection_items(pool, listings, page_size=DEFAULT_PAGE_SIZE,
+                          window=DEFAULT_CONCURRENCY * PAGES_PER_WORKER):
+  """Streams the items of many collections as their pages arrive.
 
-    print_webproperties(webproperties)
+  Pages are fetched window at a time. Once every page of a window has arrived,
+  they are handed over in the order they were queued, so only window pages are
+  held in memory whatever the size of the collections.
 
-    if webproperties.get('items'):
-      firstWebpropertyId = webproperties.get('items')[0].get('id')
-      profiles = service.management().profiles().list(
-          accountId=firstAccountId,
-          webPropertyId=firstWebpropertyId).execute()
+  Args:
+    pool: ThreadPool The pool the pages are fetched on.
+    listings: iterable (list_method, kwargs) tuples of the collections to list.
+    page_size: int The max-results of each page.
+    window: int The max number of pages fetched but not handed over yet.
+
+  Yields:
+    (kwargs, items) tuples of the list method parameters and the items of one
+    page.
+  """
+  pages = collections.deque()
+  listings = iter(listings)
+  while True:
+    # Queue the first page of the next collections while there is room.
+    while len(pages) < window:
+      try:
+        list_method, kwargs = next(listings)
+      except StopIteration:
+        break
+      pages.append((list_method, kwargs, 1, page_size))
+    if not pages:
+      return
+
+    chunk = [pages.popleft() for _ in range(min(window, len(pages)))]
+    for (items, first_page), page in zip(pool.map(fetch_page_items, chunk),
+                                         chunk):
+      if first_page is not None:
+        pages.extend(remaining_pages(page[0], page[1], first_page, page_size))
+      yield page[1], items
+
+
+def flatten(resource, columns):
+  """Flattens a resource into a row of export columns.
 
-      print_profiles(profiles)
+  Args:
+    resource: dict The API resource.
+    columns: list The (column, field path) of each column.
+
+  Returns:
+    A tuple of the column values, None where a field is missing.
+  """
+  row = []
+  for _, path in columns:
+    value = resource
+    for field in path:
+      value = value.get(field) if value is not None else None
+    row.append(value)
+  return tuple(row)
 
-  print_segments(service.management().segments().list().execute())
+
+class JsonLinesWriter(object):
+  """Writes rows as JSON Lines, one object per row.
+
+  Args:
+    path: str The path of the output file.
+    columns: list The (column, field path) of each column.
+  """
+
+  extension = 'jsonl'
+
+  def __init__(self, path, columns):
+    self.names = [name for name, _ in columns]
+    self.file = open(path, 'wb')
+    self.encoder = json.JSONEncoder(separators=(',', ':'))
+
+  def write_rows(self, rows):
+    self.file.write(''.join(
+        self.encoder.encode(collections.OrderedDict(zip(self.names, row))) +
+        '\n' for row in rows))
+
+  def close(self):
+    self.file.close()
+
+
+class CsvWriter(object):
+  """Writes rows as UTF-8 CSV, with a header row.
+
+  Args:
+    path: str The path of the output file.
+    columns: list The (column, field path) of each column.
+  """
+
+  extension = 'csv'
+
+  def __init__(self, path, columns):
+    self.file = open(path, 'wb')
+    self.writer = csv.writer(self.file)
+    self.writer.writerow([name for name, _ in columns])
+
+  def write_rows(self, rows):
+    self.writer.writerows(
+        [value.encode('utf-8') if isinstance(value, unicode) else value
+         for value in row] for row in rows)
+
+  def close(self):
+    self.file.close()
+
+
+class ParquetWriter(object):
+  """Writes rows to a Parquet file of string columns.
+
+  Rows are buffered up to PARQUET_ROW_GROUP_SIZE and written a row group at a
+  time.
+
+  Args:
+    path: str The path of the output file.
+    columns: list The (column, field path) of each column.
+
+  Raises:
+    ImportError: If pyarrow is not installed.
+  """
+
+  extension = 'parquet'
+
+  def __init__(self, path, columns):
+    if pyarrow is None:
+      raise ImportError('Exporting to Parquet needs pyarrow.')
+    self.schema = pyarrow.schema(
+        [pyarrow.field(name, pyarrow.string()) for name, _ in columns])
+    self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+    self.rows = []
+
+  def write_rows(self, rows):
+    self.rows.extend(rows)
+    if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+      self.flush()
+
+  def flush(self):
+    if not self.rows:
+      return
+    arrays = [pyarrow.array([None if value is None else unicode(value)
+                             for value in values], pyarrow.string())
+              for values in zip(*self.rows)]
+    self.writer.write_table(
+        pyarrow.Table.from_arrays(arrays, schema=self.schema))
+    self.rows = []
+
+  def close(self):
+    self.flush()
+    self.writer.close()
+
+
+# Export writers by format name.
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def export_hierarchy(service, directory, output_format='jsonl',
+                     concurrency=DEFAULT_CONCURRENCY,
+                     page_size=DEFAULT_PAGE_SIZE, http_factory=None):
+  """Exports every account, web property and view (profile) of the user.
+
+  Each collection is written to its own file of flat rows in the directory:
+  accounts, webproperties and profiles. The profiles are written page by page
+  as they arrive and are not kept, so memory does not grow with their number.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    directory: str The directory the files are written to.
+    output_format: str The output format: jsonl, csv or parquet.
+    concurrency: int The max number of listing calls in flight.
+    page_size: int The max-results of each page.
+    http_factory: callable Returns a new authorized Http object for each worker
+      thread. Defaults to one sharing the service credentials.
+
+  Returns:
+    A dictionary of the number of rows written, by collection.
+  """
+  writer_class = WRITERS[output_format]
+  if http_factory is None:
+    http_factory = get_http_factory(service)
+  if http_factory is None:
+    concurrency = 1
+  management = service.management()
+  counts = {}
+
+  def open_writer(name, columns):
+    return writer_class(
+        os.path.join(directory, '%s.%s' % (name, writer_class.extension)),
+        columns)
+
+  pool = ThreadPool(concurrency, init_worker_http, (http_factory,))
+  try:
+    accounts, = list_collections(
+        pool, [(management.accounts().list, {})], page_size)
+    writer = open_writer('accounts', ACCOUNT_COLUMNS)
+    writer.write_rows(flatten(account, ACCOUNT_COLUMNS) for account in accounts)
+    writer.close()
+    counts['accounts'] = len(accounts)
+
+    # Only the ids of the web properties are kept, to list their profiles.
+    property_ids = []
+    writer = open_writer('webproperties', WEBPROPERTY_COLUMNS)
+    for kwargs, items in iter_collection_items(
+        pool, ((management.webproperties().list, {'accountId': account['id']})
+               for account in accounts),
+        page_size, concurrency * PAGES_PER_WORKER):
+      writer.write_rows(flatten(item, WEBPROPERTY_COLUMNS) for item in items)
+      property_ids.extend((kwargs['accountId'], item['id']) for item in items)
+    writer.close()
+    counts['webproperties'] = len(property_ids)
+
+    counts['profiles'] = 0
+    writer = open_writer('profiles', PROFILE_COLUMNS)
+    for _, items in iter_collection_items(
+        pool, ((management.profiles().list,
+                {'accountId': account_id, 'webPropertyId': web_property_id})
+               for account_id, web_property_id in property_ids),
+        page_size, concurrency * PAGES_PER_WORKER):
+      writer.write_rows(flatten(item, PROFILE_COLUMNS) for item in items)
+      counts['profiles'] += len(items)
+    writer.close()
+  finally:
+    pool.close()
+    pool.join()
+  return counts
+
+
+def collection(items):
+  """Wraps the items of every page of a collection in one response object.
+
+  Args:
+    items: list The items of the collection.
+
+  Returns:
+    A response object for the print functions.
+  """
+  return {'items': items, 'itemsPerPage': len(items),
+          'totalResults': len(items)}
+
+
+def print_results(service, concurrency=DEFAULT_CONCURRENCY, http_factory=None):
+  """Traverses the management API hiearchy and prints results.
+
+  This retrieves and prints the authorized user's accounts,
+  retrieves and prints all the web properties of every account,
+  retrieves and prints all the views (profiles) of every web property,
+  and retrieves and prints all the user's segments.
+
+  Args:
+    service: The service object built by the Google API Python client library.
+    concurrency: int The max number of listing calls in flight.
+    http_factory: callable Returns a new authorized Http object for each worker
+      thread. Defaults to one sharing the service credentials.
+
+  Raises:
+    HttpError: If an error occured when accessing the API.
+    AccessTokenRefreshError: If the current token was invalid.
+  """
+  if http_factory is None:
+    http_factory = get_http_factory(service)
+  tree = traverse_hierarchy(service, concurrency, http_factory=http_factory)
+
+  print_accounts(collection([node['account'] for node in tree]))
+  for account_node in tree:
+    print_webproperties(collection(
+        [node['webproperty'] for node in account_node['webproperties']]))
+    for property_node in account_node['webproperties']:
+      print_profiles(collection(property_node['profiles']))
+
+  print_segments(collection(
+      list_items(service.management().segments().list)))
 
 
 def print_accounts(accounts_response):
@@ -318,6 +1772,32 @@ def print_profiles(profiles_response):
     print 'No profiles found.\n'
 
 
+def print_segments(segments_response):
+  """Prints all the segment info in the Segments collection.
+
+  Args:
+    segments_response: The response object returned from querying the Segments
+        collection.
+  """
+
+  print '------ Segments Collection -------'
+  print_pagination_info(segments_response)
+  print
+
+  for segment in segments_response.get('items', []):
+    print 'Segment ID = %s' % segment.get('id')
+    print 'Kind       = %s' % segment.get('kind')
+    print 'Self Link  = %s' % segment.get('selfLink')
+    print 'Name       = %s' % segment.get('name')
+    print 'Definition = %s' % segment.get('definition')
+    print 'Created    = %s' % segment.get('created')
+    print 'Updated    = %s' % segment.get('updated')
+    print
+
+  if not segments_response.get('items'):
+    print 'No segments found.\n'
+
+
 def print_pagination_info(results):
   """Prints common pagination details.
 
@@ -338,32 +1818,38 @@ def print_pagination_info(results):
 
 
 
-def main():
+def main(cache_path=CACHE_PATH, discovery_path=DISCOVERY_PATH):
   # Define the auth scopes to request.
   scope = ['https://www.googleapis.com/auth/analytics.readonly']
 
-  # Authenticate and construct service.
-  service = get_service('analytics', 'v3', scope, 'client_secrets.json')
+  # Authenticate and construct service. The listings are cached between runs.
+  cache = MetadataCache(cache_path)
+  service = get_service('analytics', 'v3', scope, 'client_secrets.json', cache,
+                        discovery_path)
   
   # Set up API headers
-  # Account ID for the custom dimension to create/update.
-  account_id = '123456'
-
-  # Web property ID for the custom dimension to create/update
-  web_property_id = 'UA-123456-1'
+  # (Account ID, Web property ID) of each property whose custom dimensions to
+  # create/update.
+  properties = [('123456', 'UA-123456-1')]
   
   # TaskA1: Create 10 custom session dimensions (‘dimension1’...’dimension10’)!
-  create_dimensions(service, account_id, web_property_id)
-
   # TaskA2: Change the name of ‘dimension1’...’dimension5’ to ‘dimensionA’...’dimensionE’!
-  update_dimensions_name(service, account_id, web_property_id)
-
   # TaskA3: Change the scope of ‘dimension6’…’dimension10’ to a different one!
-  update_dimensions_scope(service, account_id, web_property_id)
+  # The properties are provisioned in parallel, each on its own thread.
+  for account_id, web_property_id, _, error in map_properties(
+      service, provision_property, properties):
+    if error is not None:
+      print 'Provisioning %s failed : %s' % (web_property_id, error)
 
   # TaskB1: Get all GA accounts, properties & views for a Google account of your choice and
   # provide/visualize an overview for it!
   print_results(service)
+
+  print_executor_stats()
+  stats = cache.stats()
+  print 'Cache: %d hits, %d revalidated, %d misses' % (
+      stats['hits'], stats['revalidated'], stats['misses'])
+  cache.close()
   
 if __name__ == '__main__':
   main()